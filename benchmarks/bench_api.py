@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+""" Benchmark request throughput against a local fake GitHub server.
+
+Usage: PYTHONPATH=. python benchmarks/bench_api.py [options]
+
+Results can be saved (--save) to benchmarks/results/<version>.json and
+compared with results of another release (--compare). Saved results are
+never overwritten, so a baseline has to be measured on the released code,
+e.g. in a separate worktree (the fake server is loaded from this checkout
+if the release doesn't have it):
+
+    git worktree add /tmp/stscraper-1.4.0 <1.4.0 release commit>
+    PYTHONPATH=/tmp/stscraper-1.4.0 python benchmarks/bench_api.py --save
+    PYTHONPATH=. python benchmarks/bench_api.py \\
+        --compare benchmarks/results/1.4.0.json
+
+Benchmarks of features missing in the measured version are skipped.
+Numbers are only comparable if measured on the same machine.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import stscraper
+from stscraper import base
+
+try:
+    from stscraper.fakeserver import FakeGitHub
+except ImportError:  # older releases don't have the fake server
+    import importlib.util
+    _spec = importlib.util.spec_from_file_location(
+        'stscraper.fakeserver', os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            'stscraper', 'fakeserver.py'))
+    _fakeserver = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(_fakeserver)
+    FakeGitHub = _fakeserver.FakeGitHub
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_json_map import MAPPING, make_issue  # noqa: E402
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'results')
+
+
+def _measure(func, repeat):
+    """ Get the best time out of `repeat` runs, and the result """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_rest(server, items, per_page, prefetch, repeat):
+    """ Paginated REST request, items/s and requests/s """
+    server.paginated('repos/user/repo/issues', items, per_page)
+    api = server.api('token1,token2,token3')
+    api.prefetch = prefetch
+
+    def run():
+        return sum(1 for _ in api.request(
+            'repos/user/repo/issues', paginate=True, per_page=per_page))
+
+    elapsed, count = _measure(run, repeat)
+    assert count == len(items)
+    pages = (len(items) - 1) // per_page + 1
+    return {'items_per_sec': count / elapsed,
+            'requests_per_sec': pages / elapsed}
+
+
+def bench_v4(server, items, per_page, repeat):
+    """ Paginated GraphQL request, items/s and requests/s """
+    server.connection('repository.issues', items, per_page)
+    api = server.api('token1,token2,token3', stscraper.GitHubAPIv4)
+    query = """query ($owner: String!, $name: String!, $cursor: String) {
+        repository(owner: $owner, name: $name) {
+            issues(first: 100, after: $cursor) {
+                nodes { number title state }
+                pageInfo { endCursor hasNextPage }
+        }}}"""
+
+    def run():
+        return sum(1 for _ in api(query, owner='user', name='repo'))
+
+    elapsed, count = _measure(run, repeat)
+    assert count == len(items)
+    pages = (len(items) - 1) // per_page + 1
+    return {'items_per_sec': count / elapsed,
+            'requests_per_sec': pages / elapsed}
+
+
+def bench_tokens(n_tokens, n_acquire, repeat):
+    """ Token scheduling without network, acquisitions/s """
+    tokens = [stscraper.GitHubAPIToken('token%d' % i)
+              for i in range(n_tokens)]
+    reset = int(time.time()) + 3600
+    for i, token in enumerate(tokens):
+        token.limits['core'] = {
+            'remaining': 1000 + i, 'limit': 5000, 'reset': reset}
+
+    def run():
+        scheduler = stscraper.TokenScheduler(tokens)
+        for _ in range(n_acquire):
+            scheduler.acquire('repos')
+
+    elapsed, _ = _measure(run, repeat)
+    return {'acquire_per_sec': n_acquire / elapsed}
+
+
+def bench_json_map(records, repeat):
+    """ json_map projection, compiled if supported, records/s """
+    if hasattr(base, 'compile_mapping'):
+        mapping = base.compile_mapping(MAPPING)
+        run = lambda: list(mapping.map_many(records))  # noqa: E731
+    else:
+        run = lambda: [base.json_map(MAPPING, record)  # noqa: E731
+                       for record in records]
+    elapsed, _ = _measure(run, repeat)
+    return {'records_per_sec': len(records) / elapsed}
+
+
+def run_all(args):
+    items = [make_issue(i) for i in range(args.items)]
+    results = {}
+
+    server = FakeGitHub(latency=args.latency)
+    try:
+        results['rest'] = bench_rest(
+            server, items, args.per_page, 0, args.repeat)
+        results['rest_prefetch'] = bench_rest(
+            server, items, args.per_page, 8, args.repeat)
+        results['v4'] = bench_v4(server, items, args.per_page, args.repeat)
+    finally:
+        server.shutdown()
+    if hasattr(stscraper, 'TokenScheduler'):
+        results['tokens'] = bench_tokens(100, 100000, args.repeat)
+    results['json_map'] = bench_json_map(items * 10, args.repeat)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--items', type=int, default=5000,
+                        help="number of items in paginated responses")
+    parser.add_argument('--per-page', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help="fake server response latency, seconds")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', action='store_true',
+                        help="save results to benchmarks/results/")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="previously saved results to compare with")
+    args = parser.parse_args(argv)
+
+    path = os.path.join(RESULTS_DIR, stscraper.__version__ + '.json')
+    if args.save and os.path.exists(path):
+        parser.error("%s already exists. Saved results are not overwritten; "
+                     "remove the file to measure again" % path)
+
+    results = run_all(args)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)['results']
+
+    for name in sorted(results):
+        for metric, value in sorted(results[name].items()):
+            line = '%-16s %-18s %12.0f' % (name, metric, value)
+            old = baseline.get(name, {}).get(metric)
+            if old:
+                line += '  %+6.1f%%' % ((value / old - 1) * 100)
+            print(line)
+
+    if args.save:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        with open(path, 'w') as fh:
+            json.dump({
+                'version': stscraper.__version__,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'options': {key: value for key, value in vars(args).items()
+                            if key not in ('save', 'compare')},
+                'results': results,
+            }, fh, indent=2, sort_keys=True)
+        print('saved to', path)
+
+
+if __name__ == '__main__':
+    main()
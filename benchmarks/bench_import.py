@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+""" Measure startup time: importing stscraper and constructing an API.
+
+Every stage runs in a fresh interpreter; the best of several runs is
+reported, net of the interpreter startup time. Tokens are validated
+against a local fake server, so no network access is required.
+
+Usage: PYTHONPATH=. python benchmarks/bench_import.py [runs]
+"""
+
+from __future__ import print_function
+
+import os
+import subprocess
+import sys
+import time
+
+from stscraper.fakeserver import FakeGitHub
+
+CONSTRUCT = """
+import os, stscraper
+class Token(stscraper.GitHubAPIToken):
+    api_url = os.environ['FAKE_GITHUB_URL']
+class API(stscraper.GitHubAPI):
+    token_class = Token
+API('token1,token2,token3,token4')
+"""
+
+STAGES = (
+    ('python', 'pass'),
+    ('import stscraper', 'import stscraper'),
+    ('access GitHubAPI', 'import stscraper; stscraper.GitHubAPI'),
+    ('construct API', CONSTRUCT),
+)
+
+
+def measure(code, runs, env):
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code], env=env)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(runs=10):
+    server = FakeGitHub(latency=0.02)
+    env = dict(os.environ, FAKE_GITHUB_URL=server.url)
+    try:
+        baseline = None
+        for name, code in STAGES:
+            elapsed = measure(code, runs, env)
+            if baseline is None:
+                baseline = elapsed
+                print('%-20s %7.1f ms' % (name, elapsed * 1000))
+            else:
+                print('%-20s %+7.1f ms' % (name, (elapsed - baseline) * 1000))
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
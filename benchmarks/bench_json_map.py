@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+""" Compare json_map with compiled mappings on synthetic issue records.
+
+Usage: PYTHONPATH=. python benchmarks/bench_json_map.py [number_of_records]
+"""
+
+from __future__ import print_function
+
+import sys
+import timeit
+
+MAPPING = {
+    'number': 'number',
+    'title': 'title',
+    'state': 'state',
+    'author': 'user__login',
+    'author_type': 'user__type',
+    'author_site_admin': 'user__site_admin',
+    'assignee': 'assignee__login',
+    'milestone': 'milestone__title',
+    'milestone_state': 'milestone__state',
+    'labels': 'labels__,name',
+    'reactions': 'reactions__total_count',
+    'created_at': 'created_at',
+    'closed_at': 'closed_at',
+    'pr_url': 'pull_request__url',
+}
+
+
+def make_issue(i):
+    return {
+        'number': i, 'title': 'Issue %d' % i, 'state': 'open',
+        'body': 'x' * 200,
+        'user': {'login': 'user%d' % (i % 100), 'type': 'User',
+                 'site_admin': False, 'id': i},
+        'assignee': None if i % 3 else {'login': 'maintainer'},
+        'milestone': {'title': 'v1.0', 'state': 'open'} if i % 2 else None,
+        'labels': [{'name': 'bug'}, {'name': 'help wanted'}][:i % 3],
+        'reactions': {'total_count': i % 7, '+1': 0},
+        'created_at': '2020-01-01T00:00:00Z', 'closed_at': None,
+    }
+
+
+def main(n=100000):
+    from stscraper.base import compile_mapping, json_map
+    records = [make_issue(i) for i in range(n)]
+    compiled = compile_mapping(MAPPING)
+    assert [json_map(MAPPING, r) for r in records[:1000]] == \
+        list(compiled.map_many(records[:1000]))
+
+    baseline = min(timeit.repeat(
+        lambda: [json_map(MAPPING, r) for r in records], number=1, repeat=3))
+    optimized = min(timeit.repeat(
+        lambda: list(compiled.map_many(records)), number=1, repeat=3))
+
+    print('records:              %d' % n)
+    print('json_map:             %.0f records/s' % (n / baseline))
+    print('compile_mapping:      %.0f records/s' % (n / optimized))
+    print('speedup:              %.1fx' % (baseline / optimized))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
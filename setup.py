@@ -39,10 +39,17 @@ setup(
     platforms=["Linux", "Solaris", "Mac OS-X", "Unix", "Windows"],
     python_requires='>2.6, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*, <4',
     entry_points={
-        'console_scripts': ["check_gh_limits = stscraper.github:print_limits"]
+        'console_scripts': [
+            "check_gh_limits = stscraper.github:print_limits",
+            "stscraper-coordinator = stscraper.coordinator:main",
+        ]
     },
     packages=[package],
     url='https://github.com/cmustrudel/strudel.scraper',
     install_requires=requirements,
+    extras_require={
+        'async': ['aiohttp'],
+        'parquet': ['pyarrow'],
+    },
     **kwargs
 )
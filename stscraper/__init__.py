@@ -1,6 +1,43 @@
-
-from .github import *
+import importlib
+import sys
 
 __version__ = '1.4.0'
 __author__ = "Marat (@cmu.edu)"
 __license__ = "GPL v3"
+
+__all__ = [
+    # stscraper.base
+    'VCSError', 'RepoDoesNotExist', 'TokenNotReady', 'URL_PATTERN',
+    'named_url_pattern', 'parse_url', 'json_path', 'json_map', 'iter_json',
+    'CompiledMapping', 'compile_mapping', 'Transport', 'api', 'api_filter',
+    'APIToken', 'DummyAPIToken', 'TokenScheduler', 'BackoffPolicy',
+    'SingleFlight', 'VCSAPI',
+    # stscraper.github
+    'GitHubAPIToken', 'GitHubAPI', 'parse_graphql_path', 'GitHubAPIv4',
+    'get_limits', 'print_limits',
+]
+
+_SUBMODULES = ('aio', 'base', 'cache', 'coordinator', 'export', 'fakeserver',
+               'github', 'graphql', 'metrics', 'pool', 'store')
+
+if sys.version_info < (3, 7):  # no module __getattr__ (PEP 562)
+    from .github import *
+else:
+    # `requests` alone takes tens of milliseconds to import, so
+    # the API is only loaded when it is actually used
+    def __getattr__(name):
+        if name in _SUBMODULES:
+            return importlib.import_module('.' + name, __name__)
+        if name.startswith('__'):
+            raise AttributeError(name)
+        github = importlib.import_module('.github', __name__)
+        try:
+            value = getattr(github, name)
+        except AttributeError:
+            raise AttributeError(
+                "module '%s' has no attribute '%s'" % (__name__, name))
+        globals()[name] = value
+        return value
+
+    def __dir__():
+        return sorted(set(globals()) | set(__all__) | set(_SUBMODULES))
@@ -0,0 +1,706 @@
+""" asyncio interface to GitHub API.
+
+This module mirrors :py:class:`GitHubAPI` and :py:class:`GitHubAPIv4`, but
+instead of blocking on every request it lets a single event loop keep
+many requests in flight across the pool of tokens:
+
+>>> import asyncio
+>>> from stscraper.aio import AsyncGitHubAPI
+>>> async def main():
+...     async with AsyncGitHubAPI('token1,token2') as api:
+...         info = await api.repo_info('cmustrudel/strudel.scraper')
+...         async for commit in api.repo_commits('cmustrudel/strudel.scraper'):
+...             pass
+>>> asyncio.run(main())
+
+Methods returning a single object are coroutines, paginated methods are
+async generators. Tokens and their rate limits are shared with the
+singletons of the regular (blocking) API classes, i.e. `AsyncGitHubAPI`
+uses the same tokens as `GitHubAPI`, and `AsyncGitHubAPIv4` uses the same
+tokens as `GitHubAPIv4`, so both can be used at the same time.
+
+This module requires Python 3.6+ and `aiohttp`.
+"""
+
+import asyncio
+import collections
+from datetime import datetime
+import itertools
+import json
+import time
+from functools import wraps
+
+import requests
+
+try:
+    import aiohttp
+except ImportError:  # optional dependency
+    aiohttp = None
+
+from .base import TokenNotReady, VCSAPI, _build_response, _request_key, \
+    json_path
+from . import graphql
+from .github import GitHubAPI, GitHubAPIv4, _inject_rate_limit
+
+
+# syntax sugar for GET API calls, async version of base.api
+def aio_api(url, paginate=False, watermark=None, **params):
+    def wrapper(func):
+        if paginate:
+            @wraps(func)
+            def caller(self, *args):
+                formatted_url = url % func(self, *args)
+                if watermark and self.watermarks is not None:
+                    return self.incremental(
+                        formatted_url, watermark, **params)
+                return self.request(formatted_url, paginate=True, **params)
+        else:
+            @wraps(func)
+            async def caller(self, *args):
+                formatted_url = url % func(self, *args)
+                async for res in self.request(formatted_url, **params):
+                    return res
+        return caller
+    return wrapper
+
+
+def aio_api_filter(filter_func):
+    def wrapper(func):
+        @wraps(func)
+        async def caller(*args):
+            async for item in func(*args):
+                if filter_func(item):
+                    yield item
+        return caller
+    return wrapper
+
+
+def _blocking(name, replacement=None):
+    """ Stub for inherited blocking methods that have no async version """
+    def method(self, *args, **kwargs):
+        raise NotImplementedError("%s.%s() is not supported by the async API%s"
+                                  % (self.__class__.__name__, name,
+                                     replacement and ", use %s() instead"
+                                     % replacement or ""))
+    method.__name__ = name
+    return method
+
+
+class AsyncGitHubAPI(GitHubAPI):
+    """ An asyncio version of :py:class:`GitHubAPI`.
+
+    It accepts the same arguments and has the same set of methods, but
+    methods returning a single object are coroutines and paginated methods
+    are async generators.
+
+    Tokens and the token scheduler are taken from the `sync_class`
+    singleton, so rate limits are tracked across both APIs.
+
+    Connections are made through a single `aiohttp.ClientSession`, which is
+    created on the first request in the running event loop. Use the object
+    as an async context manager or call :py:meth:`close` to release it.
+    """
+    # max number of simultaneous connections
+    connections = 100
+    # blocking API class to share tokens with
+    sync_class = GitHubAPI
+
+    _session = None  # type: aiohttp.ClientSession
+    _session_loop = None
+
+    def __init__(self, tokens=None, timeout=30):
+        if aiohttp is None:
+            raise ImportError(
+                "AsyncGitHubAPI requires aiohttp. "
+                "Please install it first, e.g. `pip install aiohttp`")
+        api = self.sync_class(tokens, timeout)
+        self.tokens = api.tokens
+        self.scheduler = api.scheduler
+        # tokens were already looked up and validated by the blocking API
+        VCSAPI.__init__(self, None, timeout)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    def _get_session(self):
+        # aiohttp sessions are bound to the event loop they're created in
+        loop = asyncio.get_event_loop()
+        if self._session is None or self._session.closed \
+                or self._session_loop is not loop:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections))
+            self._session_loop = loop
+        return self._session
+
+    async def close(self):
+        """ Close the underlying HTTP session """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _call_token(self, token, url, method='get', data=None,
+                          headers=None, **params):
+        """ Async version of APIToken.__call__ """
+        if not token.ready(url):
+            raise TokenNotReady
+
+        session = self._get_session()
+        params = {k: v for k, v in params.items() if v is not None}
+        async with session.request(
+                method, token.api_url + url, params=params, data=data,
+                headers=dict(token._headers or {}, **(headers or {})),
+                timeout=aiohttp.ClientTimeout(total=token.timeout)) as resp:
+            content = await resp.read()
+        r = _build_response(resp.status, resp.headers, content,
+                            str(resp.url), resp.reason)
+
+        token._update_limits(r, url)
+        return r
+
+    @staticmethod
+    async def _first(gen):
+        """ Get the first item of an async generator, or None """
+        async for obj in gen:
+            return obj
+
+    async def aiterate_tokens(self, url="", cost=1):
+        """ Async version of :py:meth:`iterate_tokens` """
+        while True:
+            token, next_res = self.scheduler.acquire(url, cost)
+            if token is not None:
+                yield token
+                continue
+
+            sleep = int(next_res - time.time()) + 1
+            if sleep > 0:
+                self.logger.info(
+                    "%s: out of keys, resuming in %d minutes, %d seconds",
+                    datetime.now().strftime("%H:%M"), *divmod(sleep, 60))
+                if self.metrics is not None:
+                    self.metrics.inc('blocked_seconds_total', sleep)
+                await asyncio.sleep(sleep)
+                self.logger.info(".. resumed")
+
+    # blocking helpers, async methods don't use them
+    iterate_tokens = _blocking('iterate_tokens', 'aiterate_tokens')
+    _cached_fetch = _blocking('_cached_fetch', '_request')
+    _page_since = _blocking('_page_since')
+    _max_id = _blocking('_max_id')
+    _scan_shard = _blocking('_scan_shard')
+
+    async def request(self, url, method='get', data=None, paginate=False,
+                      prefetch=None, **params):
+        """ Async version of :py:meth:`GitHubAPI.request` """
+        key = None
+        if paginate:
+            params.update(self.init_pagination())
+            if self.checkpoints is not None:
+                key = self.checkpoint_key(url, method, data, **params)
+                last_completed = self._resume(key)
+                if last_completed:
+                    params['page'] = last_completed + 1
+        if prefetch is None:
+            prefetch = self.prefetch
+
+        while True:
+            r = await self._request(url, method, data, **params)
+            if r.status_code in self.status_empty:
+                self._complete(key)
+                return
+
+            res = self.extract_result(r)
+            if paginate:
+                for item in res:
+                    yield item
+                if not res or not self._has_next_page(r):
+                    self._complete(key)
+                    return
+                self._checkpoint(key, params['page'])
+                last_page = prefetch and self._last_page(r)
+                if last_page:
+                    async for page, res in self._prefetch_pages(
+                            url, method, data, params, last_page, prefetch):
+                        for item in res:
+                            yield item
+                        self._checkpoint(key, page)
+                    self._complete(key)
+                    return
+                else:
+                    params["page"] += 1
+                    continue
+            else:
+                yield res
+                return
+
+    async def incremental(self, url, watermark, **params):
+        """ Async version of :py:meth:`GitHubAPI.incremental` """
+        key = _request_key(url, params)
+        path = watermark.split('__')
+        since = self.watermarks.get(key)
+        if since:
+            params['since'] = since
+
+        high = since
+        async for item in self.request(url, paginate=True, **params):
+            timestamp = json_path(item, path)
+            if timestamp and (high is None or timestamp > high):
+                high = timestamp
+            yield item
+
+        if high != since:
+            self.watermarks.set(key, high)
+
+    async def _prefetch_pages(self, url, method, data, params, last_page,
+                              window):
+        """ Async version of :py:meth:`GitHubAPI._prefetch_pages` """
+        async def fetch(page):
+            r = await self._request(
+                url, method, data, **dict(params, page=page))
+            if r.status_code in self.status_empty:
+                return []
+            return self.extract_result(r)
+
+        pages = iter(range(params['page'] + 1, last_page + 1))
+        pending = collections.deque(
+            (page, asyncio.ensure_future(fetch(page)))
+            for page in itertools.islice(pages, window))
+        try:
+            while pending:
+                page, task = pending.popleft()
+                res = await task
+                for next_page in itertools.islice(pages, 1):
+                    pending.append(
+                        (next_page, asyncio.ensure_future(fetch(next_page))))
+                yield page, res
+        finally:
+            for _, task in pending:
+                task.cancel()
+
+    async def _request(self, url, method='get', data=None, cost=1,
+                       **params):
+        """ Async version of :py:meth:`GitHubAPI._request` """
+        cache = self.response_cache
+        if cache is not None:
+            r = cache.get(url, params, method, data)
+            if r is not None:
+                if self.metrics is not None:
+                    self.metrics.inc('cache_hits_total', cache='response')
+                return r
+
+        r = await self._fetch(url, method, data, cost=cost, **params)
+        if cache is not None:
+            cache.set(url, params, method, data, r)
+        return r
+
+    async def _fetch(self, url, method='get', data=None, cost=1, **params):
+        """ Async version of :py:meth:`GitHubAPI._fetch` """
+        timeout_counter = 0
+        cached = None
+        conditional = self.etag_cache is not None and method.lower() == 'get'
+        if conditional:
+            cached = self.etag_cache.lookup(url, params)
+
+        async for token in self.aiterate_tokens(url, cost):
+            start = time.time()
+            try:
+                r = await self._call_token(
+                    token, url, method=method, data=data,
+                    headers=self.etag_cache.validators(cached)
+                    if conditional else None, **params)
+            except TokenNotReady:
+                if self.metrics is not None:
+                    self.metrics.inc('retries_total', reason='token_not_ready')
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if self.metrics is not None:
+                    self.metrics.inc('retries_total', reason='connection')
+                timeout_counter += 1
+                if timeout_counter > self.retries_on_timeout:
+                    raise
+                continue  # i.e. try again
+
+            self._record_response(token, url, r, time.time() - start)
+            delay = self._retry_delay(r, url, timeout_counter + 1, token)
+            if delay is not None:
+                if delay > 0:
+                    timeout_counter += 1
+                    await asyncio.sleep(delay)
+                continue  # i.e. try again
+
+            if conditional:
+                if r.status_code == 304 and cached is not None \
+                        and self.metrics is not None:
+                    self.metrics.inc('cache_hits_total', cache='etag')
+                r = self.etag_cache.update(url, params, r, cached)
+            r.raise_for_status()
+            return r
+
+    # ===================================
+    #           API methods
+    # ===================================
+    async def scan(self, url, since=0, until=None, shards=1):
+        """ Async version of :py:meth:`GitHubAPI.scan`, without sharding.
+        Use multiple generators with disjoint ranges of ids instead. """
+        if shards != 1:
+            raise NotImplementedError(
+                "Sharded scans are not supported by the async API. Scan "
+                "disjoint ranges of ids in multiple generators instead")
+        key = None
+        if self.checkpoints is not None:
+            key = self.checkpoint_key(url, since=since, until=until)
+            since = self._resume(key) or since
+        while until is None or since < until:
+            page = await self._first(self.request(
+                url, since=since, per_page=self.scan_per_page)) or []
+            size = len(page)
+            if until is not None:
+                page = [obj for obj in page if obj['id'] <= until]
+            if not page:
+                break
+            for obj in page:
+                yield obj
+            since = page[-1]['id']
+            self._checkpoint(key, since)
+            if len(page) < size or size < self.scan_per_page:
+                break  # the last page
+        self._complete(key)
+
+    def all_users(self, since=0, until=None, shards=1):
+        """Get all GitHub users"""
+        return self.scan('users', since, until, shards)
+
+    def all_repos(self, since=0, until=None, shards=1):
+        """Get all GitHub repositories"""
+        return self.scan('repositories', since, until, shards)
+
+    async def _search_slice(self, kind, query, qualifier, low, high, fmt):
+        """ Async version of :py:meth:`GitHubAPI._search_slice` """
+        url = 'search/' + kind
+        q = '%s %s:%s..%s' % (query, qualifier, fmt(low), fmt(high))
+        res = await self._first(
+            self.request(url, q=q, per_page=self.search_per_page)) or {}
+        pages, subranges = self._search_split(q, res, low, high)
+        items = res.get('items') or []
+        for page in range(2, pages + 1):
+            res = await self._first(self.request(
+                url, q=q, per_page=self.search_per_page, page=page)) or {}
+            items.extend(res.get('items') or [])
+        return items, subranges
+
+    async def search(self, kind, query, qualifier='created', start=None,
+                     end=None, dedupe=True):
+        """ Async version of :py:meth:`GitHubAPI.search`.
+        Up to `search_threads` slices are retrieved concurrently. """
+        low, high, fmt = self._search_bounds(qualifier, start, end)
+        semaphore = asyncio.Semaphore(self.search_threads)
+
+        async def run(low, high):
+            async with semaphore:
+                return await self._search_slice(
+                    kind, query, qualifier, low, high, fmt)
+
+        pending = {asyncio.ensure_future(run(low, high))}
+        seen = set()
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    items, subranges = task.result()
+                    for subrange in subranges:
+                        pending.add(asyncio.ensure_future(run(*subrange)))
+                    for item in items:
+                        key = item.get('id', item.get('url'))
+                        if dedupe:
+                            if key in seen:
+                                continue
+                            seen.add(key)
+                        yield item
+        finally:
+            for task in pending:
+                task.cancel()
+
+    @aio_api('repos/%s')
+    def repo_info(self, repo_slug):
+        """Get repository info"""
+        return repo_slug
+
+    @aio_api_filter(lambda issue: 'pull_request' not in issue)
+    @aio_api('repos/%s/issues', paginate=True, watermark='updated_at',
+             state='all')
+    def repo_issues(self, repo_slug):
+        """Get repository issues (not including pull requests)"""
+        return repo_slug
+
+    @aio_api('repos/%s/issues/comments', paginate=True,
+             watermark='updated_at')
+    def repo_issue_comments(self, repo_slug):
+        """ Get all comments in all issues and pull requests,
+        both open and closed.
+        """
+        return repo_slug
+
+    @aio_api('repos/%s/issues/events', paginate=True)
+    def repo_issue_events(self, repo_slug):
+        """ Get all events in all issues and pull requests,
+        both open and closed.
+        """
+        return repo_slug
+
+    @aio_api('repos/%s/commits', paginate=True,
+             watermark='commit__committer__date')
+    def repo_commits(self, repo_slug):
+        """Get all repository commits.
+        Note that GitHub API might ignore some merge commits"""
+        return repo_slug
+
+    @aio_api('repos/%s/commits/%s')
+    def repo_commit(self, repo_slug, commit_hash):
+        """Get details for a single commit."""
+        return repo_slug, commit_hash
+
+    @aio_api('repos/%s/pulls', paginate=True, state='all')
+    def repo_pulls(self, repo_slug):
+        """Get all repository pull requests."""
+        return repo_slug
+
+    async def repo_topics(self, repo_slug):
+        """Get a tuple of repository topics."""
+        async for res in self.request('repos/%s/topics' % repo_slug):
+            return tuple(res.get('names'))
+
+    async def repo_labels(self, repo_slug):
+        """Get a tuple of repository labels."""
+        return tuple([label['name'] async for label in self.request(
+            'repos/%s/labels' % repo_slug, paginate=True)])
+
+    async def repo_contributors(self, repo_slug):
+        """Get a timeline of up to 100 top project contributors"""
+        url = 'repos/%s/stats/contributors' % repo_slug
+        async for stats in self.request(url):
+            for contributor_stats in stats:
+                record = {w['w']: w['c'] for w in contributor_stats['weeks']}
+                record['user'] = json_path(
+                    contributor_stats, ('author', 'login'))
+                yield record
+
+    @aio_api('repos/%s/pulls/%d/commits', paginate=True, state='all')
+    def pull_request_commits(self, repo, pr_id):
+        """Get commits in a pull request."""
+        return repo, pr_id
+
+    @aio_api('repos/%s/issues/%s/comments', paginate=True,
+             watermark='updated_at', state='all')
+    def issue_comments(self, repo, issue_id):
+        """ Get comments on an issue or a pull request."""
+        return repo, issue_id
+
+    @aio_api('repos/%s/pulls/%s/comments', paginate=True, state='all')
+    def review_comments(self, repo, pr_id):
+        """ Get pull request comments related to some code."""
+        return repo, pr_id
+
+    @aio_api('users/%s')
+    def user_info(self, username):
+        """Get user info - name, location, blog etc."""
+        return username
+
+    @aio_api('users/%s/repos', paginate=True)
+    def user_repos(self, username):
+        """Get list of user repositories"""
+        return username
+
+    @aio_api('users/%s/orgs', paginate=True)
+    def user_orgs(self, username):
+        """Get user organization membership."""
+        return username
+
+    @aio_api('orgs/%s/members', paginate=True)
+    def org_members(self, org):
+        """Get public organization members."""
+        return org
+
+    @aio_api('orgs/%s/repos', paginate=True)
+    def org_repos(self, org):
+        """Get organization repositories"""
+        return org
+
+    @aio_api('repos/%s/issues/%d/events', paginate=True)
+    def issue_events(self, repo, issue_no):
+        """Get issue events."""
+        return repo, issue_no
+
+    # ===================================
+    #        Non-API methods
+    # ===================================
+    async def project_exists(self, repo_slug):
+        """Check if the project exists. Does not use API keys."""
+        session = self._get_session()
+        for i in range(5):
+            try:
+                async with session.head(
+                        self.base_url + '/' + repo_slug) as resp:
+                    return resp.status < 400
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                await asyncio.sleep(2**i)
+
+
+class AsyncGitHubAPIv4(AsyncGitHubAPI):
+    """ An asyncio version of :py:class:`GitHubAPIv4`.
+
+    >>> async with AsyncGitHubAPIv4() as api:
+    ...     async for follower in api('''
+    ...             query ($user: String!, $cursor: String) {
+    ...               user(login: $user) {
+    ...                 followers(first:100, after:$cursor) {
+    ...                   nodes { login }
+    ...                   pageInfo{endCursor, hasNextPage}
+    ...             }}}''', user='user2589'):
+    ...         pass
+    """
+    sync_class = GitHubAPIv4
+
+    query_cost = GitHubAPIv4.query_cost
+    max_query_costs = GitHubAPIv4.max_query_costs
+    _costs = None
+    _query_cost = GitHubAPIv4._query_cost
+    _observe_cost = GitHubAPIv4._observe_cost
+
+    nested_pages = GitHubAPIv4.nested_pages
+    nested_batch_size = GitHubAPIv4.nested_batch_size
+    _nested_id = GitHubAPIv4._nested_id
+    _nested_type = GitHubAPIv4._nested_type
+    _nested_query = GitHubAPIv4._nested_query
+    _nested_pending = GitHubAPIv4._nested_pending
+    _nested_merge = staticmethod(GitHubAPIv4._nested_merge)
+    _nested_payload = GitHubAPIv4._nested_payload
+    _nested_result = GitHubAPIv4._nested_result
+
+    batch_error_types = GitHubAPIv4.batch_error_types
+    _batch_payload = GitHubAPIv4._batch_payload
+    _batch_result = GitHubAPIv4._batch_result
+
+    async def v4(self, query, object_path=None, **params):
+        """ Async version of :py:meth:`GitHubAPIv4.v4` """
+        info = graphql.analyze(query, object_path)
+        object_path = info.object_path
+
+        key = None
+        if self.checkpoints is not None:
+            key = self.checkpoint_key('graphql', 'post', query, **params)
+            cursor = self._resume(key)
+            if cursor:
+                params[info.cursor] = cursor
+        nested = None
+        if self.nested_pages and info.nested:
+            query, nested = self._nested_query(query, info), info
+        if self.query_cost and object_path:
+            query = _inject_rate_limit(query)
+
+        while True:
+            payload = json.dumps({'query': query, 'variables': params})
+
+            r = await self._request('graphql', 'post', data=payload,
+                                    cost=self._query_cost(query))
+            if r.status_code in self.status_empty:
+                self._complete(key)
+                return
+
+            res = self.extract_result(r)
+            self._observe_cost(query, json_path(res, ('data', 'rateLimit')))
+            objects, page_info = GitHubAPIv4._parse_v4_result(
+                res, object_path)
+            if page_info is None:
+                yield objects
+                return
+            if nested is not None:
+                await self._nested_pages(objects, nested, params)
+
+            for obj in objects:
+                yield obj
+            if not json_path(page_info, ('hasNextPage',)):
+                self._complete(key)
+                break
+            params[info.cursor] = json_path(page_info, ('endCursor',))
+            self._checkpoint(key, params[info.cursor])
+
+    async def _nested_pages(self, objects, info, params):
+        """ Async version of :py:meth:`GitHubAPIv4._nested_pages` """
+        pending = self._nested_pending(objects, info)
+        while pending:
+            batch = pending[:self.nested_batch_size]
+            pending = pending[self.nested_batch_size:] + self._nested_merge(
+                batch, await self._nested_batch(info.document, batch, params))
+
+    async def _nested_batch(self, document, batch, params):
+        """ Async version of :py:meth:`GitHubAPIv4._nested_batch` """
+        query, payload = self._nested_payload(document, batch, params)
+        res = self.extract_result(await self._request(
+            'graphql', 'post', data=payload, cost=self._query_cost(query)))
+        return self._nested_result(query, res, batch)
+
+    async def _batch_query(self, selection, var_types, fields, batch):
+        """ Async version of :py:meth:`GitHubAPIv4._batch_query` """
+        query, payload = self._batch_payload(
+            selection, var_types, fields, batch)
+        try:
+            res = self.extract_result(await self._request(
+                'graphql', 'post', data=payload,
+                cost=self._query_cost(query)))
+        except (asyncio.TimeoutError, requests.exceptions.Timeout):
+            # GitHub returns 502 if the query takes too long to run
+            if len(batch) < 2:
+                raise
+            res = {'errors': [{'type': self.batch_error_types[0]}]}
+
+        objects = self._batch_result(query, res, batch)
+        if objects is None:
+            middle = len(batch) // 2
+            return (await self._batch_query(selection, var_types, fields,
+                                            batch[:middle]) +
+                    await self._batch_query(selection, var_types, fields,
+                                            batch[middle:]))
+        return objects
+
+    async def _batch(self, selection, var_types, fields, items, batch_size):
+        """ Async version of :py:meth:`GitHubAPIv4._batch` """
+        items = iter(items)
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+            if not batch:
+                return
+            for obj in await self._batch_query(
+                    selection, var_types, fields, batch):
+                yield obj
+
+    def __call__(self, query, object_path=None, **params):
+        """ Returns an async generator for paginated queries,
+        and a coroutine otherwise """
+        gen = self.v4(query, object_path, **params)
+        if graphql.analyze(query, object_path).paginated:
+            return gen
+        return self._first(gen)
+
+    # Methods below only differ from GitHubAPIv4 in that self.v4() returns an
+    # async generator, so the query definitions are reused as is
+    repo_issues = GitHubAPIv4.repo_issues
+    user_followers = GitHubAPIv4.user_followers
+    repo_commits = GitHubAPIv4.repo_commits
+    repo_stargazers = GitHubAPIv4.repo_stargazers
+    repos_info = GitHubAPIv4.repos_info
+    users_info = GitHubAPIv4.users_info
+
+    async def user_info(self, user):
+        return await self._first(self.v4("""
+            query ($user: String!) {
+              user(login:$user) {
+                login, name, avatarUrl, websiteUrl
+                company, bio, location, name, twitterUsername, isHireable
+                # email  # email requires extra scopes from the API key
+                createdAt, updatedAt
+                followers{totalCount}
+                following {totalCount}
+              }}""", ('user',), user=user))
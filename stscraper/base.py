@@ -3,13 +3,23 @@ from __future__ import absolute_import
 
 import requests
 
+import collections
 from datetime import datetime
+import email.utils
+import hashlib
+import heapq
+import io
+import itertools
 import logging
+import math
+import os
 import random
 import re
 import six
+import sys
+import threading
 import time
-from typing import Iterable, Iterator, Optional, Tuple, Union
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 from functools import wraps
 
 
@@ -114,13 +124,303 @@ def json_map(mapping, obj):
             for key, path in mapping.items()}
 
 
+def iter_json(fileobj, prefixes):
+    """ Incrementally parse JSON, generating objects at specified prefixes
+
+    This is a thin wrapper around `ijson`, allowing to get objects at
+    several prefixes in a single pass, as soon as they are parsed.
+
+    Args:
+        fileobj: file-like object to read JSON from
+        prefixes (Iterable[str]): `ijson` prefixes of objects to extract,
+            e.g. 'item' for items of a top level array or
+            'data.user.followers.nodes.item' for GraphQL response nodes
+
+    Generates:
+        Tuple[str, object]: prefix and the parsed object at this prefix
+    """
+    try:
+        import ijson
+    except ImportError:
+        raise ImportError(
+            "Streaming parsing requires ijson. "
+            "Please install it first, e.g. `pip install ijson`")
+    prefixes = set(prefixes)
+    builder = target = None
+    depth = 0
+    for prefix, event, value in ijson.parse(fileobj, use_float=True):
+        if builder is None:
+            if prefix not in prefixes or event in ('map_key', 'end_map',
+                                                   'end_array'):
+                continue
+            if event not in ('start_map', 'start_array'):
+                yield prefix, value  # scalar value
+                continue
+            builder, target = ijson.ObjectBuilder(), prefix
+        builder.event(event, value)
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if not depth:
+                yield target, builder.value
+                builder = None
+
+
+class CompiledMapping(object):
+    """ A precompiled `json_map` mapping, for bulk transformation of records
+
+    Paths are parsed once, and a specialized function is generated to
+    extract all fields at once, sharing lookups of common path prefixes
+    (e.g. `author__name` and `author__email` only look up `author` once).
+    The result is the same as of `json_map`:
+
+    >>> obj = {'author': {'name': 'John'}, 'committer': None}
+    >>> mapping = compile_mapping({"author_login": "author__name", 'foo': 'bar'})
+    >>> mapping(obj)
+    {'author_login': 'John', 'foo': None}
+    >>> list(mapping.map_many([obj, {}]))
+    [{'author_login': 'John', 'foo': None}, {'author_login': None, 'foo': None}]
+
+    Records are expected to be dictionaries; anything unusual (e.g. a list
+    where a dictionary is expected) is handled by falling back to `json_map`.
+    """
+
+    def __init__(self, mapping):
+        self.mapping = dict(mapping)
+        self._extract = self._compile(self.mapping)
+
+    @staticmethod
+    def _compile(mapping):
+        lines = []
+        variables = {(): 'obj'}  # path prefix -> local variable name
+
+        def lookup(prefix):
+            if prefix not in variables:
+                parent = lookup(prefix[:-1])
+                name = variables[prefix] = '_%d' % len(variables)
+                lines.append('%s = None if %s is None else %s.get(%r)' % (
+                    name, parent, parent, prefix[-1]))
+            return variables[prefix]
+
+        values = []
+        for key, path in mapping.items():
+            chunks = tuple(path.split("__"))
+            joins = [i for i, chunk in enumerate(chunks)
+                     if chunk.startswith(",")]
+            if joins:
+                # as in json_path, join is only supported for the last chunk
+                i = joins[0]
+                value = '",".join(str(item.get(%r)) for item in %s)' % (
+                    chunks[i][1:], lookup(chunks[:i]))
+            else:
+                value = lookup(chunks)
+            values.append('%r: %s' % (key, value))
+
+        source = 'def extract(obj):\n    %s\n    return {%s}\n' % (
+            '\n    '.join(lines or ['pass']), ', '.join(values))
+        namespace = {}
+        six.exec_(compile(source, '<json_map>', 'exec'), namespace)
+        return namespace['extract']
+
+    def __call__(self, obj):
+        # type: (dict) -> dict
+        try:
+            return self._extract(obj)
+        except (AttributeError, TypeError):
+            return json_map(self.mapping, obj)
+
+    def map_many(self, records):
+        # type: (Iterable[dict]) -> Iterator[dict]
+        """ Apply the mapping to a sequence of records """
+        extract = self._extract
+        for obj in records:
+            try:
+                yield extract(obj)
+            except (AttributeError, TypeError):
+                yield json_map(self.mapping, obj)
+
+
+def compile_mapping(mapping):
+    # type: (dict) -> CompiledMapping
+    """ Precompile a `json_map` mapping for fast bulk use.
+    See `CompiledMapping` for details.
+    """
+    return CompiledMapping(mapping)
+
+
+def _build_response(status_code, headers, content, url, reason=None):
+    """ Construct a requests.Response from raw values.
+
+    This is used to feed responses obtained elsewhere (e.g. from an async
+    client or a cache) to the code expecting `requests` responses.
+    """
+    r = requests.Response()
+    r.status_code = status_code
+    r.headers = requests.structures.CaseInsensitiveDict(headers)
+    r._content = content
+    r.url = url
+    r.reason = reason
+    r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+    return r
+
+
+def _request_key(url, params):
+    # type: (str, dict) -> str
+    """ Get a string uniquely identifying the request """
+    return url + '?' + six.moves.urllib.parse.urlencode(sorted(
+        (k, v) for k, v in params.items() if v is not None))
+
+
+class Transport(object):
+    """ HTTP client shared by API tokens
+
+    By default, all tokens use the same transport (`Transport.default()`),
+    so connections to the API host are reused regardless of the token
+    making the request; tokens only add their Authorization header.
+    To change connection pool settings, set `VCSAPI.transport` before
+    instantiating the API:
+
+    >>> GitHubAPI.transport = Transport(pool_maxsize=200, http2=True)
+    >>> api = GitHubAPI()
+
+    Transports are safe to use across `fork()`: a new connection pool is
+    created in the child process.
+
+    Args:
+        pool_connections (int): number of hosts to keep connection pools for
+        pool_maxsize (int): number of connections per host to keep alive.
+            It should be no less than the number of concurrent threads,
+            otherwise extra connections are closed after every request.
+        http2 (bool): use HTTP/2 client provided by `httpx`. Note that
+            streamed responses are still downloaded in full.
+    """
+    _default = None  # type: Transport
+
+    def __init__(self, pool_connections=4, pool_maxsize=100, http2=False):
+        if http2:
+            try:
+                import httpx
+            except ImportError:
+                raise ImportError(
+                    "HTTP/2 transport requires httpx. Please install it "
+                    "first, e.g. `pip install httpx[http2]`")
+            self._httpx = httpx
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.http2 = http2
+        self._lock = threading.Lock()
+        self._client = None
+        self._pid = None
+        self.requests = 0
+
+    @classmethod
+    def default(cls):
+        # type: () -> Transport
+        """ Get the transport shared by all tokens by default """
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def _create_client(self):
+        if self.http2:
+            return self._httpx.Client(http2=True, limits=self._httpx.Limits(
+                max_connections=self.pool_maxsize,
+                max_keepalive_connections=self.pool_maxsize))
+        session = requests.Session()
+        # cookies should not leak between tokens
+        session.cookies.set_policy(
+            six.moves.http_cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @property
+    def client(self):
+        """ The underlying `requests.Session` (or `httpx.Client`) """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                # connections inherited from the parent process can't be
+                # used in a child; they would be shared by both
+                if self._pid != pid:
+                    self._client = self._create_client()
+                    self._pid = pid
+        return self._client
+
+    def request(self, method, url, params=None, data=None, headers=None,
+                timeout=None, stream=False):
+        # type: (...) -> requests.Response
+        """ Make an HTTP request, same arguments as `requests.request()` """
+        client = self.client
+        with self._lock:
+            self.requests += 1
+        if not self.http2:
+            return client.request(
+                method, url, params=params, data=data, headers=headers,
+                timeout=timeout, stream=stream)
+
+        httpx = self._httpx
+        try:
+            r = client.request(
+                method.upper(), url, content=data, headers=headers,
+                timeout=timeout, params={
+                    k: v for k, v in (params or {}).items() if v is not None})
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(e)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e)
+        response = _build_response(r.status_code, r.headers.items(),
+                                   r.content, str(r.url), r.reason_phrase)
+        # content is already decoded, iter_result() can read it from here
+        response.raw = io.BytesIO(r.content)
+        return response
+
+    def stats(self):
+        """ Get the number of requests made and connections opened.
+        Connection counts are only available for HTTP/1.1 transport.
+        """
+        stats = {'requests': self.requests,
+                 'connections': None, 'reused': None}
+        if self.http2 or self._client is None:
+            return stats
+        pools = [adapter.poolmanager.pools[key]
+                 for adapter in set(self._client.adapters.values())
+                 for key in adapter.poolmanager.pools.keys()]
+        connections = sum(pool.num_connections for pool in pools)
+        stats['connections'] = connections
+        stats['reused'] = sum(pool.num_requests for pool in pools) \
+            - connections
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+            self._client = self._pid = None
+
+
+def _mask_token(token):
+    # type: (APIToken) -> str
+    """ Get a token label safe to expose in metrics and logs """
+    value = str(token)
+    return '...' + value[-4:] if value else 'anonymous'
+
+
 # syntax sugar for GET API calls
-def api(url, paginate=False, **params):
+# watermark is a json path (e.g. 'updated_at') to the timestamp used to
+# request only new records, if the API supports `since` parameter
+def api(url, paginate=False, watermark=None, **params):
     def wrapper(func):
         @wraps(func)
         def caller(self, *args):
             formatted_url = url % func(self, *args)
-            if paginate:
+            if paginate and watermark and self.watermarks is not None:
+                return self.incremental(formatted_url, watermark, **params)
+            elif paginate:
                 return self.request(formatted_url, paginate=True, **params)
             else:
                 return next(self.request(formatted_url, **params))
@@ -154,17 +454,26 @@ class APIToken(object):
     api_classes = ('core',)  # type: Tuple
     # rate limits for API classes
     limits = None  # type: dict
-    session = None  # type: requests.Session
+    # api_class -> unix timestamp, see park()
+    parked_until = None  # type: dict
+    transport = None  # type: Transport
 
-    def __init__(self, token=None, timeout=None):
+    def __init__(self, token=None, timeout=None, transport=None):
         self.token = token
         self.timeout = timeout
         self.limits = {api_class: {
             'limit': None,
             'remaining': None,
-            'reset_time': None
+            'reset': None
         } for api_class in self.api_classes}
-        self.session = requests.Session()
+        self.parked_until = {}
+        self.transport = transport or Transport.default()
+
+    @property
+    def session(self):
+        # type: () -> requests.Session
+        """ HTTP session of the transport used by this token """
+        return self.transport.client
 
     @property
     def is_valid(self):
@@ -178,6 +487,22 @@ class APIToken(object):
     def _update_limits(self, response, url):
         raise NotImplementedError
 
+    def state(self):
+        # type: () -> dict
+        """ Get information about the token worth keeping between runs,
+        see `VCSAPI.token_cache`
+        """
+        return {'user': self.user, 'limits': dict(self.limits)}
+
+    def restore(self, state):
+        # type: (dict) -> None
+        """ Restore information obtained from `state()` """
+        now = time.time()
+        for api_class, limits in state.get('limits', {}).items():
+            # expired limits are meaningless
+            if limits.get('reset') and limits['reset'] > now:
+                self.limits[api_class] = limits
+
     def check_limits(self):
         """ Get information about remaining limits on the token.
 
@@ -190,7 +515,7 @@ class APIToken(object):
         { <api_class>: {
                 'remaining': remaining number of requests until reset,
                 'limit': overall limit,
-                'reset_time': unix_timestamp
+                'reset': unix_timestamp
             },
             ...
          }
@@ -215,16 +540,41 @@ class APIToken(object):
         t = self.when(url)
         return not t or t <= time.time()
 
-    def __call__(self, url, method='get', data=None, **params):
-        """ Make an API request """
-        # TODO: use coroutines, perhaps Tornado (as PY2/3 compatible)
+    def park(self, url, until):
+        # type: (str, float) -> None
+        """ Do not use this token for the API class of the url until the
+        specified time, e.g. after hitting a secondary rate limit.
 
+        The park is kept separately from the rate limits, so responses to
+        requests that were already in flight don't un-park the token.
+        Subclasses should take it into account in `when()`.
+        """
+        api_class = self.api_class(url)
+        self.parked_until[api_class] = max(
+            self.parked_until.get(api_class, 0), int(math.ceil(until)))
+
+    def __call__(self, url, method='get', data=None, headers=None,
+                 stream=False, **params):
+        """ Make an API request
+
+        Args:
+            url (str): request URL, relative to `api_url`
+            method (str): HTTP method type
+            data (str): API request payload (for POST requests)
+            headers (Optional[dict]): extra request headers
+            stream (bool): do not download the response content immediately
+            **params: request parameters
+        """
         if not self.ready(url):
             raise TokenNotReady
 
-        r = self.session.request(
+        if headers:
+            headers = dict(self._headers or {}, **headers)
+        else:
+            headers = self._headers
+        r = self.transport.request(
             method, self.api_url + url, params=params, data=data,
-            headers=self._headers,  timeout=self.timeout)
+            headers=headers, timeout=self.timeout, stream=stream)
 
         self._update_limits(r, url)
 
@@ -255,17 +605,335 @@ class DummyAPIToken(APIToken):
         pass
 
 
+class TokenScheduler(object):
+    """ Choose which token to use for the next request.
+
+    For every API class (e.g. GitHub core vs search), tokens are kept in a
+    heap ordered by the estimated number of remaining requests and, among
+    tokens with the same quota, by the time of last use. So, choosing a
+    token takes O(log n), the pool is drained evenly, and concurrent
+    threads are spread over different tokens rather than all hitting
+    the same one (which triggers secondary rate limits on GitHub).
+
+    Exhausted tokens are parked in a separate heap ordered by their reset
+    time, and are moved back once the reset time has passed.
+
+    Rate limits are only known after a response is received, so every
+    time a token is given out its estimated quota is reduced by the cost
+    of the request (one, except for GraphQL queries). This estimate is
+    reconciled with the actual token limits lazily, whenever the token
+    reaches the top of the heap. Tokens with less quota than the request
+    cost are parked until reset, rather than given out to fail.
+
+    This class is thread-safe. Alternative schedulers can be plugged in
+    via `VCSAPI.scheduler_class`; they need to implement `add()` and
+    `acquire()` methods with the same signature.
+    """
+
+    def __init__(self, tokens=()):
+        self._lock = threading.Lock()
+        self._tokens = []  # type: list
+        # api_class -> heap of [-remaining, last_used, seq, reset, token]
+        self._ready = {}  # type: dict
+        # api_class -> heap of (resume_at, seq, token)
+        self._waiting = {}  # type: dict
+        self._seq = itertools.count()
+        self._clock = itertools.count()
+        self.add(tokens)
+
+    @staticmethod
+    def _limits(token, api_class, now=None):
+        """ Get (remaining, reset) of the token, unknown quota is infinite """
+        limits = token.limits.get(api_class) or {}
+        remaining = limits.get('remaining')
+        reset = limits.get('reset')
+        if remaining is None or (
+                reset is not None and reset <= (now or time.time())):
+            remaining = sys.maxsize
+        return remaining, reset
+
+    def _entry(self, token, api_class, last_used=-1):
+        remaining, reset = self._limits(token, api_class)
+        return [-remaining, last_used, next(self._seq), reset, token]
+
+    def add(self, tokens):
+        """ Add tokens to the pool """
+        with self._lock:
+            for token in tokens:
+                self._tokens.append(token)
+                for api_class, heap in self._ready.items():
+                    heapq.heappush(heap, self._entry(token, api_class))
+
+    def _heaps(self, api_class):
+        if api_class not in self._ready:
+            self._ready[api_class] = [
+                self._entry(token, api_class) for token in self._tokens]
+            heapq.heapify(self._ready[api_class])
+            self._waiting[api_class] = []
+        return self._ready[api_class], self._waiting[api_class]
+
+    def acquire(self, url="", cost=1):
+        """ Get the best token to make a request to the specified URL
+
+        Args:
+            url (str): request URL, to determine the API class
+            cost (int): expected rate limit cost of the request
+
+        Returns:
+            Tuple[Optional[APIToken], Optional[int]]: a token and None,
+                or, if all tokens are exhausted, None and unix timestamp
+                when the first of them will become available again
+        """
+        with self._lock:
+            if not self._tokens:
+                raise VCSError("No valid tokens available")
+            api_class = self._tokens[0].api_class(url)
+            ready, waiting = self._heaps(api_class)
+            now = time.time()
+
+            while waiting and waiting[0][0] <= now:
+                resume_at, seq, token = heapq.heappop(waiting)
+                if token.ready(url):
+                    heapq.heappush(ready, self._entry(token, api_class))
+                else:  # reset time was updated meanwhile
+                    heapq.heappush(waiting, (token.when(url), seq, token))
+
+            while ready:
+                entry = ready[0]
+                token = entry[-1]
+                if not token.ready(url):
+                    heapq.heappop(ready)
+                    heapq.heappush(
+                        waiting, (token.when(url), entry[2], token))
+                    continue
+                remaining, reset = self._limits(token, api_class, now)
+                if reset != entry[3] or remaining < -entry[0]:
+                    # limits were updated since the token was scheduled;
+                    # new rate limit window or quota spent by other clients
+                    heapq.heapreplace(
+                        ready, self._entry(token, api_class, entry[1]))
+                    continue
+                if -entry[0] < cost:
+                    # even the token with the most quota left can't afford
+                    # this request, unless some tokens were reset meanwhile
+                    ready[:] = [
+                        self._entry(e[-1], api_class, e[1])
+                        if e[3] is not None and e[3] <= now else e
+                        for e in ready]
+                    heapq.heapify(ready)
+                    if -ready[0][0] >= cost:
+                        continue
+                    resets = [e[3] for e in ready if e[3] is not None] + \
+                        [resume_at for resume_at, _, _ in waiting[:1]]
+                    # limits without a reset time (e.g. shared by other
+                    # processes) might be updated any time, retry soon
+                    return None, min(resets) if resets else now + 1
+                entry[0] += cost
+                entry[1] = next(self._clock)
+                heapq.heapreplace(ready, entry)
+                return token, None
+
+            return None, waiting[0][0]
+
+
+class BackoffPolicy(object):
+    """ Decide how long to wait before retrying a failed request.
+
+    Server errors are retried with exponential backoff. Jitter is added
+    to delays, so that threads that failed at the same time don't retry
+    all at once.
+
+    Rate limit errors are specific to the token used, so instead of
+    sleeping, the offending token is parked (see `APIToken.park()`) and
+    the request is retried right away with another one:
+
+    - if the token quota is exhausted (primary rate limit), the token is
+      parked until `X-RateLimit-Reset`;
+    - if the server asked to slow down (secondary or abuse rate limits),
+      the token is parked for `Retry-After` seconds, or for
+      `secondary_delay` seconds if the header is missing.
+
+    Alternative policies can be plugged in via `VCSAPI.backoff`.
+
+    Args:
+        base (float): delay before the first retry, seconds
+        cap (float): max delay between retries, seconds
+        secondary_delay (float): how long to park a token hitting
+            a secondary rate limit without `Retry-After` header, seconds
+    """
+    secondary_markers = ('secondary rate limit', 'abuse')
+
+    def __init__(self, base=1, cap=60, secondary_delay=60):
+        self.base = base
+        self.cap = cap
+        self.secondary_delay = secondary_delay
+
+    def delay(self, attempt):
+        # type: (int) -> float
+        """ Get jittered exponential delay before the given attempt """
+        delay = min(self.cap, self.base * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    @staticmethod
+    def retry_after(response):
+        # type: (requests.Response) -> Optional[float]
+        """ Get the number of seconds from the Retry-After header, if any """
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        if value.isdigit():
+            return int(value)
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, email.utils.mktime_tz(date) - time.time())
+
+    def is_secondary(self, response):
+        # type: (requests.Response) -> bool
+        """ Check if the response is a secondary (abuse) rate limit error """
+        if response.status_code == 429 or 'Retry-After' in response.headers:
+            return True
+        try:
+            message = response.text.lower()
+        except Exception:  # e.g. decoding errors
+            return False
+        return any(marker in message for marker in self.secondary_markers)
+
+    def rate_limited(self, response, url, attempt, token=None):
+        """ Process a rate limit error response
+
+        Args:
+            response (requests.Response): the error response
+            url (str): request URL
+            attempt (int): the number of this retry, starting from 1
+            token (Optional[APIToken]): the token used to make the request
+
+        Returns:
+            float: number of seconds to wait before the next attempt,
+                0 if the token was parked and another one can be used
+        """
+        until = None
+        if response.headers.get('X-RateLimit-Remaining') == '0' and \
+                response.headers.get('X-RateLimit-Reset', '').isdigit():
+            until = int(response.headers['X-RateLimit-Reset'])
+        elif self.is_secondary(response):
+            retry_after = self.retry_after(response)
+            if retry_after is None:
+                # GitHub recommends to wait at least a minute
+                retry_after = self.secondary_delay + random.uniform(
+                    0, self.secondary_delay / 4)
+            until = time.time() + max(1, retry_after)
+
+        if until is None:  # neither, e.g. permission errors
+            return self.delay(attempt)
+        if token is None:
+            return max(0, until - time.time())
+        token.park(url, until)
+        return 0
+
+
+class SingleFlight(object):
+    """ Share the result of a call among concurrent callers with the same key
+
+    While a call is in progress, other threads making a call with the same
+    key wait for it to complete and get the same result (or exception)
+    instead of repeating the call. Once the call is completed, the next
+    one with this key is made again.
+
+    Attributes:
+        coalesced (int): number of calls served by a concurrent call
+    """
+
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> _Call
+        self.coalesced = 0
+
+    def do(self, key, func):
+        """ Call `func()` unless a call with the same key is in progress
+
+        Returns:
+            Tuple[object, bool]: result of the call and whether it was
+                shared with another caller
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                six.reraise(*call.error)
+            return call.result, True
+
+        try:
+            call.result = func()
+        except BaseException:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+
 class VCSAPI(object):
     _instance = None  # instance of API() for Singleton pattern implementation
 
     tokens = ()  # type: Tuple[APIToken]
     token_class = DummyAPIToken  # type: type
+    # HTTP client used by tokens, Transport.default() if not set
+    transport = None  # type: Transport
+    scheduler_class = TokenScheduler  # type: type
+    scheduler = None  # type: TokenScheduler
 
     status_too_many_requests = ()
+    status_unauthorized = (401,)
     status_not_found = (404, 451)
     status_empty = (409,)
     status_internal_error = (500, 502, 503)
     retries_on_timeout = 5
+    # how to wait before retrying failed requests
+    backoff = BackoffPolicy()
+    # number of pages to fetch concurrently in paginated requests,
+    # if the total number of pages is known from the first response
+    prefetch = 0
+    # store of responses for conditional requests, see cache.ETagCache
+    etag_cache = None
+    # cache of responses with expiration, see cache.ResponseCache
+    response_cache = None
+    # store of pagination checkpoints, see store.KeyValueStore
+    checkpoints = None
+    # store of timestamps of last seen records, see store.KeyValueStore
+    watermarks = None
+    # parse paginated responses incrementally, see iter_result()
+    stream = False
+    # registry of request metrics, see metrics.MetricsRegistry
+    metrics = None
+    # validate tokens on instantiation. If False, tokens are assumed
+    # to be valid until the API rejects them
+    validate_tokens = True
+    # number of tokens to validate concurrently
+    validation_threads = 16
+    # store of token validation results, see store.KeyValueStore
+    token_cache = None
+    # how long validation results are kept in `token_cache`, seconds
+    token_cache_ttl = 24 * 3600
+    # make one request for identical GET requests made concurrently
+    # by different threads, see SingleFlight
+    coalesce_requests = True
+    single_flight = None  # type: SingleFlight
 
     def __new__(cls, *args, **kwargs):  # Singleton
         if not isinstance(cls._instance, cls):
@@ -280,15 +948,91 @@ class VCSAPI(object):
         if tokens:
             if isinstance(tokens, six.string_types):
                 tokens = tokens.split(",")
-            new_tokens_instances = [self.token_class(t, timeout=timeout)
-                                    for t in set(tokens) - old_tokens]
-            self.tokens += tuple(t for t in new_tokens_instances if t.is_valid)
+            new_tokens = self._validate([
+                self.token_class(t, timeout=timeout, transport=self.transport)
+                for t in set(tokens) - old_tokens])
+            self.tokens += new_tokens
+        else:
+            new_tokens = ()
+        if self.scheduler is None:
+            self.scheduler = self.scheduler_class(self.tokens)
+        else:
+            self.scheduler.add(new_tokens)
+        if self.single_flight is None:
+            self.single_flight = SingleFlight()
         self.logger = logging.getLogger('scraper.' + self.__class__.__name__)
 
+    @staticmethod
+    def _token_key(token):
+        # type: (APIToken) -> str
+        """ Get the key of the token in `token_cache` """
+        return 'token %s %s' % (token.api_url, hashlib.sha256(
+            str(token).encode('utf8')).hexdigest())
+
+    def _validate(self, tokens):
+        # type: (List[APIToken]) -> Tuple[APIToken]
+        """ Filter out invalid tokens
+
+        Tokens are validated concurrently, unless the validation result
+        is available from `token_cache`.
+        """
+        if not self.validate_tokens:
+            return tuple(tokens)
+        cache = self.token_cache
+        now = time.time()
+        valid = [None] * len(tokens)
+        unchecked = []
+        for i, token in enumerate(tokens):
+            state = cache and cache.get(self._token_key(token))
+            if state and now - state['checked_at'] < self.token_cache_ttl:
+                token.restore(state)
+                valid[i] = state['valid']
+            else:
+                unchecked.append(i)
+
+        if len(unchecked) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(len(unchecked), self.validation_threads))
+            try:
+                results = pool.map(
+                    lambda i: bool(tokens[i].is_valid), unchecked)
+            finally:
+                pool.terminate()
+        else:
+            results = [bool(tokens[i].is_valid) for i in unchecked]
+
+        for i, is_valid in zip(unchecked, results):
+            valid[i] = is_valid
+            if cache is not None:
+                state = tokens[i].state() if is_valid else {'user': None}
+                cache.set(self._token_key(tokens[i]), dict(
+                    state, valid=is_valid, checked_at=now))
+        return tuple(token for token, is_valid in zip(tokens, valid)
+                     if is_valid)
+
+    def _revoke(self, token):
+        """ Stop using a token rejected by the API, e.g. an expired one """
+        self.logger.warning("Token %s was rejected by the API",
+                            _mask_token(token))
+        for api_class in list(token.limits):
+            token.limits[api_class] = dict(
+                token.limits[api_class] or {}, remaining=0,
+                reset=sys.maxsize)
+        if self.token_cache is not None:
+            self.token_cache.set(self._token_key(token), {
+                'user': None, 'valid': False, 'checked_at': time.time()})
+        if all(t.limits.get(api_class, {}).get('reset') == sys.maxsize
+               for t in self.tokens for api_class in t.limits):
+            raise VCSError("No valid tokens available")
+
     def _has_next_page(self, response):
         """ Check if there is a next page to a paginated response """
         raise NotImplementedError
 
+    def _last_page(self, response):
+        """ Get the last page number of a paginated response, if known """
+        return None
+
     @staticmethod
     def init_pagination():
         """ Update request params to allow pagination
@@ -303,35 +1047,99 @@ class VCSAPI(object):
         """
         return response.json()
 
-    def iterate_tokens(self, url=""):
+    def iter_result(self, response):
+        """ Streaming version of `extract_result()` for paginated responses.
+        Generates items of the response one by one as they are received,
+        without loading the whole response in memory.
+        """
+        # take care of gzip/deflate encoding
+        response.raw.decode_content = True
+        try:
+            for _, item in iter_json(response.raw, ('item',)):
+                yield item
+        finally:
+            response.close()
+
+    def iterate_tokens(self, url="", cost=1):
         """Infinite generator of tokens, taking care of their availability
 
         Args:
             url (str): request URL. In some API classes there are multiple rate
                 limits handled separately, e.g. GitHub general vs search API.
+            cost (int): expected rate limit cost of the request
         Generates:
             (APIToken): a token object
         """
         while True:
-            # problem with iterating them in the same order
-            # (eg, sorted by expiration): in multithreaded case,
-            # all threads are using the same token and GitHub imposes
-            # temporary limits. So, random order
-            for token in random.sample(self.tokens, len(self.tokens)):
-                if not token.ready(url):
-                    continue
+            token, next_res = self.scheduler.acquire(url, cost)
+            if token is not None:
                 yield token
+                continue
 
-            next_res = min(token.when(url) for token in self.tokens)
-            sleep = next_res and int(next_res - time.time()) + 1
+            sleep = int(next_res - time.time()) + 1
             if sleep > 0:
                 self.logger.info(
                     "%s: out of keys, resuming in %d minutes, %d seconds",
                     datetime.now().strftime("%H:%M"), *divmod(sleep, 60))
+                if self.metrics is not None:
+                    self.metrics.inc('blocked_seconds_total', sleep)
                 time.sleep(sleep)
                 self.logger.info(".. resumed")
 
-    def request(self, url, method='get', data=None, paginate=False, **params):
+    @staticmethod
+    def metric_endpoint(url):
+        # type: (str) -> str
+        """ Get a URL template to label request metrics, so that requests
+        to the same endpoint are counted together, e.g. 'issues/:id'
+        """
+        return re.sub(r'(^|/)\d+(?=/|$)', r'\1:id', url)
+
+    def _record_response(self, token, url, response, elapsed, stream=False):
+        """ Update metrics with a received response """
+        metrics = self.metrics
+        if metrics is None:
+            return
+        api_class = token.api_class(url)
+        metrics.inc('requests_total', api_class=api_class,
+                    endpoint=self.metric_endpoint(url),
+                    status=str(response.status_code))
+        metrics.observe('request_seconds', elapsed, api_class=api_class)
+        if 'Content-Length' in response.headers:
+            size = int(response.headers['Content-Length'])
+        else:  # streamed responses are not downloaded yet
+            size = 0 if stream else len(response.content)
+        metrics.inc('response_bytes_total', size, api_class=api_class)
+        remaining = (token.limits.get(api_class) or {}).get('remaining')
+        if remaining is not None:
+            metrics.set('token_remaining', remaining,
+                        token=_mask_token(token), api_class=api_class)
+
+    def checkpoint_key(self, url, method='get', data=None, **params):
+        # type: (str, str, Optional[str], **dict) -> str
+        """ Get the key used to store pagination checkpoint of a request """
+        params = {k: v for k, v in params.items()
+                  if k not in ('page', 'cursor')}
+        key = '%s %s' % (method.upper(), _request_key(url, params))
+        if data:
+            key += ' ' + hashlib.sha1(data.encode('utf8')).hexdigest()
+        return key
+
+    def _resume(self, key):
+        """ Get the last completed page (or cursor) of a request, if any """
+        return self.checkpoints.get(key) if key else None
+
+    def _checkpoint(self, key, page):
+        """ Record the last completed page (or cursor) of a request """
+        if key:
+            self.checkpoints.set(key, page)
+
+    def _complete(self, key):
+        """ Remove checkpoint of a fully completed request """
+        if key:
+            self.checkpoints.delete(key)
+
+    def request(self, url, method='get', data=None, paginate=False,
+                prefetch=None, stream=None, **params):
         """ Make an API request, taking care of pagination
 
         Args:
@@ -339,23 +1147,63 @@ class VCSAPI(object):
             method (str): HTTP method type
             data (str): API request payload (for POST requests)
             paginate (bool): flag to take care of pagination
+            prefetch (int): if the number of pages is known from the first
+                response, fetch up to this many pages concurrently.
+                Items are still generated in the page order.
+                By default, `self.prefetch` is used.
+            stream (bool): parse paginated responses incrementally, so items
+                are generated as they arrive and large pages are never held
+                in memory. Streamed responses bypass caches and prefetched
+                pages are not streamed. By default, `self.stream` is used.
 
         Generates:
             object: parsed object, API-specific
+
+        If `self.checkpoints` store is set, the number of the last completed
+        page of paginated requests is saved there, and interrupted requests
+        are resumed from the next page.
         """
+        key = None
         if paginate:
             params.update(self.init_pagination())
+            if self.checkpoints is not None:
+                key = self.checkpoint_key(url, method, data, **params)
+                last_completed = self._resume(key)
+                if last_completed:
+                    params['page'] = last_completed + 1
+        if prefetch is None:
+            prefetch = self.prefetch
+        if stream is None:
+            stream = self.stream
+        stream = stream and paginate
 
         while True:
-            r = self._request(url, method, data, **params)
+            r = self._request(url, method, data, stream=stream, **params)
             if r.status_code in self.status_empty:
+                self._complete(key)
                 return
 
-            res = self.extract_result(r)
+            if stream:
+                res = self.iter_result(r)
+            else:
+                res = self.extract_result(r)
             if paginate:
+                empty = True
                 for item in res:
+                    empty = False
                     yield item
-                if not res or not self._has_next_page(r):
+                if empty or not self._has_next_page(r):
+                    self._complete(key)
+                    return
+                self._checkpoint(key, params['page'])
+                last_page = prefetch and self._last_page(r)
+                if last_page:
+                    for page, res in self._prefetch_pages(
+                            url, method, data, params, last_page, prefetch):
+                        for item in res:
+                            yield item
+                        self._checkpoint(key, page)
+                    self._complete(key)
                     return
                 else:
                     params["page"] += 1
@@ -364,54 +1212,222 @@ class VCSAPI(object):
                 yield res
                 return
 
-    def _request(self, url, method='get', data=None, **params):
-        """ Make
+    def incremental(self, url, watermark, **params):
+        """ Make a paginated request, only getting records added or updated
+        since the last run.
+
+        The max value of `watermark` field in the retrieved records is
+        saved in `self.watermarks` store, and passed as `since` parameter
+        to the same request next time. The store is only updated once all
+        records are retrieved.
+
+        Note that `since` is inclusive in GitHub API, so records with the
+        timestamp equal to the watermark will be returned again.
+
+        Args:
+            url (str): request URL
+            watermark (str): path to the record timestamp, e.g.
+                'updated_at' or 'commit__committer__date'
+            **params: request parameters
+
+        Generates:
+            object: parsed object, API-specific
+        """
+        key = _request_key(url, params)
+        path = watermark.split('__')
+        since = self.watermarks.get(key)
+        if since:
+            params['since'] = since
+
+        high = since
+        for item in self.request(url, paginate=True, **params):
+            timestamp = json_path(item, path)
+            if timestamp and (high is None or timestamp > high):
+                high = timestamp
+            yield item
+
+        if high != since:
+            self.watermarks.set(key, high)
+
+    def _prefetch_pages(self, url, method, data, params, last_page, window):
+        """ Fetch pages after params['page'] through `last_page` concurrently
+
+        At most `window` pages are fetched (or held in memory) at a time.
+
+        Generates:
+            Tuple[int, list]: page number and parsed page content,
+                in the page order
+        """
+        # multiprocessing is slow to import and rarely needed
+        from multiprocessing.pool import ThreadPool
+
+        def fetch(page):
+            r = self._request(url, method, data, **dict(params, page=page))
+            if r.status_code in self.status_empty:
+                return []
+            return self.extract_result(r)
+
+        pages = iter(six.moves.range(params['page'] + 1, last_page + 1))
+        pool = ThreadPool(window)
+        try:
+            pending = collections.deque(
+                (page, pool.apply_async(fetch, (page,)))
+                for page in itertools.islice(pages, window))
+            while pending:
+                page, result = pending.popleft()
+                res = result.get()
+                for next_page in itertools.islice(pages, 1):
+                    pending.append(
+                        (next_page, pool.apply_async(fetch, (next_page,))))
+                yield page, res
+        finally:
+            pool.terminate()
+
+    def _request(self, url, method='get', data=None, stream=False, cost=1,
+                 **params):
+        """ Make an HTTP request, or get it from `response_cache` or
+        an identical request made concurrently by another thread
         Args:
             url (str): request URL
             method (str): HTTP method type
             data (str): API request payload (for POST requests)
+            stream (bool): do not download the response content immediately.
+                Streamed requests are not cached or coalesced.
+            cost (int): expected rate limit cost of the request
+
+        Return:
+            requests.Response: raw HTTP response
+        """
+        if stream or not self.coalesce_requests or method.lower() != 'get':
+            return self._cached_fetch(url, method, data, stream, cost,
+                                      **params)
+
+        r, shared = self.single_flight.do(
+            _request_key(url, params),
+            lambda: self._cached_fetch(url, method, data, stream, cost,
+                                       **params))
+        if shared and self.metrics is not None:
+            self.metrics.inc('coalesced_total')
+        return r
+
+    def _cached_fetch(self, url, method, data, stream, cost, **params):
+        """ Get a response from `response_cache`, or make the request """
+        cache = None if stream else self.response_cache
+        if cache is not None:
+            r = cache.get(url, params, method, data)
+            if r is not None:
+                if self.metrics is not None:
+                    self.metrics.inc('cache_hits_total', cache='response')
+                return r
+
+        r = self._fetch(url, method, data, stream=stream, cost=cost,
+                        **params)
+        if cache is not None:
+            cache.set(url, params, method, data, r)
+        return r
+
+    def _fetch(self, url, method='get', data=None, stream=False, cost=1,
+               **params):
+        """ Make an HTTP request, retrying on errors and rate limits
+        Args:
+            url (str): request URL
+            method (str): HTTP method type
+            data (str): API request payload (for POST requests)
+            stream (bool): do not download the response content immediately
+            cost (int): expected rate limit cost of the request
 
         Return:
             requests.Response: raw HTTP response
         """
         timeout_counter = 0
-        for token in self.iterate_tokens(url):
+        cached = None
+        conditional = self.etag_cache is not None and not stream \
+            and method.lower() == 'get'
+        if conditional:
+            cached = self.etag_cache.lookup(url, params)
+
+        for token in self.iterate_tokens(url, cost):
+            start = time.time()
             try:
-                r = token(url, method=method, data=data, **params)
+                r = token(url, method=method, data=data, stream=stream,
+                          headers=self.etag_cache.validators(cached)
+                          if conditional else None, **params)
             except TokenNotReady:
+                if self.metrics is not None:
+                    self.metrics.inc('retries_total', reason='token_not_ready')
                 continue
             except requests.exceptions.RequestException:
                 # starting early November, GitHub fails to establish
                 # a connection once in a while (bad status line).
                 # To account for more general issues like this,
                 # TimeoutException was replaced with RequestException
+                if self.metrics is not None:
+                    self.metrics.inc('retries_total', reason='connection')
                 timeout_counter += 1
                 if timeout_counter > self.retries_on_timeout:
                     raise
                 continue  # i.e. try again
 
-            if r.status_code in self.status_not_found:  # API v3 only
-                raise RepoDoesNotExist(
-                    "%s API returned status %s at %s" % (
-                        self.__class__.__name__, r.status_code, url))
-            elif r.status_code in self.status_internal_error:
-                timeout_counter += 1
-                if timeout_counter > self.retries_on_timeout:
-                    raise requests.exceptions.Timeout("VCS is down")
-                time.sleep(2**timeout_counter)
+            self._record_response(token, url, r, time.time() - start, stream)
+            delay = self._retry_delay(r, url, timeout_counter + 1, token)
+            if delay is not None:
+                # zero delay means the token was parked,
+                # so just try another one
+                if delay > 0:
+                    timeout_counter += 1
+                    time.sleep(delay)
                 continue  # i.e. try again
-            elif r.status_code in self.status_too_many_requests:
-                timeout_counter += 1
-                if timeout_counter > self.retries_on_timeout:
-                    raise requests.exceptions.Timeout(
-                        "Too many requests from the same IP. "
-                        "Are you abusing the API?")
-                time.sleep(1 << (timeout_counter+1))
-                continue
 
+            if conditional:
+                if r.status_code == 304 and cached is not None \
+                        and self.metrics is not None:
+                    self.metrics.inc('cache_hits_total', cache='etag')
+                r = self.etag_cache.update(url, params, r, cached)
             r.raise_for_status()
             return r
 
+    def _retry_delay(self, response, url, attempt, token=None):
+        """ Check response status and decide if the request has to be retried
+
+        Args:
+            response (requests.Response): raw HTTP response
+            url (str): request URL
+            attempt (int): the number of this retry, starting from 1
+            token (Optional[APIToken]): the token used to make the request
+
+        Returns:
+            Optional[float]: number of seconds to wait before the next
+                attempt, or None if the response is final
+        """
+        if response.status_code in self.status_not_found:  # API v3 only
+            raise RepoDoesNotExist(
+                "%s API returned status %s at %s" % (
+                    self.__class__.__name__, response.status_code, url))
+        elif response.status_code in self.status_internal_error:
+            if attempt > self.retries_on_timeout:
+                raise requests.exceptions.Timeout("VCS is down")
+            delay = self.backoff.delay(attempt)
+            reason = 'server_error'
+        elif response.status_code in self.status_too_many_requests:
+            if attempt > self.retries_on_timeout:
+                raise requests.exceptions.Timeout(
+                    "Too many requests from the same IP. "
+                    "Are you abusing the API?")
+            delay = self.backoff.rate_limited(response, url, attempt, token)
+            reason = 'rate_limit' if delay else 'parked'
+        elif response.status_code in self.status_unauthorized \
+                and token is not None and token.token is not None:
+            self._revoke(token)
+            if token.ready(url):  # tokens without limits can't be parked
+                return None
+            delay = 0  # i.e. retry with another token right away
+            reason = 'unauthorized'
+        else:
+            return None
+        if self.metrics is not None:
+            self.metrics.inc('retries_total', reason=reason)
+        return delay
+
     def all_users(self):
         # type: () -> Iterable[dict]
         """ """
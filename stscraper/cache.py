@@ -0,0 +1,290 @@
+""" Caching of API responses.
+
+>>> from stscraper import GitHubAPI
+>>> from stscraper.cache import ETagCache, ResponseCache
+>>> api = GitHubAPI()
+>>> api.etag_cache = ETagCache('github_etags.sqlite')
+>>> api.response_cache = ResponseCache(ttl=600)
+"""
+
+from __future__ import absolute_import
+
+import collections
+import fnmatch
+import json
+import sqlite3
+import threading
+import time
+
+from .base import _build_response, _request_key as _cache_key
+
+
+class ETagCache(object):
+    """ Persistent store of responses for conditional requests
+
+    GitHub does not charge rate limit for `304 Not Modified` responses.
+    With this cache attached (`VCSAPI.etag_cache`), GET requests are sent
+    with `If-None-Match` / `If-Modified-Since` headers taken from the
+    previously stored response to the same URL; if the resource hasn't
+    changed, the stored response is served instead.
+
+    Responses are stored in a SQLite database, so the cache survives
+    restarts. Use ':memory:' for a non-persistent cache.
+
+    Note that GitHub ETags might depend on the token used, so with a pool
+    of tokens some revalidations will still return full responses.
+
+    Attributes:
+        hits (int): number of requests served from cache (304 responses)
+        misses (int): number of requests answered with full response
+    """
+
+    def __init__(self, path=':memory:'):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                '  key TEXT PRIMARY KEY, url TEXT, headers TEXT, content BLOB)')
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, url, params):
+        # type: (str, dict) -> Optional[requests.Response]
+        """ Get the stored response for this request, if any """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT url, headers, content FROM responses WHERE key=?',
+                (_cache_key(url, params),)).fetchone()
+        if row is None:
+            return None
+        return _build_response(
+            200, json.loads(row[1]), bytes(row[2]), row[0], 'OK')
+
+    @staticmethod
+    def validators(response):
+        # type: (Optional[requests.Response]) -> Optional[dict]
+        """ Get conditional request headers to revalidate this response """
+        if response is None:
+            return None
+        headers = {}
+        if 'ETag' in response.headers:
+            headers['If-None-Match'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            headers['If-Modified-Since'] = response.headers['Last-Modified']
+        return headers
+
+    def update(self, url, params, response, cached=None):
+        """ Process response to a (possibly conditional) request
+
+        Args:
+            url (str): request URL
+            params (dict): request parameters
+            response (requests.Response): response to the request
+            cached (Optional[requests.Response]): result of the earlier
+                call to `lookup()`
+        Returns:
+            requests.Response: the cached response if the resource
+                was not modified, or the response itself otherwise
+        """
+        if response.status_code == 304 and cached is not None:
+            with self._lock:
+                self.hits += 1
+            return cached
+
+        with self._lock:
+            self.misses += 1
+            if response.status_code == 200 and self.validators(response):
+                with self._db:
+                    self._db.execute(
+                        'REPLACE INTO responses VALUES (?, ?, ?, ?)', (
+                            _cache_key(url, params), response.url,
+                            json.dumps(dict(response.headers)),
+                            sqlite3.Binary(response.content)))
+        return response
+
+    def clear(self):
+        """ Remove all stored responses """
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM responses')
+
+    def stats(self):
+        """ Get hit/miss counters """
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class ResponseCache(object):
+    """ Cache of successful API responses with expiration
+
+    Unlike `ETagCache`, which still makes a (free) request to revalidate
+    every response, this cache serves responses without making requests
+    at all until they expire. Attach it to an API object as
+    `VCSAPI.response_cache`:
+
+    >>> api.response_cache = ResponseCache(
+    ...     ttl=3600, max_bytes=256 << 20, path='responses.sqlite',
+    ...     ttls={'repos/*/*/topics': 86400, 'repos/*/*/issues': 600})
+
+    Responses are kept in memory and evicted in the least recently used
+    order once their total size exceeds `max_bytes`. If `path` is given,
+    they are also stored in a SQLite database limited to `disk_max_bytes`,
+    so they survive restarts and evictions from memory.
+
+    Args:
+        ttl (int): default time to live of responses, seconds
+        ttls (dict): time to live for specific endpoints. Keys are
+            shell-style URL patterns, e.g. 'repos/*/*/issues'; the first
+            matching pattern is used.
+        max_bytes (int): max total size of responses kept in memory
+        path (Optional[str]): path to the SQLite database for on-disk cache
+        disk_max_bytes (int): max total size of responses kept on disk
+
+    Attributes:
+        hits (int): number of requests served from cache
+        misses (int): number of requests not found in cache
+    """
+
+    def __init__(self, ttl=3600, ttls=None, max_bytes=64 << 20, path=None,
+                 disk_max_bytes=1 << 30):
+        self.ttl = ttl
+        self.ttls = list((ttls or {}).items())
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._lock = threading.Lock()
+        # key -> (expires, url, headers, content)
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._db = None
+        self._disk_bytes = 0
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._db:
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS responses ('
+                    '  key TEXT PRIMARY KEY, expires REAL, accessed REAL,'
+                    '  url TEXT, headers TEXT, content BLOB)')
+                self._db.execute(
+                    'DELETE FROM responses WHERE expires < ?', (time.time(),))
+            self._disk_bytes = self._db.execute(
+                'SELECT COALESCE(SUM(LENGTH(content)), 0) FROM responses'
+            ).fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url, params, method='get', data=None):
+        return '%s %s %s' % (
+            method.upper(), _cache_key(url, params), data or '')
+
+    def ttl_for(self, url):
+        # type: (str) -> int
+        """ Get time to live for responses from this URL """
+        for pattern, ttl in self.ttls:
+            if fnmatch.fnmatchcase(url, pattern):
+                return ttl
+        return self.ttl
+
+    def _remember(self, key, record):
+        """ Put record in memory, evicting least recently used ones """
+        if key in self._memory:
+            self._memory_bytes -= len(self._memory.pop(key)[3])
+        size = len(record[3])
+        if size > self.max_bytes:
+            return
+        self._memory[key] = record
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted[3])
+
+    @staticmethod
+    def _has_errors(response):
+        """ Check if the response reports errors with status 200,
+        e.g. GraphQL rate limit or query complexity errors """
+        if b'"errors"' not in response.content:  # avoid parsing JSON
+            return False
+        try:
+            res = response.json()
+        except ValueError:
+            return False
+        return isinstance(res, dict) and 'errors' in res
+
+    def get(self, url, params, method='get', data=None):
+        # type: (str, dict, str, Optional[str]) -> Optional[requests.Response]
+        """ Get cached response to this request, if it hasn't expired """
+        key = self.key(url, params, method, data)
+        now = time.time()
+        with self._lock:
+            record = self._memory.get(key)
+            if record is not None and record[0] < now:
+                self._memory_bytes -= len(self._memory.pop(key)[3])
+                record = None
+            if record is not None:
+                # mark as recently used
+                self._memory[key] = self._memory.pop(key)
+            elif self._db is not None:
+                row = self._db.execute(
+                    'SELECT expires, url, headers, content FROM responses '
+                    'WHERE key=? AND expires >= ?', (key, now)).fetchone()
+                if row is not None:
+                    with self._db:
+                        self._db.execute(
+                            'UPDATE responses SET accessed=? WHERE key=?',
+                            (now, key))
+                    record = (row[0], row[1], json.loads(row[2]),
+                              bytes(row[3]))
+                    self._remember(key, record)
+
+            if record is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return _build_response(200, record[2], record[3], record[1], 'OK')
+
+    def set(self, url, params, method, data, response):
+        """ Cache a response. Only successful responses are stored """
+        if response.status_code != 200 or self._has_errors(response):
+            return
+        ttl = self.ttl_for(url)
+        if ttl <= 0:
+            return
+        key = self.key(url, params, method, data)
+        now = time.time()
+        record = (now + ttl, response.url, dict(response.headers),
+                  response.content)
+        with self._lock:
+            self._remember(key, record)
+            if self._db is None or len(record[3]) > self.disk_max_bytes:
+                return
+            with self._db:
+                old = self._db.execute(
+                    'SELECT LENGTH(content) FROM responses WHERE key=?',
+                    (key,)).fetchone()
+                self._db.execute(
+                    'REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', (
+                        key, record[0], now, record[1],
+                        json.dumps(record[2]), sqlite3.Binary(record[3])))
+                self._disk_bytes += len(record[3]) - (old[0] if old else 0)
+                while self._disk_bytes > self.disk_max_bytes:
+                    key, size = self._db.execute(
+                        'SELECT key, LENGTH(content) FROM responses '
+                        'ORDER BY accessed LIMIT 1').fetchone()
+                    self._db.execute(
+                        'DELETE FROM responses WHERE key=?', (key,))
+                    self._disk_bytes -= size
+
+    def clear(self):
+        """ Remove all cached responses """
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            if self._db is not None:
+                with self._db:
+                    self._db.execute('DELETE FROM responses')
+                self._disk_bytes = 0
+
+    def stats(self):
+        """ Get hit/miss counters and cache size """
+        return {'hits': self.hits, 'misses': self.misses,
+                'memory_bytes': self._memory_bytes,
+                'disk_bytes': self._disk_bytes}
@@ -0,0 +1,330 @@
+""" Coordination of a token pool shared by multiple processes or hosts.
+
+Every API object keeps its own view of token rate limits, so several
+scrapers using the same tokens all assume they have the full quota and
+end up hitting rate limits. A coordinator is a small service holding
+the only token scheduler for all clients: clients lease tokens from it
+and report rate limits received in responses back.
+
+Start the coordinator (it listens on localhost only by default):
+
+    $ stscraper-coordinator --port 8765
+
+and plug it into API objects of every client:
+
+>>> from stscraper import GitHubAPI
+>>> from stscraper.coordinator import CoordinatedScheduler
+>>> api = GitHubAPI()
+>>> api.scheduler = CoordinatedScheduler(api.tokens, 'localhost:8765')
+
+Alternatively, set `STSCRAPER_COORDINATOR=localhost:8765` environment
+variable and `GitHubAPI.scheduler_class = CoordinatedScheduler` before
+instantiating the API. Unix sockets can be used instead of TCP by
+providing a path instead of host:port.
+
+The protocol is line-delimited JSON. Note that tokens are sent in clear
+text, so the coordinator should not be exposed outside of a trusted
+network.
+"""
+
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+
+from six.moves import socketserver
+
+from .base import TokenScheduler, VCSError
+
+
+def parse_address(address):
+    # type: (Union[str, Tuple[str, int]]) -> Union[str, Tuple[str, int]]
+    """ Parse 'host:port' into a tuple; other strings are socket paths """
+    if isinstance(address, tuple):
+        return address
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return host or '127.0.0.1', int(port)
+    return address
+
+
+class _Token(object):
+    """ Coordinator side representation of a token: only limits are known.
+    Clients send API class (e.g. 'core') instead of the URL.
+    """
+
+    def __init__(self, token, limits=None):
+        self.token = token
+        self.limits = dict(limits or {})
+
+    @staticmethod
+    def api_class(api_class):
+        return api_class
+
+    def when(self, api_class):
+        limits = self.limits.get(api_class) or {}
+        if limits.get('remaining') != 0:
+            return 0
+        return limits.get('reset')
+
+    def ready(self, api_class):
+        t = self.when(api_class)
+        return not t or t <= time.time()
+
+    def __str__(self):
+        return self.token
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.coordinator.handle(
+                    json.loads(line.decode('utf8')))
+            except Exception as e:
+                response = {'error': repr(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf8'))
+            self.wfile.flush()
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+if hasattr(socket, 'AF_UNIX'):
+    class _UnixServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+class TokenCoordinator(object):
+    """ Lease tokens to multiple clients and aggregate their rate limits
+
+    Args:
+        address (Union[str, Tuple[str, int]]): 'host:port', (host, port)
+            or a Unix socket path to listen on. Port 0 means any free port;
+            the actual address is available as `.address`
+    """
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        self.scheduler = TokenScheduler()
+        self._tokens = {}
+        self._lock = threading.Lock()
+        self.leases = 0
+
+        address = parse_address(address)
+        if isinstance(address, tuple):
+            self.server = _TCPServer(address, _Handler)
+        else:
+            if os.path.exists(address):
+                os.unlink(address)
+            self.server = _UnixServer(address, _Handler)
+        self.server.coordinator = self
+        self.address = self.server.server_address
+
+    def handle(self, request):
+        # type: (dict) -> dict
+        """ Process a single client request """
+        op = request['op']
+        if op == 'acquire':
+            token, resume_at = self.scheduler.acquire(
+                request['api_class'], request.get('cost', 1))
+            if token is None:
+                return {'token': None, 'resume_at': resume_at}
+            with self._lock:
+                self.leases += 1
+            return {'token': token.token}
+        elif op == 'update':
+            token = self._tokens.get(request['token'])
+            if token is not None:
+                token.limits[request['api_class']] = request['limits']
+            return {}
+        elif op == 'add':
+            new_tokens = []
+            with self._lock:
+                for value, limits in request['tokens'].items():
+                    if value not in self._tokens:
+                        self._tokens[value] = _Token(value, limits)
+                        new_tokens.append(self._tokens[value])
+            self.scheduler.add(new_tokens)
+            return {}
+        elif op == 'stats':
+            return {'leases': self.leases, 'limits': {
+                value: token.limits for value, token in self._tokens.items()}}
+        raise ValueError("Unknown operation: %s" % op)
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def start(self):
+        """ Serve requests in a background thread """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def shutdown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if not isinstance(self.address, tuple):
+            os.unlink(self.address)
+
+
+class _ReportingLimits(dict):
+    """ Token limits reporting every update to the coordinator """
+
+    def __init__(self, scheduler, token, limits):
+        super(_ReportingLimits, self).__init__(limits)
+        self._scheduler = scheduler
+        self._token = token
+
+    def __setitem__(self, api_class, limits):
+        super(_ReportingLimits, self).__setitem__(api_class, limits)
+        self._scheduler.update(self._token, api_class, limits)
+
+
+class CoordinatedScheduler(object):
+    """ Token scheduler delegating the choice of tokens to a coordinator
+
+    This is a drop-in replacement of `TokenScheduler`
+    (see `VCSAPI.scheduler_class`). All clients of the same coordinator
+    are expected to use the same tokens.
+
+    Args:
+        tokens (Iterable[APIToken]): tokens of this client
+        address (Optional[Union[str, Tuple[str, int]]]): coordinator
+            address, `STSCRAPER_COORDINATOR` environment variable
+            by default
+        timeout (int): socket timeout, seconds
+    """
+
+    def __init__(self, tokens=(), address=None, timeout=30):
+        address = address or os.environ.get('STSCRAPER_COORDINATOR')
+        if not address:
+            raise ValueError("Coordinator address is not provided. Either "
+                             "pass it explicitly or set "
+                             "STSCRAPER_COORDINATOR environment variable")
+        self.address = parse_address(address)
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._socket = None
+        self._file = None
+        self._tokens = {}
+        self.add(tokens)
+
+    def _connect(self):
+        if isinstance(self.address, tuple):
+            sock = socket.create_connection(self.address, self.timeout)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+        self._socket = sock
+        self._file = sock.makefile('rb')
+
+    def _disconnect(self):
+        for obj in (self._file, self._socket):
+            try:
+                obj.close()
+            except (OSError, socket.error):
+                pass
+        self._socket = self._file = None
+
+    def _call(self, op, **request):
+        request['op'] = op
+        payload = (json.dumps(request) + '\n').encode('utf8')
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._socket is None:
+                        self._connect()
+                    self._socket.sendall(payload)
+                    line = self._file.readline()
+                    if not line:
+                        raise socket.error("Connection closed")
+                    break
+                except (OSError, socket.error):
+                    self._disconnect()
+                    if attempt:
+                        raise
+        response = json.loads(line.decode('utf8'))
+        if 'error' in response:
+            raise VCSError("Token coordinator error: " + response['error'])
+        return response
+
+    def add(self, tokens):
+        """ Add tokens to the pool """
+        limits = {}
+        for token in tokens:
+            value = str(token)
+            self._tokens[value] = token
+            token.limits = _ReportingLimits(self, value, token.limits)
+            limits[value] = dict(token.limits)
+        if limits:
+            self._call('add', tokens=limits)
+
+    def update(self, token, api_class, limits):
+        """ Report new rate limits of a token """
+        self._call('update', token=token, api_class=api_class, limits=limits)
+
+    def acquire(self, url="", cost=1):
+        """ Get the best token to make a request to the specified URL
+
+        Args:
+            url (str): request URL, to determine the API class
+            cost (int): expected rate limit cost of the request
+
+        Returns:
+            Tuple[Optional[APIToken], Optional[int]]: a token and None,
+                or, if all tokens are exhausted, None and unix timestamp
+                when the first of them will become available again
+        """
+        if not self._tokens:
+            raise VCSError("No valid tokens available")
+        api_class = next(iter(self._tokens.values())).api_class(url)
+        response = self._call('acquire', api_class=api_class, cost=cost)
+        if response['token'] is None:
+            return None, response['resume_at']
+        try:
+            return self._tokens[response['token']], None
+        except KeyError:
+            raise VCSError("Token coordinator returned a token unknown to "
+                           "this client. Make sure all clients use the "
+                           "same tokens")
+
+    def stats(self):
+        """ Get the number of leases and limits of all tokens """
+        return self._call('stats')
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Coordinate a pool of API tokens shared by multiple "
+                    "scrapers")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="Interface to listen on, localhost by default")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket',
+                        help="Unix socket path to use instead of TCP")
+    args = parser.parse_args(argv)
+
+    coordinator = TokenCoordinator(args.socket or (args.host, args.port))
+    print("Listening on", coordinator.address)
+    try:
+        coordinator.serve_forever()
+    except KeyboardInterrupt:
+        coordinator.shutdown()
+
+
+if __name__ == '__main__':
+    main()
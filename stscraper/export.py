@@ -0,0 +1,197 @@
+""" Streaming export of API results to files.
+
+Records are consumed from any iterable (e.g. a paginated API method),
+optionally projected with a `json_map` mapping, and written out in chunks,
+so no more than one chunk is held in memory at any time:
+
+>>> from stscraper import GitHubAPI
+>>> from stscraper.export import export, CSVSink
+>>> api = GitHubAPI()
+>>> export(api.repo_commits('pandas-dev/pandas'), CSVSink('commits.csv'),
+...        mapping={'sha': 'sha', 'author': 'author__login',
+...                 'date': 'commit__author__date'})
+31415
+
+Supported formats are NDJSON (`NDJSONSink`), CSV (`CSVSink`) and
+Parquet (`ParquetSink`, requires `pyarrow`). NDJSON and CSV files with
+'.gz' extension are compressed.
+"""
+
+from __future__ import absolute_import
+
+import csv
+import gzip
+import io
+import itertools
+import json
+
+import six
+
+from .base import compile_mapping
+
+
+def _open(path, mode):
+    """ Open a text file for writing, compressing .gz files """
+    if path.endswith('.gz'):
+        return io.TextIOWrapper(gzip.open(path, mode + 'b'),
+                                encoding='utf8', newline='')
+    return io.open(path, mode, encoding='utf8', newline='')
+
+
+class Sink(object):
+    """ Base class for export destinations.
+
+    Sinks accept either a path or a file object. Files opened by the sink
+    are closed when the sink is closed; file objects are only flushed.
+    Sinks are context managers, so `with` statement can be used instead
+    of calling `close()` explicitly.
+    """
+    mode = 'w'
+
+    def __init__(self, path_or_file):
+        if isinstance(path_or_file, six.string_types):
+            self.fh = _open(path_or_file, self.mode)
+            self._owns_file = True
+        else:
+            self.fh = path_or_file
+            self._owns_file = False
+
+    def write(self, rows):
+        # type: (list) -> None
+        """ Write a chunk of records """
+        raise NotImplementedError
+
+    def close(self):
+        if self._owns_file:
+            self.fh.close()
+        else:
+            self.fh.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class NDJSONSink(Sink):
+    """ Newline-delimited JSON, one record per line """
+
+    def write(self, rows):
+        self.fh.write(u''.join(
+            six.text_type(json.dumps(row, default=str)) + u'\n'
+            for row in rows))
+        self.fh.flush()
+
+
+class CSVSink(Sink):
+    """ CSV file with a header.
+
+    Columns are defined by `fieldnames` if provided, or by keys of the
+    first record otherwise; extra keys in other records are ignored.
+    Nested values (lists and dictionaries) are serialized as JSON.
+    """
+
+    def __init__(self, path_or_file, fieldnames=None, **csv_kwargs):
+        super(CSVSink, self).__init__(path_or_file)
+        self.fieldnames = fieldnames
+        self.csv_kwargs = csv_kwargs
+        self._writer = None
+
+    def write(self, rows):
+        if not rows:
+            return
+        if self._writer is None:
+            self._writer = csv.DictWriter(
+                self.fh, self.fieldnames or list(rows[0].keys()),
+                extrasaction='ignore', **self.csv_kwargs)
+            self._writer.writeheader()
+        self._writer.writerows(
+            {key: json.dumps(value) if isinstance(value, (dict, list))
+             else value for key, value in row.items()}
+            for row in rows)
+        self.fh.flush()
+
+
+class ParquetSink(Sink):
+    """ Parquet file, every chunk is written as a separate row group.
+
+    Unless `schema` (a `pyarrow.Schema`) is provided, it is inferred from
+    the first chunk. Columns with all empty values in the first chunk are
+    assumed to be strings, and their values in later chunks are converted
+    to strings. Nested values (lists and dictionaries) are serialized as
+    JSON.
+    """
+
+    def __init__(self, path_or_file, schema=None, **writer_kwargs):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError(
+                "Parquet export requires pyarrow. "
+                "Please install it first, e.g. `pip install pyarrow`")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        # parquet is a binary format, so no text file wrappers here
+        self.fh = path_or_file
+        self._owns_file = False
+        self.schema = schema
+        self.writer_kwargs = writer_kwargs
+        self._writer = None
+        self._string_columns = set()
+
+    def write(self, rows):
+        if not rows:
+            return
+        rows = [{key: json.dumps(value) if isinstance(value, (dict, list))
+                 else value for key, value in row.items()} for row in rows]
+        if self.schema is None:
+            schema = self.pa.Table.from_pylist(rows).schema
+            self._string_columns = {field.name for field in schema
+                                    if self.pa.types.is_null(field.type)}
+            self.schema = self.pa.schema([
+                field.with_type(self.pa.string())
+                if field.name in self._string_columns else field
+                for field in schema])
+        elif self._string_columns:
+            rows = [{key: six.text_type(value) if key in self._string_columns
+                     and value is not None
+                     and not isinstance(value, six.string_types) else value
+                     for key, value in row.items()} for row in rows]
+        table = self.pa.Table.from_pylist(rows, schema=self.schema)
+        if self._writer is None:
+            self._writer = self.pq.ParquetWriter(
+                self.fh, self.schema, **self.writer_kwargs)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+def export(records, sink, mapping=None, chunk_size=10000):
+    """ Write records to the sink in chunks
+
+    Args:
+        records (Iterable[dict]): records to export, e.g. result of a
+            paginated API method
+        sink (Sink): export destination. It is closed upon completion.
+        mapping (Optional[dict]): `json_map` mapping to apply to records
+        chunk_size (int): number of records to accumulate before writing
+
+    Returns:
+        int: number of exported records
+    """
+    records = iter(records)
+    if mapping is not None:
+        records = compile_mapping(mapping).map_many(records)
+    count = 0
+    with sink:
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                break
+            sink.write(chunk)
+            count += len(chunk)
+    return count
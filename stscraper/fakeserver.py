@@ -0,0 +1,223 @@
+""" A local stand-in for GitHub API, for tests and benchmarks.
+
+The server runs in a background thread and serves responses from
+`routes`, a dictionary of callables. It can emulate network latency,
+per-token rate limits and random errors, so scraping code can be
+tested and benchmarked offline and reproducibly:
+
+>>> from stscraper.fakeserver import FakeGitHub
+>>> server = FakeGitHub(latency=0.05, rate_limit=5000, errors={502: 0.01})
+>>> server.paginated('repos/user/repo/issues',
+...                  [{'number': i} for i in range(1000)], per_page=100)
+>>> api = server.api('token1,token2')
+>>> len(list(api.repo_issues('user/repo')))
+1000
+>>> server.shutdown()
+"""
+
+from __future__ import absolute_import
+
+import json
+import random
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, urlparse
+
+from .github import GitHubAPI
+
+
+class FakeGitHubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Serve responses from the `routes` dictionary of the server.
+    Routes are callables taking query params and request headers and
+    returning (status, headers, json-serializable body).
+    Body of POST requests is available as `params['_body']`.
+    """
+    # keep connections alive, like the real API does
+    protocol_version = 'HTTP/1.1'
+    # otherwise small responses are delayed by Nagle's algorithm
+    disable_nagle_algorithm = True
+
+    def _respond(self):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        path = url.path.strip('/')
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params['_body'] = json.loads(self.rfile.read(length))
+        server = self.server
+        server.log.append((self.command, path, params))
+        if server.latency:
+            time.sleep(server.latency)
+
+        status, headers, body = server.handle(path, params, self.headers)
+        payload = b'' if body is None else json.dumps(body).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(payload)
+
+    do_GET = do_POST = do_HEAD = _respond
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeGitHub(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Fake GitHub API server
+
+    Args:
+        latency (float): delay before every response, seconds
+        rate_limit (Optional[int]): number of requests allowed per token
+            in `reset_in` seconds. If set, responses include
+            `X-RateLimit-*` headers and exhausted tokens get 403 errors
+        reset_in (int): rate limit window, seconds
+        errors (Optional[dict]): probabilities of injected errors by status,
+            e.g. `{502: 0.01, 403: 0.001}`. 403 errors are secondary rate
+            limit errors with `Retry-After: retry_after` header
+        retry_after (int): Retry-After of injected 403 errors, seconds
+        seed (int): random seed for error injection
+        port (int): port to listen on, any free one by default
+
+    Attributes:
+        url (str): base URL of the API, use as `APIToken.api_url`
+        routes (dict): path (without leading slash) -> route callable
+        log (list): (method, path, params) of all received requests
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0, rate_limit=None, reset_in=3600,
+                 errors=None, retry_after=1, seed=0, port=0):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', port), FakeGitHubHandler)
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.reset_in = reset_in
+        self.errors = errors or {}
+        self.retry_after = retry_after
+        self.log = []
+        self.routes = {
+            'user': lambda params, headers: (200, {}, {'login': 'fake'}),
+        }
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # token -> (requests made, window reset time)
+        self._usage = {}
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def shutdown(self):
+        BaseHTTPServer.HTTPServer.shutdown(self)
+        self.server_close()
+
+    def _rate_limit_headers(self, token):
+        now = time.time()
+        with self._lock:
+            used, reset = self._usage.get(token, (0, now + self.reset_in))
+            if reset <= now:
+                used, reset = 0, now + self.reset_in
+            used += 1
+            self._usage[token] = (used, reset)
+        return {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(max(0, self.rate_limit - used)),
+            'X-RateLimit-Reset': str(int(reset)),
+        }, used > self.rate_limit
+
+    def _injected_error(self):
+        with self._lock:
+            value = self._random.random()
+        for status, probability in sorted(self.errors.items()):
+            if value < probability:
+                return status
+            value -= probability
+        return None
+
+    def handle(self, path, params, headers):
+        """ Get (status, headers, body) of the response to a request """
+        limit_headers = {}
+        if self.rate_limit is not None:
+            limit_headers, exceeded = self._rate_limit_headers(
+                headers.get('Authorization'))
+            if exceeded:
+                return 403, limit_headers, {
+                    'message': 'API rate limit exceeded'}
+
+        error = self._injected_error()
+        if error == 403:
+            limit_headers['Retry-After'] = str(self.retry_after)
+            return 403, limit_headers, {
+                'message': 'You have exceeded a secondary rate limit'}
+        elif error is not None:
+            return error, limit_headers, None
+
+        route = self.routes.get(path)
+        if route is None:
+            return 404, limit_headers, {'message': 'Not Found'}
+        status, route_headers, body = route(params, headers)
+        return status, dict(limit_headers, **route_headers), body
+
+    def paginated(self, path, items, per_page=2):
+        """ Serve `items` at `path` in pages of `per_page` objects """
+        def route(params, headers):
+            page = int(params.get('page', 1))
+            last = (len(items) - 1) // per_page + 1
+            links = []
+            if page < last:
+                links.append('<%s%s?page=%d>; rel="next"' % (
+                    self.url, path, page + 1))
+                links.append('<%s%s?page=%d>; rel="last"' % (
+                    self.url, path, last))
+            start = (page - 1) * per_page
+            return 200, {'Link': ', '.join(links)}, \
+                items[start:start + per_page]
+        self.routes[path] = route
+
+    def connection(self, object_path, nodes, per_page=100, cost=1):
+        """ Serve `nodes` as a paginated GraphQL connection
+
+        Any query to the 'graphql' endpoint gets a page of `nodes`
+        at `object_path` (e.g. 'repository.issues'), starting after
+        the `cursor` variable. Queries selecting `rateLimit` also get
+        `cost` of the query.
+        """
+        keys = object_path.split('.')
+
+        def route(params, headers):
+            body = params.get('_body', {})
+            variables = body.get('variables') or {}
+            start = int(variables.get('cursor') or 0)
+            end = start + per_page
+            result = {'nodes': nodes[start:end], 'pageInfo': {
+                'endCursor': str(end), 'hasNextPage': end < len(nodes)}}
+            for key in reversed(keys):
+                result = {key: result}
+            if 'rateLimit' in body.get('query', ''):
+                result['rateLimit'] = {'cost': cost}
+            return 200, {}, {'data': result}
+        self.routes['graphql'] = route
+
+    def api(self, tokens='token', api_class=GitHubAPI, timeout=30):
+        """ Get an instance of the API class using this server
+
+        The API class is subclassed, so that its singleton instance
+        doesn't interfere with the regular one.
+        """
+        token_class = type('Fake' + api_class.token_class.__name__,
+                           (api_class.token_class,), {'api_url': self.url})
+        fake_class = type('Fake' + api_class.__name__, (api_class,),
+                          {'token_class': token_class, '_instance': None})
+        return fake_class(tokens, timeout=timeout)
+
+    def requests_to(self, path):
+        # type: (str) -> int
+        """ Count requests received at `path` """
+        return sum(1 for _, request_path, _ in self.log
+                   if request_path == path)
@@ -2,13 +2,15 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import calendar
 import datetime
+import itertools
 import json
 import os
 import warnings
 
 from .base import *
-import stutils
+from . import graphql
 
 # This is a list of preview features
 # https://developer.github.com/v3/previews/
@@ -27,15 +29,15 @@ accept_headers = (
 
 class GitHubAPIToken(APIToken):
     api_url = 'https://api.github.com/'
-    api_classes = ('core', 'search')
+    api_classes = ('core', 'search', 'graphql')
 
     _user = None  # cache user
     # dictionaries are mutable. Don't put default headers dict here
     # or it will be shared by all class instances
     _headers = None
 
-    def __init__(self, token=None, timeout=None):
-        super(GitHubAPIToken, self).__init__(token, timeout)
+    def __init__(self, token=None, timeout=None, transport=None):
+        super(GitHubAPIToken, self).__init__(token, timeout, transport)
         # mercy-preview: repo topics
         # squirrel-girl-preview: issue reactions
         # starfox-preview: issue events
@@ -52,9 +54,16 @@ class GitHubAPIToken(APIToken):
             except TokenNotReady:
                 pass
             else:
-                self._user = r.json().get('login', '')
+                # anonymous requests are answered with 401 too,
+                # but only tokens can be rejected
+                if r.status_code != 401 or self.token is None:
+                    self._user = r.json().get('login', '')
         return self._user
 
+    def restore(self, state):
+        super(GitHubAPIToken, self).restore(state)
+        self._user = state.get('user')
+
     @property
     def is_valid(self):
         return self.user is not None
@@ -78,6 +87,8 @@ class GitHubAPIToken(APIToken):
 
     @staticmethod
     def api_class(url):
+        if url.startswith('graphql'):
+            return 'graphql'
         return 'search' if url.startswith('search') else 'core'
 
     def legit(self):
@@ -88,9 +99,10 @@ class GitHubAPIToken(APIToken):
 
     def when(self, url):
         key = self.api_class(url)
-        if self.limits[key]['remaining'] != 0:
-            return 0
-        return self.limits[key]['reset']
+        reset = 0
+        if self.limits[key]['remaining'] == 0:
+            reset = self.limits[key]['reset'] or 0
+        return max(reset, self.parked_until.get(key, 0))
 
     def _update_limits(self, response, url):
         if 'X-RateLimit-Remaining' in response.headers:
@@ -112,12 +124,13 @@ class GitHubAPI(VCSAPI):
     """
     token_class = GitHubAPIToken
     base_url = 'https://github.com'
-    status_too_many_requests = (403,)
+    status_too_many_requests = (403, 429)
 
     def __init__(self, tokens=None, timeout=30):
         # Where to look for tokens:
         # strudel config variables
         if not tokens:
+            import stutils  # only needed to look up tokens in configs
             stconfig_tokens = stutils.get_config('GITHUB_API_TOKENS')
             if stconfig_tokens:
                 tokens = [token.strip()
@@ -146,20 +159,30 @@ class GitHubAPI(VCSAPI):
                 return True
         return False
 
+    def _last_page(self, response):
+        url = response.links.get('last', {}).get('url')
+        match = url and re.search(r'[?&]page=(\d+)', url)
+        return match and int(match.group(1))
+
+    @staticmethod
+    def metric_endpoint(url):
+        url = VCSAPI.metric_endpoint(url)
+        url = re.sub(r'^repos/[^/]+/[^/]+', 'repos/:owner/:repo', url)
+        url = re.sub(r'/[0-9a-f]{40}(?=/|$)', '/:sha', url)
+        return re.sub(r'^(user|org)s/[^/]+', r'\1s/:\1', url)
+
     # ===================================
     #           API methods
     # ===================================
-    @api('users', paginate=True)
-    def all_users(self):
-        """Get all GitHub users"""
+    def all_users(self, since=0, until=None, shards=1):
+        """Get all GitHub users, see `scan()` for parameters"""
         # https://developer.github.com/v3/users/#get-all-users
-        return ()
+        return self.scan('users', since, until, shards)
 
-    @api('repositories', paginate=True)
-    def all_repos(self):
-        """Get all GitHub repositories"""
+    def all_repos(self, since=0, until=None, shards=1):
+        """Get all GitHub repositories, see `scan()` for parameters"""
         # https://developer.github.com/v3/repos/#list-all-public-repositories
-        return ()
+        return self.scan('repositories', since, until, shards)
 
     @api('repos/%s')
     def repo_info(self, repo_slug):
@@ -168,13 +191,14 @@ class GitHubAPI(VCSAPI):
         return repo_slug
 
     @api_filter(lambda issue: 'pull_request' not in issue)
-    @api('repos/%s/issues', paginate=True, state='all')
+    @api('repos/%s/issues', paginate=True, watermark='updated_at',
+         state='all')
     def repo_issues(self, repo_slug):
         """Get repository issues (not including pull requests)"""
         # https://developer.github.com/v3/issues/#list-issues-for-a-repository
         return repo_slug
 
-    @api('repos/%s/issues/comments', paginate=True)
+    @api('repos/%s/issues/comments', paginate=True, watermark='updated_at')
     def repo_issue_comments(self, repo_slug):
         """ Get all comments in all issues and pull requests,
         both open and closed.
@@ -190,7 +214,8 @@ class GitHubAPI(VCSAPI):
         # https://developer.github.com/v3/issues/events/#list-events-for-a-repository
         return repo_slug
 
-    @api('repos/%s/commits', paginate=True)
+    @api('repos/%s/commits', paginate=True,
+         watermark='commit__committer__date')
     def repo_commits(self, repo_slug):
         """Get all repository commits.
         Note that GitHub API might ignore some merge commits"""
@@ -261,7 +286,8 @@ class GitHubAPI(VCSAPI):
         # https://developer.github.com/v3/issues/comments/#list-comments-on-an-issue
         return repo, pr_id
 
-    @api('repos/%s/issues/%s/comments', paginate=True, state='all')
+    @api('repos/%s/issues/%s/comments', paginate=True,
+         watermark='updated_at', state='all')
     def issue_comments(self, repo, issue_id):
         """ Get comments on an issue or a pull request.
         Note that for pull requests this method will return only general
@@ -318,6 +344,299 @@ class GitHubAPI(VCSAPI):
         This includes state changes, references, labels etc. """
         return repo, issue_no
 
+    # ===================================
+    #        Enumeration of all objects
+    # ===================================
+    # number of objects per page in scans; a shorter page is the last one
+    scan_per_page = 100
+
+    def _page_since(self, url, since):
+        """ Get the page of objects with ids following `since` """
+        return next(self.request(url, since=since,
+                                 per_page=self.scan_per_page), None) or []
+
+    def _max_id(self, url):
+        """ Find an upper bound of object ids, within 0.1% """
+        low, high = 0, 1 << 20
+        while self._page_since(url, high):
+            low, high = high, high * 2
+        while high - low > high // 1000:
+            middle = (low + high) // 2
+            if self._page_since(url, middle):
+                low = middle
+            else:
+                high = middle
+        return high
+
+    def _scan_shard(self, url, since, until, put):
+        """ Pass pages of objects with ids in (since, until] to `put`.
+        Stops early if `put` returns False.
+        """
+        while until is None or since < until:
+            page = self._page_since(url, since)
+            if until is not None:
+                size = len(page)
+                page = [obj for obj in page if obj['id'] <= until]
+                if page and len(page) < size:  # the last page
+                    put(page)
+                    return
+            if not page or not put(page) \
+                    or len(page) < self.scan_per_page:
+                return
+            since = page[-1]['id']
+
+    def scan(self, url, since=0, until=None, shards=1):
+        """ Get all objects from an endpoint paginated by `since` id,
+        like 'repositories' or 'users'
+
+        Args:
+            url (str): request URL
+            since (int): only get objects with ids greater than this
+            until (Optional[int]): only get objects with ids up to this
+            shards (int): split the range of ids into this many shards,
+                scanned concurrently. Objects are generated in the order of
+                ids within a shard, but shards are interleaved. If `until`
+                is not set, the max id is probed with a few extra requests,
+                and the last shard is open-ended.
+
+        Generates:
+            dict: objects, as returned by the API
+
+        If `self.checkpoints` store is set, the id of the last object
+        generated in every shard is saved there, and interrupted scans are
+        resumed from these ids. To resume a scan, call this method with the
+        same parameters.
+
+        To use multiple processes or hosts, scan disjoint ranges of ids
+        in every one of them, e.g.:
+
+        >>> repos = GitHubAPI().all_repos(since=10**8, until=2 * 10**8)
+        """
+        plan_key = bounds = None
+        if self.checkpoints is not None:
+            plan_key = self.checkpoint_key(
+                url, since=since, until=until, shards=shards)
+            bounds = self._resume(plan_key)
+        if bounds is None:
+            if shards > 1:
+                high = self._max_id(url) if until is None else until
+                bounds = [since + (high - since) * i // shards
+                          for i in range(shards)] + [until]
+            else:
+                bounds = [since, until]
+            self._checkpoint(plan_key, bounds)
+
+        # shard key -> (frontier, until) of unfinished shards
+        pending = collections.OrderedDict()
+        for low, high in zip(bounds, bounds[1:]):
+            key = low
+            if plan_key:
+                key = self.checkpoint_key(url, since=low, until=high)
+                low = self._resume(key) or low
+            if high is None or low < high:
+                pending[key] = (low, high)
+
+        # multiprocessing is slow to import and rarely needed
+        from multiprocessing.pool import ThreadPool
+        # a few pages per shard; scanning pauses if they are not consumed
+        results = six.moves.queue.Queue(2 * len(bounds))
+        stopped = threading.Event()
+
+        def run(key, low, high):
+            def put(page):
+                while not stopped.is_set():
+                    try:
+                        results.put((key, page), timeout=1)
+                        return True
+                    except six.moves.queue.Full:
+                        pass
+                return False
+            try:
+                self._scan_shard(url, low, high, put)
+                put(None)
+            except Exception as e:
+                put(e)
+
+        pool = ThreadPool(max(len(pending), 1))
+        try:
+            for key, (low, high) in pending.items():
+                pool.apply_async(run, (key, low, high))
+            while pending:
+                key, page = results.get()
+                if isinstance(page, Exception):
+                    raise page
+                if page is None:
+                    high = pending.pop(key)[1]
+                    if plan_key and high is not None:
+                        self._checkpoint(key, high)
+                    continue
+                for obj in page:
+                    yield obj
+                if plan_key:
+                    self._checkpoint(key, page[-1]['id'])
+        finally:
+            stopped.set()
+            pool.terminate()
+
+        for low, high in zip(bounds, bounds[1:]):
+            self._complete(
+                plan_key and self.checkpoint_key(url, since=low, until=high))
+        self._complete(plan_key)
+
+    # ===================================
+    #        Search methods
+    # ===================================
+    # GitHub only returns this many results of a search query
+    search_limit = 1000
+    search_per_page = 100
+    # number of query slices to retrieve concurrently
+    search_threads = 4
+    # GitHub was launched in 2008, there are no older objects
+    search_start = '2007-10-01'
+    # files larger than 384 KB are not indexed by code search
+    search_max_size = 384 * 1024
+
+    @staticmethod
+    def _search_range(start, end):
+        """ Convert 'YYYY-MM-DD' dates to a range of unix timestamps """
+        start = calendar.timegm(time.strptime(start, '%Y-%m-%d'))
+        if end is None:
+            return start, int(time.time())
+        return start, calendar.timegm(time.strptime(end, '%Y-%m-%d')) - 1
+
+    @staticmethod
+    def _format_timestamp(timestamp):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+    def _search_slice(self, kind, query, qualifier, low, high, fmt):
+        """ Get all results of a search query slice, if they are within
+        `search_limit`, or subranges to split the slice into
+
+        Returns:
+            Tuple[list, list]: items and (low, high) subranges
+        """
+        url = 'search/' + kind
+        q = '%s %s:%s..%s' % (query, qualifier, fmt(low), fmt(high))
+        res = next(self.request(url, q=q, per_page=self.search_per_page),
+                   None) or {}
+        pages, subranges = self._search_split(q, res, low, high)
+        items = res.get('items') or []
+        for page in range(2, pages + 1):
+            res = next(self.request(url, q=q, per_page=self.search_per_page,
+                                    page=page), None) or {}
+            items.extend(res.get('items') or [])
+        return items, subranges
+
+    def _search_split(self, q, res, low, high):
+        """ Decide how to retrieve a slice, given its first page `res`
+
+        Returns:
+            Tuple[int, list]: number of pages to retrieve and (low, high)
+                subranges to split the slice into; only one of them is set
+        """
+        total = res.get('total_count', 0)
+        if total > self.search_limit and high > low:
+            parts = min(-(-total // self.search_limit) + 1, high - low + 1)
+            bounds = [low + (high - low + 1) * i // parts
+                      for i in range(parts + 1)]
+            return 0, [(bounds[i], bounds[i + 1] - 1) for i in range(parts)]
+        if total > self.search_limit:
+            self.logger.warning(
+                "Search query '%s' has %d results, only first %d will be "
+                "retrieved", q, total, self.search_limit)
+        return -(-min(total, self.search_limit) // self.search_per_page), []
+
+    def _search_bounds(self, qualifier, start, end):
+        """ Get the initial (low, high) range of a search query and
+        the function to format range bounds """
+        if qualifier == 'size':
+            high = self.search_max_size if end is None else end - 1
+            return start or 0, high, str
+        low, high = self._search_range(start or self.search_start, end)
+        return low, high, self._format_timestamp
+
+    def search(self, kind, query, qualifier='created', start=None, end=None,
+               dedupe=True):
+        """ Get all results of a search query, past the 1000 results cap
+
+        The query is recursively split into slices by `qualifier` ranges,
+        until every slice has less than `search_limit` results. Slices are
+        retrieved concurrently, in `search_threads` threads, so results
+        are generated in no particular order.
+
+        Args:
+            kind (str): 'repositories', 'issues', 'users' or 'code'
+            query (str): search query, e.g. 'language:python stars:>10'
+            qualifier (str): qualifier to slice the query by. Date
+                qualifiers (e.g. 'created' or 'pushed') are sliced between
+                `start` and `end` dates, 'YYYY-MM-DD', exclusive. `size` is
+                sliced between `start` and `end` sizes, in bytes.
+            dedupe (bool): skip results seen before. Objects might appear
+                in several slices if they were updated during the search.
+
+        Generates:
+            dict: search results, as returned by the API
+
+        >>> repos = GitHubAPI().search_repos('language:python', 'pushed')
+        """
+        low, high, fmt = self._search_bounds(qualifier, start, end)
+
+        # multiprocessing is slow to import and rarely needed
+        from multiprocessing.pool import ThreadPool
+        results = six.moves.queue.Queue()
+
+        def run(low, high):
+            try:
+                results.put(self._search_slice(
+                    kind, query, qualifier, low, high, fmt))
+            except Exception as e:
+                results.put(e)
+
+        pool = ThreadPool(self.search_threads)
+        seen = set()
+        try:
+            pool.apply_async(run, (low, high))
+            running = 1
+            while running:
+                result = results.get()
+                running -= 1
+                if isinstance(result, Exception):
+                    raise result
+                items, subranges = result
+                for subrange in subranges:
+                    pool.apply_async(run, subrange)
+                    running += 1
+                for item in items:
+                    key = item.get('id', item.get('url'))
+                    if dedupe:
+                        if key in seen:
+                            continue
+                        seen.add(key)
+                    yield item
+        finally:
+            pool.terminate()
+
+    def search_repos(self, query, qualifier='created', start=None, end=None):
+        """ Search repositories, sliced by creation or last push date """
+        # https://docs.github.com/en/rest/search#search-repositories
+        return self.search('repositories', query, qualifier, start, end)
+
+    def search_issues(self, query, start=None, end=None):
+        """ Search issues and pull requests, sliced by creation date """
+        # https://docs.github.com/en/rest/search#search-issues-and-pull-requests
+        return self.search('issues', query, 'created', start, end)
+
+    def search_users(self, query, start=None, end=None):
+        """ Search users, sliced by account creation date """
+        # https://docs.github.com/en/rest/search#search-users
+        return self.search('users', query, 'created', start, end)
+
+    def search_code(self, query, min_size=None, max_size=None):
+        """ Search code, sliced by file size in bytes (code search doesn't
+        support date qualifiers) """
+        # https://docs.github.com/en/rest/search#search-code
+        return self.search('code', query, 'size', min_size, max_size)
+
     # ===================================
     #        Non-API methods
     # ===================================
@@ -335,20 +654,24 @@ class GitHubAPI(VCSAPI):
 
 
 def parse_graphql_path(query):
-    """ Given a query, find object path.
-    This naive implementation doesn't account for many quircks in GitHub API.
-    In some cases, you still need to specify the path manually
+    """ Given a query, find object path: response keys of the first object
+    having multiple fields or a list of nodes. See `graphql.analyze()`.
+    Queries that can't be parsed get an empty path.
     """
-    path = []
-    query = re.sub(r'\(.*?\)', '', query.replace('\n', ' ').rstrip(' }'))
-    # skip the leading "query(...)" part
-    chunks = query.split('{')[1:]
-    for chunk in chunks:
-        chunk = chunk.strip()
-        if chunk in ('nodes', 'edges') or any(c in chunk for c in ' ,}'):
-            break
-        path.append(chunk)
-    return path
+    return list(graphql.analyze(query).object_path)
+
+
+def _inject_rate_limit(query, selection='rateLimit { cost }'):
+    """ Add `selection` to the top level of a query, to get the query cost
+    along with the result. Queries already selecting `rateLimit` and
+    documents that can't be parsed are returned as is.
+    """
+    document = graphql.analyze(query).document
+    if 'rateLimit' in query or document is None \
+            or len(document.operations) != 1:
+        return query
+    body = document.operation.body + 1
+    return query[:body] + ' ' + selection + query[body:]
 
 
 class GitHubAPIv4(GitHubAPI):
@@ -358,6 +681,19 @@ class GitHubAPIv4(GitHubAPI):
     set of methods. Instead, you're expected to write your own queries and this
     class will help you with pagination and network timeouts.
 
+    GraphQL queries are rate limited by cost in points rather than by number
+    of requests. Unless `query_cost` is disabled, queries are amended to
+    also return their cost, which is used to choose a token with enough
+    points left for the next page of the same query.
+
+    Only the connection at `object_path` is paginated; connections nested
+    in its nodes (e.g. comments of issues) are truncated at the first page.
+    If `nested_pages` is set, all pages of these connections are retrieved
+    as well, using batched follow-up queries, and merged into the nodes.
+    For this, nodes have to implement `Node` interface (i.e. have `id`) and
+    nested connections have to select `pageInfo {endCursor, hasNextPage}`.
+    Only one level of nesting is supported.
+
     Basic usage:
 
     >>> api = GitHubAPIv4('github_api_tokens')
@@ -386,10 +722,10 @@ class GitHubAPIv4(GitHubAPI):
     - first, it will parse the query and try to figure out the first object that
         has multiple fields; in the first query, it is `user`. In the second,
         it is `user.followers`.
-        The query parser is pretty naive, and is expected to fail on non-trivial
-        queries. In this case, you will need to explicitly tell what object you
-        want to retrieve. In the example below, we explicitly tell scraper the
-        path to the return object in the second positional argument:
+        If the query has multiple objects of interest, you will need to
+        explicitly tell what object you want to retrieve. In the example
+        below, we explicitly tell scraper the path to the return object in
+        the second positional argument:
 
         >>> api('...some query..',
         ...     ('repository', 'defaultBranchRef', 'target', 'history'),
@@ -399,16 +735,44 @@ class GitHubAPIv4(GitHubAPI):
         is not, it will simply return the content of this object; this is what
         happened with the first query. If there IS a pagination object, it will
         indicate we need pagination, and the content of `nodes` or `edges` will
-        be returned instead.
+        be returned instead. The cursor variable is the one passed as `after`
+        argument of the paginated object.
+
+    Query analysis is memoized, so running the same query many times
+    doesn't add parsing overhead.
 
     """
+    # request the query cost to plan token usage
+    query_cost = True
+    # max number of distinct queries to remember the cost of
+    max_query_costs = 1000
+
+    _costs = None  # query -> cost of the last run
+
+    # retrieve all pages of connections nested in paginated nodes
+    nested_pages = False
+    # max number of nodes in a single follow-up query
+    nested_batch_size = 20
+
+    def _query_cost(self, query):
+        """ Get the expected cost of a query, based on its last run """
+        return (self._costs or {}).get(query, 1)
+
+    def _observe_cost(self, query, rate_limit):
+        """ Remember the cost of the query reported in `rateLimit` """
+        cost = json_path(rate_limit, ('cost',))
+        if not cost:
+            return
+        if self._costs is None or len(self._costs) >= self.max_query_costs:
+            self._costs = {}
+        self._costs[query] = cost
 
     def v4(self, query, object_path=None, **params):
         """ Make an API v4 request, taking care of pagination
 
         Args:
-            query (str): GraphQL query. If the API request is multipage, it is
-                expected that the cursor variable name is "cursor".
+            query (str): GraphQL query. If the API request is multipage, the
+                cursor variable is the `after` argument of the connection.
             object_path (Tuple[str]): json path to objects to iterate, excluding
                 leading "data" part, and the trailing "nodes" when applicable.
                 If omitted, will return full "data" content
@@ -446,52 +810,238 @@ class GitHubAPIv4(GitHubAPI):
         ...         following {totalCount}
         ...       }}''', ('user',), user=user))
 
+        If `self.checkpoints` store is set, the cursor of the last completed
+        page is saved there, and interrupted queries are resumed from it.
+
+        If `self.stream` is set, responses to paginated queries are parsed
+        incrementally, and nodes are generated as they are received.
         """
-        if object_path is None:
-            object_path = parse_graphql_path(query) or ()
+        info = graphql.analyze(query, object_path)
+        object_path = info.object_path
+
+        key = None
+        if self.checkpoints is not None:
+            key = self.checkpoint_key('graphql', 'post', query, **params)
+            cursor = self._resume(key)
+            if cursor:
+                params[info.cursor] = cursor
+        stream = self.stream and info.paginated
+        nested = None
+        if self.nested_pages and info.nested:
+            query, nested = self._nested_query(query, info), info
+            stream = False
+        # without an object path, the whole response is returned
+        if self.query_cost and object_path:
+            query = _inject_rate_limit(query)
 
         while True:
             payload = json.dumps({'query': query, 'variables': params})
 
-            r = self._request('graphql', 'post', data=payload)
+            r = self._request('graphql', 'post', data=payload, stream=stream,
+                              cost=self._query_cost(query))
             if r.status_code in self.status_empty:
+                self._complete(key)
                 return
 
-            res = self.extract_result(r)
-            if 'errors' in res or 'data' not in res:
-                raise VCSError('API didn\'t return any data:\n' +
-                               json.dumps(res, indent=4))
-            data = res['data']
-
-            try:
-                objects = json_path(data, object_path, raise_on_missing=True)
-            except IndexError:
-                raise VCSError('Invalid object path "%s" in:\n %s' %
-                               (object_path, json.dumps(data)))
-
-            page_info = json_path(objects, ('pageInfo',))
-            if page_info is None:
-                yield objects
-                return
-            # This is due to inconsistency in graphql API.
-            # In most cases, requests returning lists of objects put them in
-            # 'nodes', but in few legacy methods they use 'edges'
-            nodes = objects.get('nodes', objects.get('edges'))
-            if nodes is None:
-                raise EnvironmentError(
-                    'Unexpected result format. Please report an issue:\n'
-                    'https://github.com/CMUSTRUDEL/strudel.scraper/issues/new')
-
-            for obj in nodes:
+            if stream:
+                page_info, rate_limit = {}, {}
+                objects = self._iter_v4_result(
+                    r, object_path, page_info, rate_limit)
+            else:
+                res = self.extract_result(r)
+                rate_limit = json_path(res, ('data', 'rateLimit'))
+                objects, page_info = self._parse_v4_result(res, object_path)
+                if page_info is None:
+                    self._observe_cost(query, rate_limit)
+                    yield objects
+                    return
+                if nested is not None:
+                    self._nested_pages(objects, nested, params)
+
+            for obj in objects:
                 yield obj
+            self._observe_cost(query, rate_limit)
             if not json_path(page_info, ('hasNextPage',)):
+                self._complete(key)
                 break
             # the result is single page, or there are no more pages
-            params['cursor'] = json_path(page_info, ('endCursor',))
+            params[info.cursor] = json_path(page_info, ('endCursor',))
+            self._checkpoint(key, params[info.cursor])
+
+    # aliases of fields added to nodes to query their nested connections
+    _nested_id = 'stscraperNodeId'
+    _nested_type = 'stscraperNodeType'
+
+    def _nested_query(self, query, info):
+        """ Add node id and type to nodes of the paginated connection """
+        body = info.nodes.body + 1
+        return '%s %s: id %s: __typename %s' % (
+            query[:body], self._nested_id, self._nested_type, query[body:])
+
+    def _nested_pages(self, objects, info, params):
+        """ Retrieve remaining pages of connections nested in `objects`
+        and merge them into the objects; see `_nested_query()`
+        """
+        pending = self._nested_pending(objects, info)
+        while pending:
+            batch = pending[:self.nested_batch_size]
+            pending = pending[self.nested_batch_size:] + self._nested_merge(
+                batch, self._nested_batch(info.document, batch, params))
+
+    def _nested_pending(self, objects, info):
+        """ Find nested connections having more pages
+
+        Returns:
+            list: (node id, node type, field, connection) tuples
+        """
+        document = info.document
+        is_edge = info.nodes.name == 'node'
+        pending = []  # (node id, node type, field, connection)
+        for obj in objects:
+            node = obj and (obj.get('node') if is_edge else obj)
+            if not node:
+                continue
+            node_id = node.pop(self._nested_id, None)
+            node_type = node.pop(self._nested_type, None)
+            for key in info.nested:
+                field = document.field(info.nodes.selections, key)
+                connection = node.get(key)
+                if not isinstance(connection, dict):
+                    continue
+                page_info = connection.get('pageInfo') or {}
+                if node_id and page_info.get('hasNextPage') \
+                        and page_info.get('endCursor'):
+                    pending.append((node_id, node_type, field, connection))
+        return pending
+
+    @staticmethod
+    def _nested_merge(batch, pages):
+        """ Merge next pages into nested connections,
+        return connections that have more pages """
+        pending = []
+        for item, page in zip(batch, pages):
+            connection = item[-1]
+            key = 'nodes' if 'nodes' in connection else 'edges'
+            connection[key].extend(page.get(key) or [])
+            connection['pageInfo'] = page.get('pageInfo') or {}
+            if connection['pageInfo'].get('hasNextPage'):
+                pending.append(item)
+        return pending
+
+    def _nested_batch(self, document, batch, params):
+        """ Get the next page of several nested connections in one query """
+        query, payload = self._nested_payload(document, batch, params)
+        res = self.extract_result(self._request(
+            'graphql', 'post', data=payload, cost=self._query_cost(query)))
+        return self._nested_result(query, res, batch)
+
+    def _nested_payload(self, document, batch, params):
+        """ Build a query to get the next page of nested connections,
+        return the query and the request payload """
+        variables = set()
+        declarations, selections, values = [], [], {}
+        for i, (node_id, node_type, field, connection) in enumerate(batch):
+            variables |= field.variables
+            declarations.append('$nodeId%d: ID!, $nodeCursor%d: String' %
+                                (i, i))
+            values['nodeId%d' % i] = node_id
+            values['nodeCursor%d' % i] = connection['pageInfo']['endCursor']
+            arguments = [argument for argument in field.arguments
+                         if argument[0] != 'after']
+            arguments.append(('after', '$nodeCursor%d' % i))
+            selections.append(
+                'n%d: node(id: $nodeId%d) { ... on %s { %s%s(%s) %s } }' % (
+                    i, i, node_type,
+                    field.alias and field.alias + ': ' or '', field.name,
+                    ', '.join('%s: %s' % arg for arg in arguments),
+                    document.source[field.body:field.end]))
+        for name, type_reference in document.operation.variables:
+            if name in variables:
+                declarations.append('$%s: %s' % (name, type_reference))
+                values[name] = params.get(name)
+
+        query = 'query (%s) {\n%s\n}' % (
+            ', '.join(declarations), '\n'.join(selections))
+        if self.query_cost:
+            query = _inject_rate_limit(query)
+        return query, json.dumps({'query': query, 'variables': values})
+
+    def _nested_result(self, query, res, batch):
+        """ Extract next pages of nested connections from the response """
+        if 'errors' in res or not res.get('data'):
+            raise VCSError('API didn\'t return any data:\n' +
+                           json.dumps(res, indent=4))
+        self._observe_cost(query, res['data'].get('rateLimit'))
+        return [json_path(res['data'], ('n%d' % i, field.key)) or {}
+                for i, (_, _, field, _) in enumerate(batch)]
+
+    @staticmethod
+    def _parse_v4_result(res, object_path):
+        """ Extract objects and pagination info from a parsed v4 response
+
+        Returns:
+            (object, Optional[dict]): if the object under `object_path` is
+                paginated, a list of nodes and the `pageInfo` object.
+                Otherwise, the object itself and None
+        """
+        if 'errors' in res or 'data' not in res:
+            raise VCSError('API didn\'t return any data:\n' +
+                           json.dumps(res, indent=4))
+        data = res['data']
+
+        try:
+            objects = json_path(data, object_path, raise_on_missing=True)
+        except IndexError:
+            raise VCSError('Invalid object path "%s" in:\n %s' %
+                           (object_path, json.dumps(data)))
+
+        page_info = json_path(objects, ('pageInfo',))
+        if page_info is None:
+            return objects, None
+        # This is due to inconsistency in graphql API.
+        # In most cases, requests returning lists of objects put them in
+        # 'nodes', but in few legacy methods they use 'edges'
+        nodes = objects.get('nodes', objects.get('edges'))
+        if nodes is None:
+            raise EnvironmentError(
+                'Unexpected result format. Please report an issue:\n'
+                'https://github.com/CMUSTRUDEL/strudel.scraper/issues/new')
+        return nodes, page_info
+
+    @staticmethod
+    def _iter_v4_result(response, object_path, page_info, rate_limit=None):
+        """ Streaming version of `_parse_v4_result()` for paginated queries
+
+        Generates nodes as they are received; `pageInfo` object is stored in
+        the `page_info` dictionary once the whole response is parsed.
+        Similarly, `rateLimit` object, if any, is stored in `rate_limit`.
+        """
+        base = '.'.join(('data',) + tuple(object_path))
+        prefixes = (base + '.nodes.item', base + '.edges.item',
+                    base + '.pageInfo', 'data.rateLimit', 'errors')
+        response.raw.decode_content = True
+        try:
+            for prefix, obj in iter_json(response.raw, prefixes):
+                if prefix == 'errors':
+                    if obj:
+                        raise VCSError('API returned errors:\n' +
+                                       json.dumps(obj, indent=4))
+                elif prefix == base + '.pageInfo':
+                    page_info.update(obj or {})
+                elif prefix == 'data.rateLimit':
+                    if rate_limit is not None:
+                        rate_limit.update(obj or {})
+                else:
+                    yield obj
+        finally:
+            response.close()
+        if not page_info:
+            raise VCSError('No pagination info at object path "%s"' %
+                           (object_path,))
 
     def __call__(self, query, object_path=None, **params):
         gen = self.v4(query, object_path, **params)
-        if 'pageInfo' in query:
+        if graphql.analyze(query, object_path).paginated:
             return iter(gen)
         return next(gen)
 
@@ -559,6 +1109,150 @@ class GitHubAPIv4(GitHubAPI):
                     pageInfo {endCursor, hasNextPage}
             }}}""", ('repository', 'stargazers'), owner=owner, repo=repo)
 
+    # ===================================
+    #        Batch methods
+    # ===================================
+    # GraphQL error types indicating the query is too expensive to run
+    batch_error_types = ('MAX_NODE_LIMIT_EXCEEDED', 'RESOURCE_LIMITS_EXCEEDED')
+
+    def _batch_query(self, selection, var_types, fields, batch):
+        """ Run a single batch query, splitting it on complexity errors
+
+        Returns:
+            list: objects in the order of `batch`, None for missing objects
+        """
+        query, payload = self._batch_payload(
+            selection, var_types, fields, batch)
+        try:
+            res = self.extract_result(self._request(
+                'graphql', 'post', data=payload,
+                cost=self._query_cost(query)))
+        except requests.exceptions.Timeout:
+            # GitHub returns 502 if the query takes too long to run
+            if len(batch) < 2:
+                raise
+            res = {'errors': [{'type': self.batch_error_types[0]}]}
+
+        objects = self._batch_result(query, res, batch)
+        if objects is None:
+            middle = len(batch) // 2
+            return (self._batch_query(selection, var_types, fields,
+                                      batch[:middle]) +
+                    self._batch_query(selection, var_types, fields,
+                                      batch[middle:]))
+        return objects
+
+    def _batch_payload(self, selection, var_types, fields, batch):
+        """ Build a batch query, return the query and the request payload """
+        declarations = ', '.join(
+            '$%s%d: %s' % (name, i, var_types[name])
+            for i in range(len(batch)) for name in sorted(var_types))
+        aliases = '\n'.join(
+            'r%d: %s { %s }' % (i, selection.format(i=i), fields)
+            for i in range(len(batch)))
+        variables = {'%s%d' % (name, i): value
+                     for i, item in enumerate(batch)
+                     for name, value in item.items()}
+        query = 'query (%s) {\n%s\n}' % (declarations, aliases)
+        if self.query_cost:
+            query = _inject_rate_limit(query)
+        return query, json.dumps({'query': query, 'variables': variables})
+
+    def _batch_result(self, query, res, batch):
+        """ Extract objects from a parsed batch query response
+
+        Returns:
+            Optional[list]: objects in the order of `batch`, or None if
+                the query was too complex and the batch has to be split
+        """
+        errors = res.get('errors') or []
+        if any(error.get('type') in self.batch_error_types
+               or 'complexity' in error.get('message', '').lower()
+               for error in errors) and len(batch) > 1:
+            return None
+        if any(error.get('type') != 'NOT_FOUND' for error in errors) \
+                or not res.get('data'):
+            raise VCSError('API didn\'t return any data:\n' +
+                           json.dumps(res, indent=4))
+        self._observe_cost(query, res['data'].get('rateLimit'))
+        return [res['data'].get('r%d' % i) for i in range(len(batch))]
+
+    def _batch(self, selection, var_types, fields, items, batch_size):
+        """ Get objects in batches of `batch_size` using query aliases
+
+        Args:
+            selection (str): object selection, using `{i}` placeholder
+                for the variable suffix, e.g. 'user(login: $login{i})'
+            var_types (dict): types of variables used in `selection`
+            fields (str): fields to retrieve for each object
+            items (Iterable[dict]): variables for each object
+            batch_size (int): max number of objects in a query
+
+        Generates:
+            object: retrieved objects in the order of `items`,
+                None if the object does not exist
+        """
+        items = iter(items)
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+            if not batch:
+                return
+            for obj in self._batch_query(selection, var_types, fields, batch):
+                yield obj
+
+    def repos_info(self, repo_slugs, fields=None, batch_size=50):
+        """ Get info for multiple repositories using few API requests
+
+        Args:
+            repo_slugs (Iterable[str]): repository slugs, e.g. 'owner/repo'
+            fields (str): GraphQL fields to retrieve
+            batch_size (int): max number of repositories in a query.
+                Batches are automatically split if GitHub reports the
+                query is too complex.
+
+        Generates:
+            Optional[dict]: repository info in the order of `repo_slugs`,
+                None for repositories that don't exist
+
+        >>> list(GitHubAPIv4().repos_info(['pandas-dev/pandas', 'a/b']))
+        [{'nameWithOwner': 'pandas-dev/pandas', ...}, None]
+        """
+        return self._batch(
+            'repository(owner: $owner{i}, name: $name{i})',
+            {'owner': 'String!', 'name': 'String!'},
+            fields or """
+                nameWithOwner, description, homepageUrl, createdAt,
+                updatedAt, pushedAt, isFork, isArchived, diskUsage,
+                primaryLanguage {name}, licenseInfo {spdxId}
+                parent {nameWithOwner}
+                stargazers {totalCount}, forks {totalCount}""",
+            (dict(zip(('owner', 'name'), slug.split('/', 1)))
+             for slug in repo_slugs),
+            batch_size)
+
+    def users_info(self, logins, fields=None, batch_size=50):
+        """ Get info for multiple users using few API requests
+
+        Args:
+            logins (Iterable[str]): user logins
+            fields (str): GraphQL fields to retrieve
+            batch_size (int): max number of users in a query
+
+        Generates:
+            Optional[dict]: user info in the order of `logins`,
+                None for users that don't exist
+        """
+        return self._batch(
+            'user(login: $login{i})', {'login': 'String!'},
+            fields or """
+                login, name, avatarUrl, websiteUrl
+                company, bio, location, twitterUsername, isHireable
+                createdAt, updatedAt
+                followers {totalCount}
+                following {totalCount}""",
+            ({'login': login} for login in logins),
+            batch_size)
+
 
 def get_limits(tokens=None):
     """Get human-readable rate usage limit.
@@ -594,6 +1288,7 @@ def print_limits(argv=None):
 
     columns = ('user', 'core_limit', 'core_remaining', 'core_renews_in',
                'search_limit', 'search_remaining', 'search_renews_in',
+               'graphql_limit', 'graphql_remaining', 'graphql_renews_in',
                'key')
 
     stats = list(get_limits())
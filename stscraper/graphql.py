@@ -0,0 +1,468 @@
+""" A small GraphQL query parser.
+
+It only covers what is needed to analyze and rewrite queries sent to
+GitHub v4 API: operations with variable definitions, selection sets with
+aliases and arguments, inline fragments and named fragments. Elements of
+the parsed document keep their offsets in the source text, so parts of
+the query can be reused verbatim in generated queries:
+
+>>> from stscraper.graphql import parse
+>>> doc = parse('query ($user: String!) { user(login: $user) { login } }')
+>>> field = doc.operation.selections[0]
+>>> field.name, field.arguments, doc.source[field.start:field.end]
+('user', [('login', '$user')], 'user(login: $user) { login }')
+"""
+
+from __future__ import absolute_import
+
+import re
+
+TOKEN_PATTERN = re.compile(r'''
+    (?P<ignored>[\s,]+|\#[^\n\r]*)
+  | (?P<string>"""(?:\\"""|[^"]|"(?!""))*"""|"(?:\\.|[^"\\\n\r])*")
+  | (?P<spread>\.\.\.)
+  | (?P<punctuator>[!$&()\:=@\[\]{|}])
+  | (?P<name>[_A-Za-z][_0-9A-Za-z]*)
+  | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+''', re.VERBOSE | re.UNICODE)
+
+
+class GraphQLSyntaxError(ValueError):
+    pass
+
+
+def tokenize(source):
+    """ Split GraphQL source into (kind, value, offset) tokens.
+    Whitespace, commas and comments are skipped.
+    """
+    tokens = []
+    pos = 0
+    while pos < len(source):
+        match = TOKEN_PATTERN.match(source, pos)
+        if match is None:
+            raise GraphQLSyntaxError(
+                "Unexpected character %r at %d" % (source[pos], pos))
+        kind = match.lastgroup
+        if kind != 'ignored':
+            tokens.append((kind, match.group(), pos))
+        pos = match.end()
+    return tokens
+
+
+class Field(object):
+    """ A field in a selection set
+
+    Attributes:
+        alias (Optional[str]): field alias, if any
+        name (str): field name
+        arguments (List[Tuple[str, str]]): argument names and source text
+            of their values
+        selections (list): nested selections (fields and fragments)
+        variables (Set[str]): names of variables used in the field,
+            including nested selections
+        start, end (int): offsets of the field in the source text
+        body (Optional[int]): offset of the selection set opening brace
+    """
+    __slots__ = ('alias', 'name', 'arguments', 'selections', 'variables',
+                 'start', 'end', 'body')
+
+    def __init__(self, alias, name, arguments, selections, variables,
+                 start, end, body):
+        self.alias = alias
+        self.name = name
+        self.arguments = arguments
+        self.selections = selections
+        self.variables = variables
+        self.start = start
+        self.end = end
+        self.body = body
+
+    @property
+    def key(self):
+        # type: () -> str
+        """ Name of the field in the response """
+        return self.alias or self.name
+
+    def __repr__(self):
+        return '<Field %s>' % self.key
+
+
+class InlineFragment(object):
+    """ `... on Type { selections }`; `type_condition` might be None """
+    __slots__ = ('type_condition', 'selections', 'start', 'end')
+
+    def __init__(self, type_condition, selections, start, end):
+        self.type_condition = type_condition
+        self.selections = selections
+        self.start = start
+        self.end = end
+
+
+class FragmentSpread(object):
+    """ `...FragmentName` """
+    __slots__ = ('name', 'start', 'end')
+
+    def __init__(self, name, start, end):
+        self.name = name
+        self.start = start
+        self.end = end
+
+
+class Operation(object):
+    """ A query, mutation or subscription
+
+    Attributes:
+        kind (str): operation type; 'query' for query shorthand `{ ... }`
+        name (Optional[str]): operation name
+        variables (List[Tuple[str, str]]): variable names and source text
+            of their types
+        selections (list): top level selections
+        body (int): offset of the selection set opening brace
+    """
+    __slots__ = ('kind', 'name', 'variables', 'selections', 'body')
+
+    def __init__(self, kind, name, variables, selections, body):
+        self.kind = kind
+        self.name = name
+        self.variables = variables
+        self.selections = selections
+        self.body = body
+
+
+class Document(object):
+    """ Parsed GraphQL document
+
+    Attributes:
+        source (str): the original query text
+        operations (List[Operation]): operations, in the order of definition
+        fragments (dict): fragment name -> InlineFragment with the fragment
+            type condition and selections
+    """
+
+    def __init__(self, source, operations, fragments):
+        self.source = source
+        self.operations = operations
+        self.fragments = fragments
+
+    @property
+    def operation(self):
+        # type: () -> Operation
+        """ The only operation of the document """
+        if len(self.operations) != 1:
+            raise GraphQLSyntaxError(
+                "Expected exactly one operation, got %d" %
+                len(self.operations))
+        return self.operations[0]
+
+    def fields(self, selections):
+        """ Iterate fields of a selection set, looking into fragments """
+        for selection in selections:
+            if isinstance(selection, Field):
+                yield selection
+            else:
+                if isinstance(selection, FragmentSpread):
+                    selection = self.fragments[selection.name]
+                for field in self.fields(selection.selections):
+                    yield field
+
+    def field(self, selections, key):
+        """ Find a field by its response key in a selection set """
+        for field in self.fields(selections):
+            if field.key == key:
+                return field
+        return None
+
+
+class _Parser(object):
+
+    def __init__(self, source):
+        self.source = source
+        self.tokens = tokenize(source)
+        self.pos = 0
+
+    def peek(self, value=None):
+        if self.pos >= len(self.tokens):
+            return None
+        token = self.tokens[self.pos]
+        if value is not None and token[1] != value:
+            return None
+        return token
+
+    def next(self, value=None, kind=None):
+        token = self.peek()
+        if token is None or (value is not None and token[1] != value) \
+                or (kind is not None and token[0] != kind):
+            raise GraphQLSyntaxError("Expected %s at %s, got %s" % (
+                value or kind, token and token[2], token and token[1]))
+        self.pos += 1
+        return token
+
+    def end_offset(self):
+        """ Offset right after the last consumed token """
+        kind, value, offset = self.tokens[self.pos - 1]
+        return offset + len(value)
+
+    def skip_value(self):
+        """ Skip a value (possibly nested), return variables used in it """
+        token = self.next()
+        if token[1] == '$':
+            return {self.next(kind='name')[1]}
+        variables = set()
+        closing = {'[': ']', '{': '}'}.get(token[1])
+        if closing is not None:
+            while not self.peek(closing):
+                if token[1] == '{':  # object field name
+                    self.next(kind='name')
+                    self.next(':')
+                variables |= self.skip_value()
+            self.next(closing)
+        return variables
+
+    def arguments(self):
+        arguments, variables = [], set()
+        if self.peek('('):
+            self.next('(')
+            while not self.peek(')'):
+                name = self.next(kind='name')[1]
+                self.next(':')
+                start = self.peek()[2]
+                variables |= self.skip_value()
+                arguments.append((name, self.source[start:self.end_offset()]))
+            self.next(')')
+        return arguments, variables
+
+    def directives(self):
+        variables = set()
+        while self.peek('@'):
+            self.next('@')
+            self.next(kind='name')
+            variables |= self.arguments()[1]
+        return variables
+
+    def selection_set(self):
+        """ Parse a selection set, return (selections, variables) """
+        self.next('{')
+        selections, variables = [], set()
+        while not self.peek('}'):
+            start = self.peek()
+            if start is None:
+                raise GraphQLSyntaxError("Unexpected end of query")
+            if start[1] == '...':
+                self.next()
+                if self.peek() and self.peek()[0] == 'name' \
+                        and not self.peek('on'):
+                    name = self.next()[1]
+                    variables |= self.directives()
+                    selections.append(FragmentSpread(
+                        name, start[2], self.end_offset()))
+                    continue
+                type_condition = None
+                if self.peek('on'):
+                    self.next()
+                    type_condition = self.next(kind='name')[1]
+                variables |= self.directives()
+                nested, nested_variables = self.selection_set()
+                variables |= nested_variables
+                selections.append(InlineFragment(
+                    type_condition, nested, start[2], self.end_offset()))
+                continue
+
+            alias, name = None, self.next(kind='name')[1]
+            if self.peek(':'):
+                self.next()
+                alias, name = name, self.next(kind='name')[1]
+            arguments, field_variables = self.arguments()
+            field_variables |= self.directives()
+            nested, body = [], None
+            if self.peek('{'):
+                body = self.peek()[2]
+                nested, nested_variables = self.selection_set()
+                field_variables |= nested_variables
+            variables |= field_variables
+            selections.append(Field(
+                alias, name, arguments, nested, field_variables,
+                start[2], self.end_offset(), body))
+        self.next('}')
+        return selections, variables
+
+    def type_reference(self):
+        start = self.peek()[2]
+        if self.peek('['):
+            self.next()
+            self.type_reference()
+            self.next(']')
+        else:
+            self.next(kind='name')
+        if self.peek('!'):
+            self.next()
+        return self.source[start:self.end_offset()]
+
+    def variable_definitions(self):
+        definitions = []
+        if self.peek('('):
+            self.next('(')
+            while not self.peek(')'):
+                self.next('$')
+                name = self.next(kind='name')[1]
+                self.next(':')
+                definitions.append((name, self.type_reference()))
+                if self.peek('='):
+                    self.next()
+                    self.skip_value()
+                self.directives()
+            self.next(')')
+        return definitions
+
+    def document(self):
+        operations, fragments = [], {}
+        while self.peek() is not None:
+            if self.peek('{'):
+                body = self.peek()[2]
+                operations.append(Operation(
+                    'query', None, [], self.selection_set()[0], body))
+                continue
+            kind = self.next(kind='name')[1]
+            if kind == 'fragment':
+                start = self.tokens[self.pos - 1][2]
+                name = self.next(kind='name')[1]
+                self.next('on')
+                type_condition = self.next(kind='name')[1]
+                self.directives()
+                selections = self.selection_set()[0]
+                fragments[name] = InlineFragment(
+                    type_condition, selections, start, self.end_offset())
+            elif kind in ('query', 'mutation', 'subscription'):
+                name = None
+                if self.peek() and self.peek()[0] == 'name':
+                    name = self.next()[1]
+                variables = self.variable_definitions()
+                self.directives()
+                body = self.peek('{') and self.peek()[2]
+                operations.append(Operation(
+                    kind, name, variables, self.selection_set()[0], body))
+            else:
+                raise GraphQLSyntaxError("Unexpected definition " + kind)
+        return Document(self.source, operations, fragments)
+
+
+def parse(source):
+    # type: (str) -> Document
+    """ Parse a GraphQL document
+
+    Raises:
+        GraphQLSyntaxError: if the document is not valid GraphQL
+    """
+    return _Parser(source).document()
+
+
+class QueryInfo(object):
+    """ Results of query analysis, see `analyze()`
+
+    Attributes:
+        document (Optional[Document]): parsed query; None if the query
+            could not be parsed
+        object_path (Tuple[str]): response keys of the object to return
+        paginated (bool): whether the object is a connection with `pageInfo`
+        cursor (str): name of the variable used as `after` argument of the
+            connection; 'cursor' if it can't be determined
+        nodes (Optional[Field]): `nodes` (or `edges.node`) field of the
+            connection
+        nested (Tuple[str]): response keys of paginated connections
+            inside the connection nodes
+    """
+    __slots__ = ('document', 'object_path', 'paginated', 'cursor', 'nodes',
+                 'nested')
+
+    def __init__(self, document, object_path, paginated, cursor='cursor',
+                 nodes=None, nested=()):
+        self.document = document
+        self.object_path = object_path
+        self.paginated = paginated
+        self.cursor = cursor
+        self.nodes = nodes
+        self.nested = nested
+
+
+def _find_object_path(document, selections):
+    """ Descend into the only field of selection sets until the object
+    has multiple fields or is a list of nodes """
+    # rate limit info is not a part of the result
+    fields = [field for field in document.fields(selections)
+              if field.name != 'rateLimit']
+    path = []
+    while True:
+        if len(fields) != 1 or not fields[0].selections \
+                or fields[0].key in ('nodes', 'edges'):
+            return tuple(path)
+        path.append(fields[0].key)
+        fields = list(document.fields(fields[0].selections))
+
+
+def _analyze(query, object_path):
+    try:
+        document = parse(query)
+        operation = document.operation
+    except GraphQLSyntaxError:
+        return QueryInfo(None, tuple(object_path or ()), 'pageInfo' in query)
+
+    if object_path is None:
+        object_path = _find_object_path(document, operation.selections)
+    object_path = tuple(object_path)
+    field, selections = None, operation.selections
+    for key in object_path:
+        field = document.field(selections, key)
+        if field is None:  # not a path to a field, e.g. a typo
+            return QueryInfo(document, object_path, 'pageInfo' in query)
+        selections = field.selections
+
+    if field is None or document.field(selections, 'pageInfo') is None:
+        return QueryInfo(document, object_path, False)
+    cursor = dict(field.arguments).get('after', '')
+    nodes = document.field(selections, 'nodes')
+    edges = document.field(selections, 'edges')
+    if nodes is None and edges is not None:
+        nodes = document.field(edges.selections, 'node')
+    nested = ()
+    if nodes is not None:
+        nested = tuple(
+            nested_field.key for nested_field in document.fields(
+                nodes.selections)
+            if document.field(nested_field.selections, 'pageInfo'))
+    return QueryInfo(
+        document, object_path, True,
+        cursor[1:] if cursor.startswith('$') else 'cursor', nodes, nested)
+
+
+# (query, object_path) -> QueryInfo
+_analyzed = {}
+# max number of distinct queries to keep the analysis of
+MAX_ANALYZED = 1000
+
+
+def analyze(query, object_path=None):
+    # type: (str, Optional[Iterable[str]]) -> QueryInfo
+    """ Find the object to return, pagination and nested connections
+
+    Args:
+        query (str): GraphQL query
+        object_path (Optional[Iterable[str]]): response keys of the object
+            to return. If omitted, it is the first object with more than
+            one field or a list of nodes, e.g. `('user', 'followers')` in
+            `query { user(login: "a") { followers(first: 100) {...} } }`
+
+    Results are memoized, so repeated calls with the same query are cheap.
+
+    >>> info = analyze('''query ($user: String!, $after: String) {
+    ...     user(login: $user) { followers(first: 100, after: $after) {
+    ...         nodes { login } pageInfo { endCursor, hasNextPage }}}}''')
+    >>> info.object_path, info.paginated, info.cursor
+    (('user', 'followers'), True, 'after')
+    """
+    key = (query, None if object_path is None else tuple(object_path))
+    info = _analyzed.get(key)
+    if info is None:
+        info = _analyze(query, object_path)
+        if len(_analyzed) >= MAX_ANALYZED:
+            _analyzed.clear()
+        _analyzed[key] = info
+    return info
@@ -0,0 +1,214 @@
+""" Metrics of API usage.
+
+Attach a registry to an API object to collect counters and histograms
+of requests made through it:
+
+>>> from stscraper import GitHubAPI
+>>> from stscraper.metrics import MetricsRegistry
+>>> api = GitHubAPI()
+>>> api.metrics = MetricsRegistry()
+>>> api.metrics.serve(9090)  # Prometheus endpoint at :9090/metrics
+
+Collected metrics (all prefixed with `stscraper_`):
+
+- `requests_total{api_class, endpoint, status}`: responses received
+- `request_seconds{api_class}`: histogram of response latency
+- `response_bytes_total{api_class}`: size of response bodies
+- `retries_total{reason}`: requests retried because of connection errors,
+  server errors, rate limits or parked tokens
+- `cache_hits_total{cache}`: requests served by ETag (304 responses) or
+  response cache
+- `coalesced_total`: requests served by an identical concurrent request
+- `token_remaining{token, api_class}`: remaining quota of every token
+- `blocked_seconds_total`: time spent waiting for exhausted tokens
+
+Any object with the same `inc()`, `set()` and `observe()` methods can be
+used instead, e.g. an adapter to `prometheus_client` or statsd.
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import os
+import threading
+
+from six.moves import BaseHTTPServer
+
+# token labels used in metrics, e.g. '...a1b2'
+from .base import _mask_token as mask_token  # noqa: F401
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+DESCRIPTIONS = {
+    'requests_total': 'Responses received from the API',
+    'request_seconds': 'Response latency',
+    'response_bytes_total': 'Size of response bodies',
+    'retries_total': 'Retried requests by reason',
+    'cache_hits_total': 'Requests served from cache',
+    'coalesced_total': 'Requests served by a concurrent identical request',
+    'token_remaining': 'Remaining rate limit quota of tokens',
+    'blocked_seconds_total': 'Time spent waiting for tokens to reset',
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, _escape(value)) for key, value in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Histogram(object):
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry(object):
+    """ Thread-safe in-memory collection of counters, gauges and histograms
+
+    Metrics are identified by name and a set of labels and are created on
+    the first use. Histograms use the same `buckets` (in seconds).
+
+    Args:
+        prefix (str): prefix of metric names in the exported data
+        buckets (Iterable[float]): upper bounds of histogram buckets
+    """
+
+    def __init__(self, prefix='stscraper_', buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # name -> (type, {sorted labels tuple: value or _Histogram})
+        self._metrics = {}
+
+    def _series(self, name, metric_type):
+        if name not in self._metrics:
+            self._metrics[name] = (metric_type, {})
+        elif self._metrics[name][0] != metric_type:
+            raise ValueError("%s is a %s, not %s" % (
+                name, self._metrics[name][0], metric_type))
+        return self._metrics[name][1]
+
+    def inc(self, name, value=1, **labels):
+        """ Increase a counter """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series(name, 'counter')
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """ Set value of a gauge """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._series(name, 'gauge')[key] = value
+
+    def observe(self, name, value, **labels):
+        """ Add an observation to a histogram """
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series(name, 'histogram')
+            if key not in series:
+                series[key] = _Histogram(self.buckets)
+            series[key].observe(value)
+
+    def get(self, name, **labels):
+        """ Get the current value of a counter or a gauge, or the number of
+        observations of a histogram. Returns 0 for unknown metrics.
+        """
+        with self._lock:
+            if name not in self._metrics:
+                return 0
+            value = self._metrics[name][1].get(
+                tuple(sorted(labels.items())), 0)
+        return value.count if isinstance(value, _Histogram) else value
+
+    def render(self):
+        # type: () -> str
+        """ Export all metrics in Prometheus text format """
+        lines = []
+        with self._lock:
+            for name in sorted(self._metrics):
+                metric_type, series = self._metrics[name]
+                full_name = self.prefix + name
+                if name in DESCRIPTIONS:
+                    lines.append('# HELP %s %s' % (
+                        full_name, DESCRIPTIONS[name]))
+                lines.append('# TYPE %s %s' % (full_name, metric_type))
+                for labels, value in sorted(series.items()):
+                    if metric_type != 'histogram':
+                        lines.append('%s%s %s' % (
+                            full_name, _format_labels(labels),
+                            _format_value(value)))
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(
+                            self.buckets + (float('inf'),), value.counts):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (
+                            full_name, _format_labels(
+                                labels, [('le', _format_value(bound))]),
+                            cumulative))
+                    lines.append('%s_sum%s %s' % (
+                        full_name, _format_labels(labels),
+                        _format_value(value.sum)))
+                    lines.append('%s_count%s %d' % (
+                        full_name, _format_labels(labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        """ Write metrics to a file, e.g. for node_exporter textfile
+        collector. The file is replaced atomically.
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            fh.write(self.render())
+        # unlike os.rename, os.replace (Python 3) also overwrites on Windows
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+
+    def serve(self, port=9090, host='127.0.0.1'):
+        """ Serve metrics over HTTP in a background thread
+
+        Returns:
+            HTTPServer: the server; call `.shutdown()` to stop it
+        """
+        registry = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                payload = registry.render().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
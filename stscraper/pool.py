@@ -0,0 +1,262 @@
+""" Fan-out of API calls over multiple processes.
+
+API objects are singletons, so they can only be used from multiple threads
+of the same process. For long lists of repositories it is often the
+decoding and transformation of responses, rather than the network, that
+becomes the bottleneck. `run()` distributes calls over a pool of worker
+processes, each running several threads, while sharing rate limits of
+tokens between all processes:
+
+>>> from stscraper import pool
+>>> for slug, commits in pool.run('repo_commits', slugs, processes=8):
+...     if isinstance(commits, Exception):
+...         continue  # e.g. stscraper.RepoDoesNotExist
+...     process(commits)
+
+Results of paginated methods are collected into lists in worker processes,
+so they should fit in memory.
+"""
+
+from __future__ import absolute_import
+
+import inspect
+import itertools
+import multiprocessing
+from multiprocessing.managers import BaseManager
+import pickle
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+from .base import TokenScheduler, VCSError
+from .github import GitHubAPI
+
+
+class LimitsStore(object):
+    """ Rate limits of all tokens, kept in a manager process,
+    see `LimitsManager`.
+
+    Keys are (token, api_class) tuples. Every method is atomic and, when
+    called through a manager proxy, takes a single round trip.
+    """
+
+    def __init__(self):
+        self._limits = {}
+        # the manager serves every client in a separate thread
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        return self._limits.get(key, default)
+
+    def set(self, key, limits):
+        with self._lock:
+            self._limits[key] = limits
+
+    def setdefaults(self, items):
+        """ Set limits of the keys which don't have them yet """
+        with self._lock:
+            for key, limits in items.items():
+                self._limits.setdefault(key, limits)
+
+    def consume(self, key, amount=1):
+        """ Reduce the estimated number of remaining requests
+
+        Returns:
+            bool: False if the quota left is known to be less than `amount`
+                (e.g. it was spent by other processes), True otherwise
+        """
+        with self._lock:
+            limits = self._limits.get(key) or {}
+            remaining, reset = limits.get('remaining'), limits.get('reset')
+            # unknown quota, or a new rate limit window
+            if remaining is None or (reset is not None
+                                     and reset <= time.time()):
+                return True
+            if remaining < amount:
+                return False
+            self._limits[key] = dict(limits, remaining=remaining - amount)
+            return True
+
+
+class LimitsManager(BaseManager):
+    """ A manager serving `LimitsStore()` proxies, e.g.:
+
+    >>> manager = LimitsManager()
+    >>> manager.start()
+    >>> store = manager.LimitsStore()
+    """
+
+
+LimitsManager.register('LimitsStore', LimitsStore)
+
+
+class SharedLimits(object):
+    """ Rate limits of a token shared between processes.
+
+    This is a drop-in replacement for the `APIToken.limits` dictionary,
+    `{api_class: {'remaining': .., 'reset': .., 'limit': ..}}`, keeping the
+    actual values in a `LimitsStore` served by `LimitsManager`. So, once
+    one process learns from a response that a token is exhausted, all
+    others stop using it.
+
+    Args:
+        store (LimitsStore): a `LimitsManager().LimitsStore()` proxy
+            shared by all processes
+        token (str): token value, used as a part of the keys in `store`
+        defaults (dict): initial limits, used unless other process
+            has already set them
+    """
+
+    def __init__(self, store, token, defaults):
+        self._store = store
+        self._token = token
+        self._api_classes = list(defaults)
+        store.setdefaults({(token, api_class): limits
+                           for api_class, limits in defaults.items()})
+
+    def __getitem__(self, api_class):
+        limits = self._store.get((self._token, api_class))
+        if limits is None:
+            raise KeyError(api_class)
+        return limits
+
+    def __setitem__(self, api_class, limits):
+        if api_class not in self._api_classes:
+            self._api_classes.append(api_class)
+        self._store.set((self._token, api_class), limits)
+
+    def __contains__(self, api_class):
+        return api_class in self._api_classes
+
+    def __iter__(self):
+        return iter(self._api_classes)
+
+    def get(self, api_class, default=None):
+        return self._store.get((self._token, api_class), default)
+
+    def keys(self):
+        return list(self._api_classes)
+
+    def items(self):
+        return [(api_class, self[api_class]) for api_class in self]
+
+    def consume(self, api_class, amount=1):
+        """ Reduce the estimated number of remaining requests,
+        see `LimitsStore.consume()` """
+        return self._store.consume((self._token, api_class), amount)
+
+
+class SharedTokenScheduler(TokenScheduler):
+    """ Token scheduler accounting for requests made by other processes.
+
+    Every token given out reduces the shared estimate of its remaining
+    quota, so schedulers in other processes see that the quota was spent
+    and move the token down the heap (see `TokenScheduler.acquire()`).
+    If the quota was spent by other processes after the token was chosen,
+    another one is chosen. Tokens are expected to have `SharedLimits`.
+    """
+
+    def acquire(self, url="", cost=1):
+        while True:
+            token, resume_at = super(SharedTokenScheduler, self).acquire(
+                url, cost)
+            if token is None or not isinstance(token.limits, SharedLimits) \
+                    or token.limits.consume(token.api_class(url), cost):
+                return token, resume_at
+
+
+# state of a worker process, set by _init_worker()
+_worker = {}
+
+
+def _init_worker(api_class, tokens, timeout, store, threads):
+    # tokens were validated by the parent process. Also, with fork start
+    # method the parent instance (with its connections) is inherited,
+    # and a subclass gets a singleton of its own
+    api_class = type(api_class.__name__, (api_class,), {
+        '_instance': None, 'validate_tokens': False})
+    api = api_class([token for token, _ in tokens], timeout=timeout)
+    limits = dict(tokens)
+    for token in api.tokens:
+        token.limits = SharedLimits(store, str(token), limits[token.token])
+    api.scheduler = SharedTokenScheduler(api.tokens)
+    _worker['api'] = api
+    _worker['threads'] = ThreadPool(threads)
+
+
+def _picklable(error):
+    """ Make sure the exception can be sent back to the parent process """
+    try:
+        pickle.loads(pickle.dumps(error))
+    except Exception:
+        return VCSError(repr(error))
+    return error
+
+
+def _call_chunk(task):
+    method_name, transform, chunk = task
+    method = getattr(_worker['api'], method_name)
+
+    def call(item):
+        try:
+            result = method(*item) if isinstance(item, tuple) \
+                else method(item)
+            if inspect.isgenerator(result):
+                result = list(result)
+            if transform is not None:
+                result = transform(result)
+        except Exception as e:
+            result = _picklable(e)
+        return item, result
+
+    return _worker['threads'].map(call, chunk)
+
+
+def run(method_name, items, processes=None, threads=8, tokens=None,
+        api_class=GitHubAPI, timeout=30, transform=None, chunk_size=None):
+    """ Call an API method for every item using a pool of processes
+
+    Args:
+        method_name (str): name of the API method, e.g. 'repo_info'
+        items (Iterable): method arguments, e.g. repository slugs.
+            Tuples are unpacked into multiple arguments,
+            e.g. `('user/repo', 42)` for `issue_comments`
+        processes (Optional[int]): number of worker processes,
+            the number of CPUs by default
+        threads (int): number of threads making requests in every process
+        tokens (Optional[Union[str, list]]): API tokens, see `VCSAPI`
+        api_class (type): API class, e.g. `GitHubAPI` or `GitHubAPIv4`
+        timeout (int): request timeout, seconds
+        transform (Optional[callable]): function to apply to the results
+            in worker processes, e.g. to reduce the amount of data sent
+            back. It has to be picklable, i.e. defined at a module level
+        chunk_size (Optional[int]): number of items sent to a worker
+            process at once, `threads` by default
+
+    Yields:
+        Tuple[Any, Any]: item and the method result, or the exception it
+            raised, in the order of completion
+    """
+    chunk_size = chunk_size or threads
+    items = iter(items)
+    chunks = iter(lambda: list(itertools.islice(items, chunk_size)), [])
+    tasks = ((method_name, transform, chunk) for chunk in chunks)
+
+    # validate tokens once, rather than in every worker
+    api = api_class(tokens, timeout=timeout)
+    tokens = [(token.token, dict(token.limits)) for token in api.tokens]
+
+    manager = LimitsManager()
+    manager.start()
+    pool = None
+    try:
+        pool = multiprocessing.Pool(processes, _init_worker, (
+            api_class, tokens, timeout, manager.LimitsStore(), threads))
+        for results in pool.imap_unordered(_call_chunk, tasks):
+            for item, result in results:
+                yield item, result
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        manager.shutdown()
@@ -0,0 +1,138 @@
+""" Simple persistent key-value stores.
+
+These are used to keep scraping state between runs, e.g. pagination
+checkpoints (`VCSAPI.checkpoints`). Values must be JSON-serializable.
+
+>>> store = JSONFileStore('checkpoints.json')
+>>> store.set('key', 42)
+>>> store.get('key')
+42
+>>> dict(store.items())
+{'key': 42}
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import sqlite3
+import threading
+
+
+class KeyValueStore(object):
+    """ An abstract key-value store.
+    All implementations are expected to be thread-safe.
+    """
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Remove the key. Does nothing if it doesn't exist """
+        raise NotImplementedError
+
+    def items(self, prefix=''):
+        """ Get a list of (key, value) pairs with keys starting with prefix """
+        raise NotImplementedError
+
+    def clear(self, prefix=''):
+        """ Remove all keys starting with prefix """
+        for key, _ in self.items(prefix):
+            self.delete(key)
+
+
+class MemoryStore(KeyValueStore):
+    """ Non-persistent store, mostly useful for testing """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def items(self, prefix=''):
+        with self._lock:
+            return [(k, v) for k, v in self._data.items()
+                    if k.startswith(prefix)]
+
+
+class JSONFileStore(MemoryStore):
+    """ Store keeping all data in a JSON file.
+
+    The whole file is rewritten on every change, so it is only suitable for
+    relatively small amounts of data, e.g. a few thousand keys.
+    """
+
+    def __init__(self, path):
+        super(JSONFileStore, self).__init__()
+        self.path = path
+        if os.path.isfile(path):
+            with open(path) as fh:
+                self._data = json.load(fh)
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            json.dump(self._data, fh, indent=2, sort_keys=True)
+        # atomic on POSIX, so the file is never left half-written;
+        # unlike os.rename, os.replace (Python 3) also overwrites on Windows
+        getattr(os, 'replace', os.rename)(tmp_path, self.path)
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._save()
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+                self._save()
+
+
+class SQLiteStore(KeyValueStore):
+    """ Store keeping data in a SQLite database """
+
+    def __init__(self, path, table='store'):
+        self.table = table
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS %s ('
+                             '  key TEXT PRIMARY KEY, value TEXT)' % table)
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value FROM %s WHERE key=?' % self.table,
+                (key,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set(self, key, value):
+        with self._lock, self._db:
+            self._db.execute('REPLACE INTO %s VALUES (?, ?)' % self.table,
+                             (key, json.dumps(value)))
+
+    def delete(self, key):
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM %s WHERE key=?' % self.table,
+                             (key,))
+
+    def items(self, prefix=''):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT key, value FROM %s WHERE substr(key, 1, ?) = ?'
+                % self.table, (len(prefix), prefix)).fetchall()
+        return [(key, json.loads(value)) for key, value in rows]
@@ -1,13 +1,68 @@
 #!/usr/bin/env python
 
+import copy
+import json
+import socket
+import sys
+import time
 from typing import Generator
 import unittest
 
+import requests
+import six
+
 import stscraper
+from stscraper import coordinator, metrics, pool
+from stscraper.fakeserver import FakeGitHub
+
+
+class FakeGitHubToken(stscraper.GitHubAPIToken):
+    api_url = None  # set to the fake server url in tests
+
+
+class FakeGitHubAPI(stscraper.GitHubAPI):
+    token_class = FakeGitHubToken
+
+
+class FakeServerTestCase(unittest.TestCase):
+    api_class = FakeGitHubAPI
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeGitHub()
+        FakeGitHubToken.api_url = cls.server.url
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.log = []
+        # reset the singleton so tokens don't leak between tests
+        self.api_class._instance = None
+        self.api = self.api_class('token1,token2')
 
 
 class TestBase(unittest.TestCase):
 
+    def test_compile_mapping(self):
+        mapping = {'author': 'author__name', 'email': 'author__email',
+                   'committer': 'committer__name', 'missing': 'a__b__c',
+                   'labels': 'labels__,name', 'sha': 'sha'}
+        compiled = stscraper.compile_mapping(mapping)
+        objects = (
+            {'author': {'name': 'John'}, 'committer': None, 'sha': '123',
+             'labels': [{'name': 'Bug'}, {'name': 'Good first issue'}]},
+            {'author': {}, 'labels': [], 'a': {'b': None}},
+            # unexpected types are handled by falling back to json_map
+            {'author': ['John'], 'labels': []},
+        )
+        for obj in objects:
+            self.assertEqual(compiled(obj), stscraper.json_map(mapping, obj))
+        self.assertEqual(list(compiled.map_many(objects)),
+                         [stscraper.json_map(mapping, obj) for obj in objects])
+
     def test_add_keys(self):
         api = stscraper.VCSAPI('key1,key2,key1')
         self.assertEqual(len(api.tokens), 2)
@@ -15,6 +70,1182 @@ class TestBase(unittest.TestCase):
         self.assertTrue(api2 is api)
         self.assertEqual(len(api.tokens), 4)
 
+    @unittest.skipIf(sys.version_info < (3, 7), "requires PEP 562")
+    def test_lazy_import(self):
+        import subprocess
+        code = ("import sys, stscraper\n"
+                "assert 'requests' not in sys.modules\n"
+                "assert stscraper.GitHubAPI.__module__ == 'stscraper.github'\n"
+                "from stscraper import *\n"
+                "assert GitHubAPIv4 and TokenScheduler\n"
+                "assert 'requests' in sys.modules\n")
+        subprocess.check_call([sys.executable, '-c', code])
+        self.assertIn('GitHubAPI', dir(stscraper))
+        self.assertRaises(AttributeError, getattr, stscraper, 'NoSuchThing')
+
+
+class TestPagination(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.commits = [{'sha': str(i)} for i in range(9)]
+        self.server.paginated('repos/a/b/commits', self.commits)
+
+    def test_sequential(self):
+        self.assertEqual(list(self.api.repo_commits('a/b')), self.commits)
+
+    def test_prefetch(self):
+        self.api.prefetch = 3
+        try:
+            self.assertEqual(list(self.api.repo_commits('a/b')), self.commits)
+        finally:
+            del self.api.prefetch
+        pages = sorted(int(params['page']) for method, path, params
+                       in self.server.log if path == 'repos/a/b/commits')
+        self.assertEqual(pages, [1, 2, 3, 4, 5])
+
+    def test_prefetch_partial(self):
+        items = self.api.request(
+            'repos/a/b/commits', paginate=True, prefetch=2)
+        self.assertEqual([next(items) for _ in range(3)], self.commits[:3])
+        items.close()
+
+
+class TestETagCache(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.version = 1
+
+        def route(params, headers):
+            etag = '"v%d"' % self.version
+            if headers.get('If-None-Match') == etag:
+                return 304, {'ETag': etag}, None
+            return 200, {'ETag': etag}, {'version': self.version}
+        self.server.routes['repos/a/b'] = route
+
+    def tearDown(self):
+        self.api.etag_cache = None
+
+    def test_revalidation(self):
+        from stscraper.cache import ETagCache
+        cache = self.api.etag_cache = ETagCache()
+        self.assertEqual(self.api.repo_info('a/b'), {'version': 1})
+        self.assertEqual(self.api.repo_info('a/b'), {'version': 1})
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1})
+
+        self.version = 2
+        self.assertEqual(self.api.repo_info('a/b'), {'version': 2})
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 2})
+
+    def test_disabled(self):
+        calls = []
+        call = FakeGitHubToken.__call__
+
+        def record(token, url, **kwargs):
+            calls.append(kwargs['headers'])
+            return call(token, url, **kwargs)
+
+        FakeGitHubToken.__call__ = record
+        try:
+            self.assertEqual(self.api.repo_info('a/b'), {'version': 1})
+        finally:
+            FakeGitHubToken.__call__ = call
+        self.assertEqual(calls, [None])
+
+    def test_persistence(self):
+        import os
+        import tempfile
+        from stscraper.cache import ETagCache
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        try:
+            self.api.etag_cache = ETagCache(path)
+            self.api.repo_info('a/b')
+            cache = self.api.etag_cache = ETagCache(path)
+            self.assertEqual(self.api.repo_info('a/b'), {'version': 1})
+            self.assertEqual(cache.hits, 1)
+        finally:
+            os.remove(path)
+
+
+class TestResponseCache(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        from stscraper.cache import ResponseCache
+        self.cache = self.api.response_cache = ResponseCache(
+            ttl=60, ttls={'repos/*/*/topics': 0})
+        self.server.routes['repos/a/b'] = lambda params, headers: (
+            200, {}, {'full_name': 'a/b', 'size': 'x' * 1000})
+        self.server.routes['repos/a/b/topics'] = lambda params, headers: (
+            200, {}, {'names': ['a', 'b']})
+
+    def tearDown(self):
+        self.api.response_cache = None
+
+    def _requests(self, path):
+        return len([p for _, p, _ in self.server.log if p == path])
+
+    def test_cache(self):
+        for _ in range(3):
+            self.assertEqual(self.api.repo_info('a/b')['full_name'], 'a/b')
+            self.api.repo_topics('a/b')
+        self.assertEqual(self._requests('repos/a/b'), 1)
+        # ttl=0 disables caching for this endpoint
+        self.assertEqual(self._requests('repos/a/b/topics'), 3)
+        self.assertEqual(self.cache.hits, 2)
+
+    def test_errors(self):
+        errors = {'errors': [{'type': 'RATE_LIMITED'}]}
+        self.server.routes['graphql'] = lambda params, headers: (
+            200, {}, errors)
+        for _ in range(2):
+            self.assertEqual(next(self.api.request(
+                'graphql', 'post', data='{"query": "{}"}')), errors)
+        # GraphQL errors are returned with status 200, but not cached
+        self.assertEqual(self._requests('graphql'), 2)
+
+    def test_expiration(self):
+        self.cache.ttl = -1
+        self.api.repo_info('a/b')
+        self.cache.ttl = 60
+        self.api.repo_info('a/b')
+        self.assertEqual(self._requests('repos/a/b'), 2)
+
+    def test_eviction(self):
+        self.cache.max_bytes = 1500
+        self.server.routes['repos/a/c'] = self.server.routes['repos/a/b']
+        self.api.repo_info('a/b')
+        self.api.repo_info('a/c')  # evicts a/b
+        self.assertLessEqual(self.cache.stats()['memory_bytes'], 1500)
+        self.api.repo_info('a/b')
+        self.assertEqual(self._requests('repos/a/b'), 2)
+
+    def test_disk(self):
+        import os
+        import tempfile
+        from stscraper.cache import ResponseCache
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        try:
+            self.api.response_cache = ResponseCache(path=path)
+            self.api.repo_info('a/b')
+            self.api.response_cache = ResponseCache(path=path)
+            self.api.repo_info('a/b')
+            self.assertEqual(self._requests('repos/a/b'), 1)
+        finally:
+            os.remove(path)
+
+
+class FakeGitHubAPIv4(stscraper.GitHubAPIv4):
+    token_class = FakeGitHubToken
+
+
+class TestBatchQueries(FakeServerTestCase):
+    api_class = FakeGitHubAPIv4
+    max_aliases = 3
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.server.routes['graphql'] = self._graphql
+
+    def _graphql(self, params, headers):
+        import re
+        query = params['_body']['query']
+        variables = params['_body']['variables']
+        aliases = re.findall(r'\b(r\d+): (repository|user)\b', query)
+        if len(aliases) > self.max_aliases:
+            return 200, {}, {'errors': [{
+                'type': 'MAX_NODE_LIMIT_EXCEEDED',
+                'message': 'Query has complexity of 5000'}]}
+        data, errors = {}, []
+        for alias, kind in aliases:
+            i = alias[1:]
+            if kind == 'user':
+                login = variables['login' + i]
+                data[alias] = {'login': login}
+            else:
+                login = variables['owner' + i]
+                data[alias] = {'nameWithOwner': '%s/%s' % (
+                    login, variables['name' + i])}
+            if login == 'missing':
+                data[alias] = None
+                errors.append({'type': 'NOT_FOUND', 'path': [alias]})
+        res = {'data': data}
+        if errors:
+            res['errors'] = errors
+        return 200, {}, res
+
+    def _queries(self):
+        return len([p for _, p, _ in self.server.log if p == 'graphql'])
+
+    def test_repos_info(self):
+        slugs = ['a/b', 'missing/c', 'd/e']
+        self.assertEqual(list(self.api.repos_info(slugs, batch_size=10)), [
+            {'nameWithOwner': 'a/b'}, None, {'nameWithOwner': 'd/e'}])
+        self.assertEqual(self._queries(), 1)
+
+    def test_users_info(self):
+        logins = ['u%d' % i for i in range(7)]
+        users = list(self.api.users_info(iter(logins), batch_size=3))
+        self.assertEqual([u['login'] for u in users], logins)
+        self.assertEqual(self._queries(), 3)
+
+    def test_split(self):
+        logins = ['u%d' % i for i in range(8)]
+        users = list(self.api.users_info(logins, batch_size=8))
+        self.assertEqual([u['login'] for u in users], logins)
+        # one failed query of 8 and then 2 batches of 4, then 4 batches of 2
+        self.assertEqual(self._queries(), 7)
+
+
+class TestNestedPages(FakeServerTestCase):
+    api_class = FakeGitHubAPIv4
+    query = """query ($owner: String!, $name: String!, $cursor: String,
+                      $labels: Int) {
+        repository(owner: $owner, name: $name) {
+            issues(first: 100, after: $cursor) {
+                nodes { number
+                    labels(first: $labels) { totalCount }
+                    ... on Issue { comments(first: 2) {
+                        nodes { body } pageInfo { endCursor hasNextPage }}}
+                }
+                pageInfo { endCursor hasNextPage }
+        }}}"""
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.server.routes['graphql'] = self._graphql
+        self.comments = {'I%d' % i: [{'body': '%d.%d' % (i, j)}
+                                     for j in range(i * 2)]
+                         for i in range(4)}
+        self.api.nested_pages = True
+        self.api.nested_batch_size = 2
+
+    def _page(self, node_id, cursor):
+        start = int(cursor or 0)
+        comments = self.comments[node_id]
+        return {'nodes': comments[start:start + 2], 'pageInfo': {
+            'endCursor': str(start + 2),
+            'hasNextPage': start + 2 < len(comments)}}
+
+    def _graphql(self, params, headers):
+        import re
+        query = params['_body']['query']
+        variables = params['_body']['variables']
+        if 'repository' in query:
+            nodes = [{'number': i, 'stscraperNodeId': 'I%d' % i,
+                      'stscraperNodeType': 'Issue',
+                      'labels': {'totalCount': variables['labels']},
+                      'comments': self._page('I%d' % i, None)}
+                     for i in range(4)]
+            return 200, {}, {'data': {'repository': {'issues': {
+                'nodes': nodes, 'pageInfo': {'hasNextPage': False}}}}}
+        self.assertNotIn('$labels', query)
+        data = {}
+        for i in re.findall(r'\bn(\d+): node\(id: \$nodeId\1\) '
+                            r'{ \.\.\. on Issue { comments\(', query):
+            data['n' + i] = {'comments': self._page(
+                variables['nodeId' + i], variables['nodeCursor' + i])}
+        return 200, {}, {'data': data}
+
+    def test_nested_pages(self):
+        issues = list(self.api.v4(self.query, owner='a', name='b', labels=5))
+        self.assertEqual([issue['comments']['nodes'] for issue in issues],
+                         [self.comments['I%d' % i] for i in range(4)])
+        self.assertEqual(issues[1], {
+            'number': 1, 'labels': {'totalCount': 5},
+            'comments': {'nodes': self.comments['I1'], 'pageInfo': {
+                'endCursor': '2', 'hasNextPage': False}}})
+        # I2 and I3 need 1 and 2 more pages, in batches of 2
+        self.assertEqual(self.server.requests_to('graphql'), 3)
+
+
+class TestSearch(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.server.routes['search/repositories'] = self._search
+        # 5 repos a day in Jan 2020, plus 12 created at the same second
+        start = 1577836800  # 2020-01-01
+        self.repos = [{'id': i, 'created': start + i * 86400 // 5}
+                      for i in range(155)]
+        self.repos += [{'id': 1000 + i, 'created': start + 100}
+                       for i in range(12)]
+        self.api.search_limit = 10
+        self.api.search_per_page = 5
+
+    def _search(self, params, headers):
+        import calendar
+        import re
+        low, high = (
+            calendar.timegm(time.strptime(value, '%Y-%m-%dT%H:%M:%SZ'))
+            for value in re.search(r'created:(\S+)\.\.(\S+)',
+                                   params['q']).groups())
+        items = [repo for repo in self.repos if low <= repo['created'] <= high]
+        page, per_page = int(params.get('page', 1)), int(params['per_page'])
+        return 200, {}, {
+            'total_count': len(items), 'incomplete_results': False,
+            'items': items[:10][(page - 1) * per_page:page * per_page]}
+
+    def test_slicing(self):
+        repos = list(self.api.search_repos(
+            'language:python', start='2020-01-01', end='2020-02-01'))
+        ids = [repo['id'] for repo in repos]
+        self.assertEqual(len(ids), len(set(ids)))
+        # only first 10 of the repos created at the same second
+        self.assertEqual(len(ids), 155 + 10)
+        queries = [params['q'] for _, path, params in self.server.log
+                   if path == 'search/repositories']
+        self.assertEqual(queries[0], 'language:python created:'
+                         '2020-01-01T00:00:00Z..2020-01-31T23:59:59Z')
+
+
+class TestScan(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.ids = list(range(3, 3000, 3))
+        self.server.routes['repositories'] = self._repositories
+
+    def _repositories(self, params, headers):
+        since = int(params.get('since', 0))
+        return 200, {}, [{'id': i} for i in self.ids
+                         if i > since][:int(params['per_page'])]
+
+    def _ids(self, repos):
+        return [repo['id'] for repo in repos]
+
+    def test_sequential(self):
+        self.assertEqual(self._ids(self.api.all_repos()), self.ids)
+        # the last page is short, no request is needed to find the end
+        self.assertEqual(self.server.requests_to('repositories'), 10)
+        self.assertEqual(self._ids(self.api.all_repos(since=99, until=150)),
+                         list(range(102, 151, 3)))
+
+    def test_shards(self):
+        ids = self._ids(self.api.all_repos(shards=4))
+        self.assertEqual(sorted(ids), self.ids)
+
+    def test_resume(self):
+        from stscraper.store import MemoryStore
+        self.api.checkpoints = MemoryStore()
+        try:
+            repos = self.api.all_repos(until=1500, shards=2)
+            seen = self._ids(next(repos) for _ in range(120))
+            repos.close()
+            # the plan and frontiers of shards
+            self.assertGreaterEqual(len(self.api.checkpoints.items()), 2)
+            seen += self._ids(self.api.all_repos(until=1500, shards=2))
+            # at most the page being consumed is repeated
+            self.assertEqual(sorted(set(seen)), self.ids[:500])
+            self.assertLessEqual(len(seen), 550)
+            self.assertEqual(self.api.checkpoints.items(), [])
+        finally:
+            self.api.checkpoints = None
+
+
+class TestGraphQL(unittest.TestCase):
+
+    def test_analyze(self):
+        from stscraper import graphql
+        query = """query ($owner: String!, $repo: String!, $after: String) {
+            repository(name: $repo, owner: $owner) {
+                defaultBranchRef { target { ...history }}}}
+            fragment history on Ref { ... on Commit {
+                history(first: 100, after: $after) {
+                    nodes { oid, parents(first: 5) {
+                        nodes { oid } pageInfo { endCursor hasNextPage }}}
+                    pageInfo { endCursor, hasNextPage }}}}"""
+        info = graphql.analyze(query)
+        self.assertEqual(info.object_path, (
+            'repository', 'defaultBranchRef', 'target', 'history'))
+        self.assertTrue(info.paginated)
+        self.assertEqual(info.cursor, 'after')
+        self.assertEqual(info.nested, ('parents',))
+        # memoized
+        self.assertIs(graphql.analyze(query), info)
+
+        info = graphql.analyze('{ viewer { login, bio: bio } rateLimit '
+                               '{ cost } }')
+        self.assertEqual(info.object_path, ('viewer',))
+        self.assertFalse(info.paginated)
+        # explicit path; 'pageInfo' in a string is not pagination
+        info = graphql.analyze('{ a(s: "pageInfo") { b c } d }', ('a',))
+        self.assertFalse(info.paginated)
+        self.assertRaises(graphql.GraphQLSyntaxError, graphql.parse, '{ a(')
+        self.assertEqual(stscraper.parse_graphql_path('{ a( '), [])
+
+
+class TestCheckpoints(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        from stscraper.store import MemoryStore
+        self.api.checkpoints = MemoryStore()
+        self.commits = [{'sha': str(i)} for i in range(9)]
+        self.server.paginated('repos/a/b/commits', self.commits)
+
+    def tearDown(self):
+        self.api.checkpoints = None
+
+    def test_resume(self):
+        commits = self.api.repo_commits('a/b')
+        # two pages completed, third started
+        self.assertEqual([next(commits) for _ in range(5)], self.commits[:5])
+        commits.close()
+        (key, page), = self.api.checkpoints.items()
+        self.assertEqual(page, 2)
+        self.assertEqual(key, self.api.checkpoint_key(
+            'repos/a/b/commits', page=1, per_page=100))
+
+        self.assertEqual(list(self.api.repo_commits('a/b')), self.commits[4:])
+        self.assertEqual(self.api.checkpoints.items(), [])
+
+    def test_resume_prefetch(self):
+        commits = self.api.request(
+            'repos/a/b/commits', paginate=True, prefetch=2)
+        self.assertEqual([next(commits) for _ in range(7)], self.commits[:7])
+        commits.close()
+        self.assertEqual(list(self.api.repo_commits('a/b')), self.commits[6:])
+
+    def test_v4(self):
+        FakeGitHubAPIv4._instance = None
+        api = FakeGitHubAPIv4('token1')
+        api.checkpoints = self.api.checkpoints
+
+        def route(params, headers):
+            cursor = int(params['_body']['variables'].get('cursor') or 0)
+            return 200, {}, {'data': {'user': {'followers': {
+                'nodes': [{'login': str(cursor)}],
+                'pageInfo': {'endCursor': str(cursor + 1),
+                             'hasNextPage': cursor < 3}}}}}
+        self.server.routes['graphql'] = route
+
+        query = '''query ($user: String!, $cursor: String) {
+          user(login: $user) {
+            followers(first:100, after:$cursor) {
+              nodes { login }
+              pageInfo{endCursor, hasNextPage}
+        }}}'''
+        followers = api(query, user='x')
+        self.assertEqual([next(followers) for _ in range(2)],
+                         [{'login': '0'}, {'login': '1'}])
+        followers.close()
+        # the second page wasn't completed, so it is fetched again
+        self.assertEqual([f['login'] for f in api(query, user='x')],
+                         ['1', '2', '3'])
+        self.assertEqual(api.checkpoints.items(), [])
+
+
+class TestWatermarks(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        from stscraper.store import MemoryStore
+        self.api.watermarks = MemoryStore()
+        self.issues = [{'number': i, 'updated_at': '2020-01-0%dT00:00:00Z' % i}
+                       for i in range(1, 6)]
+
+        def route(params, headers):
+            since = params.get('since', '')
+            return 200, {}, [issue for issue in self.issues
+                             if issue['updated_at'] >= since]
+        self.server.routes['repos/a/b/issues'] = route
+
+    def tearDown(self):
+        self.api.watermarks = None
+
+    def test_incremental(self):
+        self.assertEqual(len(list(self.api.repo_issues('a/b'))), 5)
+        self.assertEqual(self.api.watermarks.items(), [
+            ('repos/a/b/issues?state=all', '2020-01-05T00:00:00Z')])
+
+        self.issues[1]['updated_at'] = '2020-01-07T00:00:00Z'
+        issues = list(self.api.repo_issues('a/b'))
+        # since is inclusive, so the last seen issue is returned again
+        self.assertEqual([issue['number'] for issue in issues], [2, 5])
+        self.assertEqual(self.server.log[-1][2]['since'],
+                         '2020-01-05T00:00:00Z')
+        self.assertEqual(self.api.watermarks.get('repos/a/b/issues?state=all'),
+                         '2020-01-07T00:00:00Z')
+
+    def test_interrupted(self):
+        issues = self.api.repo_issues('a/b')
+        next(issues)
+        issues.close()
+        self.assertEqual(self.api.watermarks.items(), [])
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.records = ({'sha': str(i), 'author': {'login': 'user%d' % i},
+                         'parents': [{'sha': str(i - 1)}]} for i in range(25))
+        self.mapping = {'sha': 'sha', 'author': 'author__login',
+                        'parents': 'parents'}
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def _path(self, name):
+        import os
+        return os.path.join(self.tmpdir, name)
+
+    def test_ndjson(self):
+        import gzip
+        from stscraper.export import export, NDJSONSink
+        path = self._path('commits.ndjson.gz')
+        count = export(self.records, NDJSONSink(path), self.mapping,
+                       chunk_size=10)
+        self.assertEqual(count, 25)
+        with gzip.open(path, 'rt') as fh:
+            rows = [json.loads(line) for line in fh]
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[3], {'sha': '3', 'author': 'user3',
+                                   'parents': [{'sha': '2'}]})
+
+    def test_csv(self):
+        import csv
+        from stscraper.export import export, CSVSink
+        path = self._path('commits.csv')
+        export(self.records, CSVSink(path, fieldnames=['sha', 'author']),
+               self.mapping, chunk_size=10)
+        with open(path) as fh:
+            rows = list(csv.DictReader(fh))
+        self.assertEqual(len(rows), 25)
+        self.assertEqual(rows[24], {'sha': '24', 'author': 'user24'})
+
+    def test_parquet(self):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+        from stscraper.export import export, ParquetSink
+        path = self._path('commits.parquet')
+        export(self.records, ParquetSink(path), self.mapping, chunk_size=10)
+        parquet_file = pq.ParquetFile(path)
+        self.assertEqual(parquet_file.metadata.num_rows, 25)
+        self.assertEqual(parquet_file.metadata.num_row_groups, 3)
+
+    def test_parquet_nulls(self):
+        import os
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+        from stscraper.export import ParquetSink
+        records = [{'number': i, 'closed': i if i >= 5 else None,
+                    'label': None} for i in range(20)]
+        path = self._path('issues.parquet')
+        sink = ParquetSink(path)
+        size = 0
+        for i in range(0, 20, 5):
+            sink.write(records[i:i + 5])
+            # every chunk is written right away, nothing is held back
+            self.assertGreater(os.path.getsize(path), size)
+            size = os.path.getsize(path)
+        sink.close()
+
+        parquet_file = pq.ParquetFile(path)
+        self.assertEqual(parquet_file.metadata.num_row_groups, 4)
+        table = parquet_file.read()
+        # no values in the first chunk, assumed to be strings
+        self.assertEqual(table.schema.field('closed').type, pa.string())
+        self.assertEqual(table.column('closed').to_pylist(),
+                         [None] * 5 + [str(i) for i in range(5, 20)])
+        self.assertEqual(table.schema.field('label').type, pa.string())
+        self.assertEqual(table.column('label').to_pylist(), [None] * 20)
+
+
+class TestStores(unittest.TestCase):
+
+    def _test_store(self, store_class):
+        import os
+        import tempfile
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(path)
+        try:
+            store = store_class(path)
+            self.assertIsNone(store.get('a'))
+            store.set('a', 1)
+            store.set('ab', {'x': [1]})
+            store.set('b', 'c')
+            store.delete('b')
+            store.delete('nonexistent')
+            store = store_class(path)
+            self.assertEqual(store.get('ab'), {'x': [1]})
+            self.assertEqual(sorted(store.items('a')),
+                             [('a', 1), ('ab', {'x': [1]})])
+            store.clear('ab')
+            self.assertEqual(store.items(), [('a', 1)])
+        finally:
+            os.remove(path)
+
+    def test_json_store(self):
+        from stscraper.store import JSONFileStore
+        self._test_store(JSONFileStore)
+
+    def test_sqlite_store(self):
+        from stscraper.store import SQLiteStore
+        self._test_store(SQLiteStore)
+
+
+class TestStreaming(FakeServerTestCase):
+
+    def tearDown(self):
+        self.api.stream = False
+
+    def test_rest(self):
+        commits = [{'sha': str(i), 'stats': {'total': i * 0.5}}
+                   for i in range(5)]
+        self.server.paginated('repos/a/b/commits', commits)
+        self.api.stream = True
+        self.assertEqual(list(self.api.repo_commits('a/b')), commits)
+
+    def test_v4(self):
+        FakeGitHubAPIv4._instance = None
+        api = FakeGitHubAPIv4('token1')
+        api.stream = True
+
+        def route(params, headers):
+            cursor = int(params['_body']['variables'].get('cursor') or 0)
+            return 200, {}, {'data': {'user': {'followers': {
+                'nodes': [{'login': str(cursor)}, {'login': 'x'}],
+                'pageInfo': {'endCursor': str(cursor + 1),
+                             'hasNextPage': cursor < 2}}}}}
+        self.server.routes['graphql'] = route
+
+        followers = api('''query ($user: String!, $cursor: String) {
+          user(login: $user) {
+            followers(first:100, after:$cursor) {
+              nodes { login }
+              pageInfo{endCursor, hasNextPage}
+        }}}''', user='x')
+        self.assertEqual([f['login'] for f in followers],
+                         ['0', 'x', '1', 'x', '2', 'x'])
+
+        self.server.routes['graphql'] = lambda params, headers: (
+            200, {}, {'errors': [{'message': 'Something went wrong'}]})
+        self.assertRaises(stscraper.VCSError, list, api.user_followers('x'))
+
+
+class TestTokenScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.tokens = [stscraper.GitHubAPIToken('token%d' % i)
+                       for i in range(3)]
+        self.scheduler = stscraper.TokenScheduler(self.tokens)
+
+    def _set_limits(self, token, remaining, reset=None, api_class='core'):
+        token.limits[api_class] = {
+            'remaining': remaining, 'limit': 5000,
+            'reset': reset or int(time.time()) + 3600}
+
+    def test_spread(self):
+        # tokens with unknown limits are used in round robin
+        used = [self.scheduler.acquire('repos')[0] for _ in range(6)]
+        self.assertEqual(used[:3], used[3:])
+        self.assertEqual(len(set(used)), 3)
+
+    def test_remaining(self):
+        self._set_limits(self.tokens[0], 10)
+        self._set_limits(self.tokens[1], 100)
+        self._set_limits(self.tokens[2], 20)
+        token, _ = self.scheduler.acquire('repos')
+        self.assertIs(token, self.tokens[1])
+
+    def test_exhausted(self):
+        reset = int(time.time()) + 100
+        for token in self.tokens[1:]:
+            self._set_limits(token, 0, reset)
+        used = {self.scheduler.acquire('repos')[0] for _ in range(5)}
+        self.assertEqual(used, {self.tokens[0]})
+        # search limits are tracked separately
+        self.assertIsNotNone(self.scheduler.acquire('search/code')[0])
+
+        self._set_limits(self.tokens[0], 0, reset - 10)
+        self.assertEqual(self.scheduler.acquire('repos'),
+                         (None, reset - 10))
+
+    def test_reset(self):
+        for token in self.tokens:
+            self._set_limits(token, 0, int(time.time()) - 1)
+        # GitHubAPIToken is ready once reset time passes
+        self.assertIsNotNone(self.scheduler.acquire('repos')[0])
+
+    def test_add(self):
+        for token in self.tokens:
+            self._set_limits(token, 4000)
+        self.scheduler.acquire('repos')
+        token = stscraper.GitHubAPIToken('token4')
+        self._set_limits(token, 5000)
+        self.scheduler.add([token])
+        self.assertIs(self.scheduler.acquire('repos')[0], token)
+
+    def test_cost(self):
+        reset = int(time.time()) + 100
+        for token, remaining in zip(self.tokens, (10, 30, 5)):
+            self._set_limits(token, remaining, reset, 'graphql')
+        self.assertIs(self.scheduler.acquire('graphql', 25)[0],
+                      self.tokens[1])
+        # no token has 25 points left until reset
+        self.assertEqual(self.scheduler.acquire('graphql', 25),
+                         (None, reset))
+        self.assertIs(self.scheduler.acquire('graphql', 5)[0],
+                      self.tokens[0])
+        # GraphQL points are tracked separately from REST requests
+        self.assertIsNotNone(self.scheduler.acquire('repos', 25)[0])
+
+    def test_cost_unknown_reset(self):
+        for token in self.tokens:
+            token.limits['graphql'] = {'remaining': 10, 'reset': None}
+        token, retry_at = self.scheduler.acquire('graphql', 25)
+        self.assertIsNone(token)
+        self.assertGreater(retry_at, time.time())
+        self.assertLess(retry_at, time.time() + 2)
+
+
+def _repo_name(info):
+    return info['name']
+
+
+class TestPool(FakeServerTestCase):
+
+    def test_run(self):
+        for name in 'abc':
+            self.server.routes['repos/user/' + name] = \
+                lambda params, headers, name=name: (200, {}, {'name': name})
+        results = dict(pool.run(
+            'repo_info', ['user/a', 'user/b', 'user/c', 'user/d'],
+            processes=2, threads=2, tokens='token1,token2',
+            api_class=FakeGitHubAPI, transform=_repo_name))
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results['user/a'], 'a')
+        self.assertEqual(results['user/c'], 'c')
+        self.assertIsInstance(results['user/d'], stscraper.RepoDoesNotExist)
+        # tokens are only validated once, in the parent process
+        self.assertEqual(self.server.requests_to('user'), 2)
+
+    def test_shared_limits(self):
+        manager = pool.LimitsManager()
+        manager.start()
+        try:
+            store = manager.LimitsStore()
+            tokens = [stscraper.GitHubAPIToken('token%d' % i)
+                      for i in range(2)]
+            for token in tokens:
+                token.limits['core'] = {
+                    'remaining': 10, 'limit': 5000,
+                    'reset': int(time.time()) + 3600}
+            # the same tokens as seen by two different processes
+            copies = [copy.copy(token) for token in tokens]
+            for token in tokens + copies:
+                token.limits = pool.SharedLimits(
+                    store, str(token), token.limits)
+            scheduler = pool.SharedTokenScheduler(tokens)
+            other = pool.SharedTokenScheduler(copies)
+
+            token = scheduler.acquire('repos')[0]
+            self.assertEqual(token.limits['core']['remaining'], 9)
+            # the other process prefers the token with more requests left
+            self.assertNotEqual(str(other.acquire('repos')[0]), str(token))
+            self.assertEqual(other.acquire('repos')[0].limits['core'][
+                'remaining'], 8)
+
+            # the last request can't be given out twice
+            token.limits['core'] = dict(token.limits['core'], remaining=1)
+            self.assertTrue(token.limits.consume('core'))
+            self.assertFalse(token.limits.consume('core'))
+            self.assertEqual(token.limits['core']['remaining'], 0)
+        finally:
+            manager.shutdown()
+
+
+class TestCoordinator(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestCoordinator, self).setUp()
+        self.coordinator = coordinator.TokenCoordinator().start()
+        self.address = '%s:%d' % self.coordinator.address
+
+    def tearDown(self):
+        self.coordinator.shutdown()
+
+    def _client(self, tokens):
+        return coordinator.CoordinatedScheduler(
+            [stscraper.GitHubAPIToken(t) for t in tokens], self.address)
+
+    def test_shared_limits(self):
+        # two processes using the same tokens
+        client1 = self._client(['token1', 'token2'])
+        client2 = self._client(['token1', 'token2'])
+        reset = int(time.time()) + 100
+        token = client1.acquire('repos')[0]
+        token.limits['core'] = {'remaining': 0, 'limit': 5000, 'reset': reset}
+        token.limits['search'] = {
+            'remaining': 0, 'limit': 30, 'reset': reset + 10}
+
+        for _ in range(3):
+            self.assertNotEqual(str(client2.acquire('repos')[0]), str(token))
+        client2.acquire('repos')[0].limits['core'] = {
+            'remaining': 0, 'limit': 5000, 'reset': reset - 10}
+        self.assertEqual(client1.acquire('repos'), (None, reset - 10))
+        self.assertIsNotNone(client1.acquire('search/code')[0])
+        self.assertEqual(client1.stats()['leases'], 6)
+        client1.close()
+        client2.close()
+
+    def test_api(self):
+        self.server.routes['repos/a/b'] = lambda params, headers: (
+            200, {'X-RateLimit-Remaining': '42', 'X-RateLimit-Limit': '5000',
+                  'X-RateLimit-Reset': '1000'}, {'name': 'b'})
+        self.api.scheduler = coordinator.CoordinatedScheduler(
+            self.api.tokens, self.address)
+        self.assertEqual(self.api.repo_info('a/b'), {'name': 'b'})
+        limits = self.api.scheduler.stats()['limits']
+        self.assertIn(42, [token_limits.get('core', {}).get('remaining')
+                           for token_limits in limits.values()])
+        self.api.scheduler.close()
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), "requires Unix sockets")
+    def test_unix_socket(self):
+        import os
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), 'coordinator.sock')
+        server = coordinator.TokenCoordinator(path).start()
+        try:
+            client = coordinator.CoordinatedScheduler(
+                [stscraper.GitHubAPIToken('token1')], path)
+            self.assertEqual(str(client.acquire('repos')[0]), 'token1')
+            client.close()
+        finally:
+            server.shutdown()
+
+
+class TestBackoff(FakeServerTestCase):
+
+    def test_secondary_limit(self):
+        def route(params, headers):
+            if headers['Authorization'] == 'token token1':
+                return 403, {'Retry-After': '30'}, {
+                    'message': 'You have exceeded a secondary rate limit'}
+            return 200, {}, {'name': 'b'}
+        self.server.routes['repos/a/b'] = route
+
+        start = time.time()
+        for _ in range(4):
+            self.assertEqual(self.api.repo_info('a/b'), {'name': 'b'})
+        # no sleeping, the request is retried with the other token
+        self.assertLess(time.time() - start, 5)
+        token1 = [t for t in self.api.tokens if str(t) == 'token1'][0]
+        self.assertFalse(token1.ready('repos/a/b'))
+        self.assertGreater(token1.when('repos/a/b'), time.time() + 20)
+        # search API is limited separately
+        self.assertTrue(token1.ready('search/code'))
+
+    def test_park_after_response(self):
+        token1 = stscraper.GitHubAPIToken('token1')
+        token2 = stscraper.GitHubAPIToken('token2')
+        scheduler = stscraper.TokenScheduler([token1, token2])
+        until = time.time() + 30
+        token1.park('repos/a/b', until)
+        # a request made before the park is answered with plenty of quota
+        response = stscraper.base._build_response(200, {
+            'X-RateLimit-Remaining': '4999', 'X-RateLimit-Limit': '5000',
+            'X-RateLimit-Reset': str(int(time.time()) + 3600)}, b'', '')
+        token1._update_limits(response, 'repos/a/b')
+        self.assertEqual(token1.limits['core']['remaining'], 4999)
+        self.assertFalse(token1.ready('repos/a/b'))
+        self.assertGreaterEqual(token1.when('repos/a/b'), until)
+        for _ in range(4):
+            self.assertIs(scheduler.acquire('repos/a/b')[0], token2)
+
+    def test_policy(self):
+        policy = stscraper.BackoffPolicy(base=1, cap=10)
+        for attempt in range(1, 6):
+            delay = policy.delay(attempt)
+            limit = min(10, 2 ** attempt)
+            self.assertTrue(limit / 2.0 <= delay <= limit)
+
+        response = stscraper.base._build_response(
+            403, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}, b'', '')
+        self.assertEqual(policy.retry_after(response), 0)
+        response.headers['Retry-After'] = '120'
+        self.assertEqual(policy.retry_after(response), 120)
+
+        # primary rate limit: park until reset
+        reset = int(time.time()) + 100
+        response = stscraper.base._build_response(429, {
+            'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset)},
+            b'', '')
+        token = stscraper.GitHubAPIToken('token')
+        self.assertEqual(policy.rate_limited(response, 'repos', 1, token), 0)
+        self.assertEqual(token.when('repos'), reset)
+
+
+class TestMetrics(FakeServerTestCase):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.api.metrics = metrics.MetricsRegistry()
+        self.api.backoff = stscraper.BackoffPolicy(base=0.01)
+        self.failures = [502]
+
+        def route(params, headers):
+            if self.failures:
+                return self.failures.pop(), {}, None
+            return 200, {'X-RateLimit-Remaining': '42',
+                         'X-RateLimit-Limit': '5000',
+                         'X-RateLimit-Reset': '1000'}, {'name': 'b'}
+        self.server.routes['repos/a/b/issues/12'] = route
+
+    def tearDown(self):
+        self.api.metrics = None
+        del self.api.backoff
+
+    def test_counters(self):
+        self.api._request('repos/a/b/issues/12')
+        registry = self.api.metrics
+        labels = {'api_class': 'core',
+                  'endpoint': 'repos/:owner/:repo/issues/:id'}
+        for status in ('502', '200'):
+            self.assertEqual(
+                registry.get('requests_total', status=status, **labels), 1)
+        self.assertEqual(
+            registry.get('retries_total', reason='server_error'), 1)
+        self.assertEqual(registry.get('request_seconds', api_class='core'), 2)
+        self.assertEqual(
+            registry.get('response_bytes_total', api_class='core'),
+            len(b'{"name": "b"}'))
+
+        text = registry.render()
+        self.assertIn('# TYPE stscraper_request_seconds histogram', text)
+        self.assertIn('stscraper_request_seconds_bucket'
+                      '{api_class="core",le="+Inf"} 2', text)
+        six.assertRegex(
+            self, text, r'stscraper_token_remaining\{api_class="core",'
+                  r'token="\.\.\.ken\d"\} 42\n')
+
+    def test_serve(self):
+        self.api._request('repos/a/b/issues/12')
+        server = self.api.metrics.serve(0)
+        try:
+            r = requests.get('http://127.0.0.1:%d/metrics' %
+                             server.server_address[1])
+            self.assertIn('stscraper_requests_total{', r.text)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestFakeServer(unittest.TestCase):
+
+    def test_rate_limit(self):
+        server = FakeGitHub(rate_limit=3)
+        try:
+            server.paginated('repos/a/b/commits', list(range(5)), 1)
+            # 'user' request to validate the token + 2 pages
+            api = server.api('token1')
+            commits = api.request('repos/a/b/commits', paginate=True,
+                                  per_page=1)
+            self.assertEqual([next(commits), next(commits)], [0, 1])
+            self.assertEqual(api.tokens[0].limits['core']['remaining'], 0)
+            api.tokens[0].limits['core']['remaining'] = 1
+            self.assertRaises(stscraper.TokenNotReady,
+                              api.tokens[0], 'repos/a/b/commits')
+        finally:
+            server.shutdown()
+
+    def test_errors(self):
+        server = FakeGitHub(seed=1)
+        try:
+            server.paginated('repos/a/b/commits', list(range(5)), 1)
+            api = server.api('token1')
+            api.backoff = stscraper.BackoffPolicy(base=0.01)
+            server.errors = {502: 0.4}
+            self.assertEqual(list(api.request(
+                'repos/a/b/commits', paginate=True, per_page=1)),
+                list(range(5)))
+            self.assertGreater(server.requests_to('repos/a/b/commits'), 5)
+        finally:
+            server.shutdown()
+
+    def test_connection(self):
+        server = FakeGitHub()
+        try:
+            server.connection('user.followers', [
+                {'login': str(i)} for i in range(250)])
+            api = server.api('token1', stscraper.GitHubAPIv4)
+            self.assertEqual(len(list(api.user_followers('user'))), 250)
+            self.assertEqual(server.requests_to('graphql'), 3)
+        finally:
+            server.shutdown()
+
+    def test_query_cost(self):
+        server = FakeGitHub(rate_limit=5000)
+        try:
+            server.connection('user.followers', [
+                {'login': str(i)} for i in range(250)], cost=7)
+            api = server.api('token1', stscraper.GitHubAPIv4)
+            self.assertEqual(len(list(api.user_followers('user'))), 250)
+            queries = [params['_body']['query']
+                       for _, path, params in server.log if path == 'graphql']
+            self.assertIn('rateLimit { cost }', queries[0])
+            self.assertEqual(list(api._costs.values()), [7])
+            limits = api.tokens[0].limits
+            self.assertEqual(limits['graphql']['remaining'], 5000 - 4)
+            self.assertEqual(limits['core']['remaining'], 5000 - 1)
+        finally:
+            server.shutdown()
+
+        query = stscraper.github._inject_rate_limit(
+            'query ($a: In = {b: "{"}) { user { login } }')
+        self.assertEqual(
+            query, 'query ($a: In = {b: "{"}) { rateLimit { cost } '
+                   'user { login } }')
+
+
+class TestCoalescing(FakeServerTestCase):
+
+    def setUp(self):
+        FakeServerTestCase.setUp(self)
+        self.api.metrics = metrics.MetricsRegistry()
+        self.server.latency = 0.2
+        self.server.routes['users/x'] = lambda params, headers: (
+            200, {}, {'login': 'x'})
+
+    def tearDown(self):
+        self.server.latency = 0
+        self.api.metrics = None
+
+    def _concurrently(self, func, n=8):
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(n)
+        try:
+            return [pool.apply_async(func) for _ in range(n)]
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_coalesce(self):
+        results = self._concurrently(lambda: self.api.user_info('x'))
+        self.assertEqual([r.get() for r in results], [{'login': 'x'}] * 8)
+        self.assertEqual(self.server.requests_to('users/x'), 1)
+        self.assertEqual(self.api.metrics.get('coalesced_total'), 7)
+        # completed requests are not reused
+        self.api.user_info('x')
+        self.assertEqual(self.server.requests_to('users/x'), 2)
+
+    def test_errors(self):
+        results = self._concurrently(lambda: self.api.user_info('missing'))
+        for result in results:
+            self.assertRaises(stscraper.RepoDoesNotExist, result.get)
+        self.assertEqual(self.server.requests_to('users/missing'), 1)
+
+
+class TestTransport(FakeServerTestCase):
+
+    def setUp(self):
+        self.server.log = []
+        self.server.paginated('repos/a/b/commits', list(range(6)), 2)
+        self.api_class._instance = None
+
+    def tearDown(self):
+        self.api.tokens[0].transport.close()
+        self.api_class._instance = None
+        del self.api_class.transport
+
+    def test_shared(self):
+        self.api_class.transport = stscraper.Transport(pool_maxsize=4)
+        self.api = self.api_class('token1,token2')
+        tokens = self.api.tokens
+        self.assertIs(tokens[0].transport, tokens[1].transport)
+        self.assertEqual(list(self.api.repo_commits('a/b')), list(range(6)))
+        # 2 concurrent token validations and 3 pages
+        stats = self.api_class.transport.stats()
+        self.assertEqual(stats['requests'], 5)
+        self.assertLessEqual(stats['connections'], 2)
+        self.assertEqual(stats['reused'], 5 - stats['connections'])
+
+    @unittest.skipIf(six.PY2, "httpx requires Python 3")
+    def test_http2(self):
+        try:
+            self.api_class.transport = stscraper.Transport(http2=True)
+        except ImportError:
+            self.skipTest("httpx is not installed")
+        self.api = self.api_class('token1')
+        self.assertEqual(list(self.api.repo_commits('a/b')), list(range(6)))
+        self.api.stream = True
+        try:
+            self.assertEqual(list(self.api.repo_commits('a/b')),
+                             list(range(6)))
+        finally:
+            self.api.stream = False
+        self.assertEqual(self.api_class.transport.stats()['requests'], 7)
+
+
+class TestTokenValidation(FakeServerTestCase):
+
+    def setUp(self):
+        self.server.log = []
+        self.api_class._instance = None
+
+        def user(params, headers):
+            if headers['Authorization'] == 'token bad':
+                return 401, {}, {'message': 'Bad credentials'}
+            return 200, {}, {'login': headers['Authorization'][-1]}
+        self.server.routes['user'] = user
+        self.server.latency = 0.1
+
+    def tearDown(self):
+        self.server.latency = 0
+        del self.server.routes['user']
+        self.api_class._instance = None
+        for attr in ('token_cache', 'validate_tokens'):
+            if attr in self.api_class.__dict__:
+                delattr(self.api_class, attr)
+
+    def test_concurrent(self):
+        start = time.time()
+        api = self.api_class(['token%d' % i for i in range(8)] + ['bad'])
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(sorted(token.user for token in api.tokens),
+                         [str(i) for i in range(8)])
+
+    def test_cache(self):
+        from stscraper.store import MemoryStore
+        self.api_class.token_cache = MemoryStore()
+        self.api_class('token1,token2,bad')
+        self.assertEqual(self.server.requests_to('user'), 3)
+
+        self.api_class._instance = None
+        api = self.api_class('token1,token2,bad')
+        self.assertEqual(self.server.requests_to('user'), 3)
+        self.assertEqual(sorted(token.user for token in api.tokens),
+                         ['1', '2'])
+
+    def test_lazy(self):
+        self.api_class.validate_tokens = False
+        api = self.api_class('bad')
+        self.assertEqual(len(api.tokens), 1)
+        self.assertEqual(self.server.requests_to('user'), 0)
+        # a rejected token is not used anymore
+        api.__init__('token1')
+        self.server.routes['repos/a/b'] = lambda params, headers: (
+            (401, {}, {'message': 'Bad credentials'})
+            if headers['Authorization'] == 'token bad'
+            else (200, {}, {'name': 'b'}))
+        for _ in range(3):
+            self.assertEqual(api.repo_info('a/b'), {'name': 'b'})
+        self.assertLessEqual(self.server.requests_to('repos/a/b'), 4)
+
 
 class TestGitHub(unittest.TestCase):
 
@@ -372,5 +1603,10 @@ class TestGitHubv4(unittest.TestCase):
         self.assertRaises(stscraper.VCSError, stargazers)
 
 
+# async API tests use syntax unavailable in Python 2
+if sys.version_info >= (3, 6):
+    from test_aio import *  # noqa: F401,F403
+
+
 if __name__ == "__main__":
     unittest.main()
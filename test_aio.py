@@ -0,0 +1,176 @@
+""" Tests of the asyncio API, loaded by test.py on Python 3.6+ """
+
+import asyncio
+import unittest
+
+import stscraper
+from stscraper import aio
+from test import (FakeServerTestCase, FakeGitHubToken, FakeGitHubAPI,
+                  FakeGitHubAPIv4, TestBatchQueries, TestNestedPages,
+                  TestSearch)
+
+__all__ = ['TestAsyncGitHub', 'TestAsyncGitHubv4']
+
+
+@unittest.skipIf(aio.aiohttp is None, "async API requires aiohttp")
+class TestAsyncGitHub(FakeServerTestCase):
+    api_class = type('FakeAsyncGitHubAPI', (aio.AsyncGitHubAPI,), {
+        'token_class': FakeGitHubToken, 'sync_class': FakeGitHubAPI}
+    )
+
+    def setUp(self):
+        self.api_class.sync_class._instance = None
+        FakeServerTestCase.setUp(self)
+
+    def _run(self, coro):
+        async def wrapper():
+            try:
+                return await coro
+            finally:
+                await self.api.close()
+        # asyncio.run() requires Python 3.7+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(wrapper())
+        finally:
+            loop.close()
+
+    def test_shared_tokens(self):
+        sync_api = self.api_class.sync_class('token1,token2')
+        self.assertIs(self.api.tokens[0], sync_api.tokens[0])
+        self.assertIs(self.api.scheduler, sync_api.scheduler)
+
+    def test_blocking_methods(self):
+        self.assertRaises(NotImplementedError, self.api.iterate_tokens)
+
+        async def users():
+            return [u async for u in self.api.all_users(shards=2)]
+
+        self.assertRaises(NotImplementedError, self._run, users())
+
+    def test_single_object(self):
+        self.server.routes['repos/a/b'] = lambda params, headers: (
+            200, {}, {'full_name': 'a/b'})
+        info = self._run(self.api.repo_info('a/b'))
+        self.assertEqual(info, {'full_name': 'a/b'})
+
+    def test_pagination(self):
+        self.server.paginated('repos/a/b/commits',
+                              [{'sha': str(i)} for i in range(5)])
+
+        async def commits():
+            return [c async for c in self.api.repo_commits('a/b')]
+
+        self.assertEqual(len(self._run(commits())), 5)
+
+    def test_prefetch(self):
+        commits = [{'sha': str(i)} for i in range(9)]
+        self.server.paginated('repos/a/b/commits', commits)
+
+        async def fetch():
+            return [c async for c in self.api.request(
+                'repos/a/b/commits', paginate=True, prefetch=3)]
+
+        self.assertEqual(self._run(fetch()), commits)
+
+    def test_scan(self):
+        self.server.routes['users'] = lambda params, headers: (200, {}, [
+            {'id': i} for i in range(int(params['since']) + 1, 25)
+        ][:int(params['per_page'])])
+        self.api.scan_per_page = 10
+
+        async def users(**kwargs):
+            return [u['id'] async for u in self.api.all_users(**kwargs)]
+
+        self.assertEqual(self._run(users(until=20)), list(range(1, 21)))
+        self.assertEqual(self.server.requests_to('users'), 2)
+        # the short last page ends the scan without an extra request
+        self.assertEqual(self._run(users()), list(range(1, 25)))
+        self.assertEqual(self.server.requests_to('users'), 5)
+
+    # same search results as in TestSearch
+    _search = TestSearch._search
+
+    def test_search(self):
+        TestSearch.setUp(self)
+
+        async def repos():
+            return [repo['id'] async for repo in self.api.search_repos(
+                'language:python', start='2020-01-01', end='2020-02-01')]
+
+        ids = self._run(repos())
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(len(ids), 155 + 10)
+
+    def test_concurrency(self):
+        self.server.routes['users/x'] = lambda params, headers: (
+            200, {}, {'login': 'x'})
+
+        async def users():
+            return await asyncio.gather(
+                *(self.api.user_info('x') for _ in range(20)))
+
+        self.assertEqual(len(self._run(users())), 20)
+
+    def test_not_found(self):
+        self.assertRaises(stscraper.RepoDoesNotExist,
+                          self._run, self.api.repo_info('a/nonexistent'))
+
+
+
+@unittest.skipIf(aio.aiohttp is None, "async API requires aiohttp")
+class TestAsyncGitHubv4(FakeServerTestCase):
+    api_class = type('FakeAsyncGitHubAPIv4', (aio.AsyncGitHubAPIv4,), {
+        'token_class': FakeGitHubToken, 'sync_class': FakeGitHubAPIv4}
+    )
+
+    setUp = TestAsyncGitHub.setUp
+    _run = TestAsyncGitHub._run
+    # reuse fake GraphQL endpoints of the blocking API tests
+    max_aliases = TestBatchQueries.max_aliases
+    _batch_graphql = TestBatchQueries._graphql
+    _queries = TestBatchQueries._queries
+    _page = TestNestedPages._page
+    _graphql = TestNestedPages._graphql
+
+    def test_users_info(self):
+        self.server.routes['graphql'] = self._batch_graphql
+        logins = ['u%d' % i for i in range(8)]
+
+        async def users():
+            return [user['login'] async for user in self.api.users_info(
+                logins, batch_size=8)]
+
+        self.assertEqual(self._run(users()), logins)
+        self.assertEqual(self._queries(), 7)
+
+    def test_split_on_timeout(self):
+        def graphql(params, headers):
+            # the query takes too long to run
+            if params['_body']['query'].count(': user(') > 2:
+                return 502, {}, {}
+            return self._batch_graphql(params, headers)
+
+        self.server.routes['graphql'] = graphql
+        self.api.retries_on_timeout = 0
+        logins = ['u%d' % i for i in range(8)]
+
+        async def users():
+            return [user['login'] async for user in self.api.users_info(
+                logins, batch_size=8)]
+
+        self.assertEqual(self._run(users()), logins)
+        # one failed query of 8 and then 2 batches of 4, then 4 batches of 2
+        self.assertEqual(self._queries(), 7)
+
+    def test_nested_pages(self):
+        TestNestedPages.setUp(self)
+
+        async def issues():
+            return [issue async for issue in self.api.v4(
+                TestNestedPages.query, owner='a', name='b', labels=5)]
+
+        self.assertEqual([issue['comments']['nodes']
+                          for issue in self._run(issues())],
+                         [self.comments['I%d' % i] for i in range(4)])
+        self.assertEqual(self.server.requests_to('graphql'), 3)